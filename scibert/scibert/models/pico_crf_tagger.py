@@ -27,12 +27,20 @@ class PicoCrfTagger(Model):
     - No option for `calculate_span_f1` because PICO is evaluated at token-level
     - No option for `verbose_metrics`.  Defaults to printing all because in PICO,
       we want to see F1 scores for each class.
+
+    ``calculate_training_metrics=False`` skips Viterbi decoding and the metrics
+    on training batches, where only the loss is then returned. With
+    ``batched_viterbi=True`` all sequences of a batch are decoded at once on
+    the device of the logits instead of one by one by ``crf.viterbi_tags``;
+    the paths are the same.
     """
     def __init__(self, vocab: Vocabulary,
                  text_field_embedder: TextFieldEmbedder,
                  encoder: Seq2SeqEncoder,
                  include_start_end_transitions: bool = True,
                  dropout: Optional[float] = None,
+                 calculate_training_metrics: bool = True,
+                 batched_viterbi: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator(),
                  regularizer: Optional[RegularizerApplicator] = None) -> None:
         super().__init__(vocab, regularizer)
@@ -49,6 +57,8 @@ class PicoCrfTagger(Model):
         output_dim = self.encoder.get_output_dim()
         self.tag_projection_layer = TimeDistributed(Linear(output_dim, self.num_tags))
         self.crf = ConditionalRandomField(self.num_tags, constraints=None, include_start_end_transitions=include_start_end_transitions)
+        self.calculate_training_metrics = calculate_training_metrics
+        self.batched_viterbi = batched_viterbi
 
         self.metrics = {
             "accuracy": CategoricalAccuracy(),
@@ -78,27 +88,39 @@ class PicoCrfTagger(Model):
             encoded_text = self.dropout(encoded_text)
 
         logits = self.tag_projection_layer(encoded_text)
-        best_paths = self.crf.viterbi_tags(logits, mask)
-
-        # Just get the tags and ignore the score.
-        predicted_tags = [x for x, y in best_paths]
-
-        output = {"logits": logits, "mask": mask, "tags": predicted_tags}
-        # output = {"tags": predicted_tags}
+        output = {"logits": logits, "mask": mask}
+
+        if tags is not None and self.training and not self.calculate_training_metrics:
+            # Only the loss is needed.
+            output["loss"] = -self.crf(logits, tags, mask)
+            if metadata is not None:
+                output["words"] = [x["words"] for x in metadata]
+            return output
+
+        if self.batched_viterbi:
+            paths, lengths = self.viterbi_paths(logits, mask)
+            predicted_tags = [path[:length] for path, length in zip(paths.tolist(), lengths.tolist())]
+        else:
+            # Just get the tags and ignore the score.
+            predicted_tags = [x for x, y in self.crf.viterbi_tags(logits, mask)]
+            paths = None
+        output["tags"] = predicted_tags
 
         if tags is not None:
             # Add negative log-likelihood as loss
             log_likelihood = self.crf(logits, tags, mask)
             output["loss"] = -log_likelihood
 
-            # Represent viterbi tags as "class probabilities" that we can
-            # feed into the metrics
-            class_probabilities = logits * 0.
-            for i, instance_tags in enumerate(predicted_tags):
-                for j, tag_id in enumerate(instance_tags):
-                    class_probabilities[i, j, tag_id] = 1
-
             if environ.get('PICO_MODE') != 'PREDICT':
+                # Represent viterbi tags as "class probabilities" that we can
+                # feed into the metrics; the paths cover the unmasked tokens.
+                if paths is None:
+                    paths = torch.zeros(mask.size(), dtype=torch.long)
+                    for i, instance_tags in enumerate(predicted_tags):
+                        paths[i, :len(instance_tags)] = torch.LongTensor(instance_tags)
+                    paths = paths.to(logits.device)
+                class_probabilities = (logits * 0.).scatter_(
+                    2, paths.unsqueeze(-1), mask.unsqueeze(-1).to(logits.dtype))
                 for metric in self.metrics.values():
                     metric(class_probabilities, tags, mask.float())
 
@@ -106,6 +128,41 @@ class PicoCrfTagger(Model):
             output["words"] = [x["words"] for x in metadata]
         return output
 
+    def viterbi_paths(self, logits: torch.Tensor, mask: torch.Tensor):
+        """
+        Decodes the best tag sequences of a batch at once, with the scores
+        ``crf.viterbi_tags`` would use for each sequence. Returns the paths,
+        padded with 0 to ``(batch, tokens)``, and the sequence lengths.
+        """
+        logits, mask = logits.detach(), mask.bool()
+        batch_size, max_seq_length, num_tags = logits.size()
+        lengths = mask.long().sum(-1)
+        transitions = self.crf.transitions.detach()
+        if self.crf.include_start_end_transitions:
+            start_transitions = self.crf.start_transitions.detach()
+            end_transitions = self.crf.end_transitions.detach()
+        else:
+            start_transitions = end_transitions = logits.new_zeros(num_tags)
+
+        # (batch, tags) best score of any path ending in each tag.
+        path_scores = start_transitions + logits[:, 0]
+        identity = torch.arange(num_tags, device=logits.device).expand(batch_size, num_tags)
+        backpointers = []
+        for t in range(1, max_seq_length):
+            scores, pointers = (path_scores.unsqueeze(-1) + transitions).max(1)
+            # Past the end of a sequence, carry its scores over and point back to the same tag.
+            step_mask = mask[:, t].unsqueeze(-1)
+            path_scores = torch.where(step_mask, logits[:, t] + scores, path_scores)
+            backpointers.append(torch.where(step_mask, pointers, identity))
+
+        _, best_tags = (path_scores + end_transitions).max(1)
+        paths = [best_tags]
+        for pointers in reversed(backpointers):
+            best_tags = pointers.gather(1, best_tags.unsqueeze(-1)).squeeze(-1)
+            paths.append(best_tags)
+        paths = torch.stack(paths[::-1], 1)
+        return paths * mask.long(), lengths
+
     @overrides
     def decode(self, output_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
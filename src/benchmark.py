@@ -0,0 +1,313 @@
+#encoding=utf-8
+"""
+Micro-benchmarks for the data pipeline, e.g.
+
+    python benchmark.py -mode oracle
+    python benchmark.py -mode collate
+    python benchmark.py -mode step -device cpu
+    python benchmark.py -mode precision -device cpu -precisions fp32 bf16
+    python benchmark.py -mode rouge -candidate ../results/ext_bert_covid_step9000.candidate \
+                                    -gold ../results/ext_bert_covid_step9000.gold
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+from models.data_loader import Batch, DataIterator
+from models.encoder import ExtTransformerEncoder
+from models.precision import autocast, DynamicLossScaler, PRECISIONS
+from models.reporter_ext import Statistics
+from others.utils import test_rouge, rouge_results_to_str
+from prepro.utils import _get_word_ngrams, NgramOracle
+
+
+def str2bool(v):
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('Boolean value expected.')
+
+
+def _random_doc(n_sents, vocab_size, sent_len=25):
+    # Zipf-like token distribution so that n-grams overlap as in real text.
+    weights = [1.0 / (r + 1) for r in range(vocab_size)]
+    words = ['w%d' % r for r in range(vocab_size)]
+    return [random.choices(words, weights, k=random.randint(sent_len // 2, sent_len * 2))
+            for _ in range(n_sents)]
+
+
+def _set_union_selection(sents, abstract, summary_size):
+    """The original `greedy_selection` search, kept as the reference."""
+
+    def cal_rouge(evaluated_ngrams, reference_ngrams):
+        overlapping_count = len(evaluated_ngrams.intersection(reference_ngrams))
+        precision = overlapping_count / len(evaluated_ngrams) if evaluated_ngrams else 0.0
+        recall = overlapping_count / len(reference_ngrams) if reference_ngrams else 0.0
+        return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
+    max_rouge = 0.0
+    evaluated_1grams = [_get_word_ngrams(1, [sent]) for sent in sents]
+    reference_1grams = _get_word_ngrams(1, [abstract])
+    evaluated_2grams = [_get_word_ngrams(2, [sent]) for sent in sents]
+    reference_2grams = _get_word_ngrams(2, [abstract])
+
+    selected = []
+    for s in range(summary_size):
+        cur_max_rouge = max_rouge
+        cur_id = -1
+        for i in range(len(sents)):
+            if (i in selected):
+                continue
+            c = selected + [i]
+            candidates_1 = set.union(*map(set, [evaluated_1grams[idx] for idx in c]))
+            candidates_2 = set.union(*map(set, [evaluated_2grams[idx] for idx in c]))
+            rouge_score = cal_rouge(candidates_1, reference_1grams) + cal_rouge(candidates_2, reference_2grams)
+            if rouge_score > cur_max_rouge:
+                cur_max_rouge = rouge_score
+                cur_id = i
+        if (cur_id == -1):
+            return selected
+        selected.append(cur_id)
+        max_rouge = cur_max_rouge
+
+    return sorted(selected)
+
+
+def oracle(args):
+    random.seed(args.seed)
+    print('%8s %12s %12s %8s' % ('n_sents', 'sets (ms)', 'oracle (ms)', 'speedup'))
+    for n_sents in args.doc_lengths:
+        docs = []
+        for _ in range(args.n_docs):
+            doc = _random_doc(n_sents + 10, args.vocab_size)
+            docs.append((doc[:n_sents], sum(doc[n_sents:], [])))
+
+        start = time.time()
+        expected = [_set_union_selection(sents, abstract, args.summary_size) for sents, abstract in docs]
+        sets_time = (time.time() - start) / len(docs)
+
+        start = time.time()
+        labels = [NgramOracle(sents, abstract).select(args.summary_size) for sents, abstract in docs]
+        oracle_time = (time.time() - start) / len(docs)
+
+        assert labels == expected, 'oracle labels differ from the set-union search'
+        print('%8d %12.2f %12.2f %7.1fx' % (n_sents, sets_time * 1000, oracle_time * 1000,
+                                             sets_time / oracle_time))
+
+
+def _random_example():
+    n_sents = random.randint(3, 40)
+    sent_lens = [random.randint(8, 60) for _ in range(n_sents)]
+    clss = [sum(sent_lens[:i]) for i in range(n_sents)]
+    src = [random.randint(1, 30000) for _ in range(sum(sent_lens))]
+    segs = sum([[i % 2] * l for i, l in enumerate(sent_lens)], [])
+    tgt = [1] + [random.randint(3, 30000) for _ in range(random.randint(20, 200))] + [2]
+    labels = [int(random.random() < 0.1) for _ in range(n_sents)]
+    return {'src': src, 'tgt': tgt, 'segs': segs, 'clss': clss, 'src_sent_labels': labels,
+            'src_txt': [], 'tgt_txt': ''}
+
+
+def _list_batch(data):
+    """The original list-padding `Batch` collation, kept as the reference."""
+
+    def _pad(data, pad_id, width=-1):
+        if (width == -1):
+            width = max(len(d) for d in data)
+        return [d + [pad_id] * (width - len(d)) for d in data]
+
+    src = torch.tensor(_pad([x[0] for x in data], 0))
+    tgt = torch.tensor(_pad([x[1] for x in data], 0))
+    segs = torch.tensor(_pad([x[2] for x in data], 0))
+    clss = torch.tensor(_pad([x[3] for x in data], -1))
+    src_sent_labels = torch.tensor(_pad([x[4] for x in data], 0))
+    mask_cls = ~(clss == -1)
+    clss[clss == -1] = 0
+    return {'src': src, 'tgt': tgt, 'segs': segs, 'clss': clss, 'src_sent_labels': src_sent_labels,
+            'mask_src': ~(src == 0), 'mask_tgt': ~(tgt == 0), 'mask_cls': mask_cls}
+
+
+def collate(args):
+    random.seed(args.seed)
+    dataset = [_random_example() for _ in range(args.n_examples)]
+    print('%10s %8s %12s %12s %8s' % ('batch_size', 'examples', 'lists (ms)', 'arrays (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        it_args = argparse.Namespace(task='ext', max_tgt_len=140, use_interval=True, max_pos=512)
+        minibatches = list(DataIterator(it_args, dataset, batch_size, shuffle=False).create_batches())
+
+        start = time.time()
+        expected = [_list_batch(mb) for mb in minibatches]
+        list_time = (time.time() - start) / len(minibatches)
+
+        start = time.time()
+        batches = [Batch(mb, 'cpu') for mb in minibatches]
+        array_time = (time.time() - start) / len(minibatches)
+
+        for batch, ref in zip(batches, expected):
+            for name, tensor in ref.items():
+                assert torch.equal(getattr(batch, name), tensor), name
+        n_examples = sum(len(mb) for mb in minibatches) / len(minibatches)
+        print('%10d %8.1f %12.3f %12.3f %7.1fx' % (batch_size, n_examples, list_time * 1000, array_time * 1000,
+                                                    list_time / array_time))
+
+
+def rouge(args):
+    """Score a .candidate/.gold pair in memory and, if ROUGE-1.5.5 is set up, with pyrouge."""
+    start = time.time()
+    native = test_rouge(args.temp_dir, args.candidate, args.gold, engine='native')
+    print('native (%.1fs)\n%s' % (time.time() - start, rouge_results_to_str(native)))
+    if not args.perl:
+        return
+    start = time.time()
+    perl = test_rouge(args.temp_dir, args.candidate, args.gold, engine='perl')
+    print('perl (%.1fs)\n%s' % (time.time() - start, rouge_results_to_str(perl)))
+    for key in sorted(native):
+        if key in perl and not key.endswith(('_cb', '_ce')):
+            print('%-24s %.5f %.5f %+.5f' % (key, native[key], perl[key], native[key] - perl[key]))
+
+
+def _train_steps(args, model, optim, batches, host_sync, precision='fp32'):
+    """Runs the extractive training step of `trainer_ext` over `batches`.
+
+    Returns the per-report xent values, including one for the batches
+    after the last full report, the seconds per step and the largest
+    number of bytes saved for backward by a step.
+    """
+    if precision == 'fp32':
+        loss_fn = torch.nn.BCELoss(reduction='none')
+    else:
+        loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
+    scaler = DynamicLossScaler() if precision == 'fp16' else None
+    report_stats, xents = Statistics(), []
+    saved = [0]
+
+    def _pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    activation_bytes = 0
+    if args.device != 'cpu':
+        torch.cuda.synchronize()
+    start = time.time()
+    for i, (vecs, mask, labels) in enumerate(batches, 1):
+        optim.zero_grad()
+        saved[0] = 0
+        with torch.autograd.graph.saved_tensors_hooks(_pack, lambda t: t):
+            with autocast(precision, args.device):
+                if precision == 'fp32':
+                    sent_scores = model(vecs, mask)
+                else:
+                    sent_scores = model.logits(vecs, mask)
+            loss = (loss_fn(sent_scores.float(), labels) * mask.float()).sum()
+        activation_bytes = max(activation_bytes, saved[0])
+        if scaler is not None:
+            (loss * scaler.scale / loss.numel()).backward()
+        else:
+            (loss / loss.numel()).backward()
+        if scaler is None or scaler.unscale_(model.parameters()):
+            optim.step()
+        if host_sync:
+            batch_stats = Statistics(float(loss.cpu().data.numpy()), len(labels))
+        else:
+            batch_stats = Statistics(loss, len(labels))
+        report_stats.update(batch_stats)
+        if i % args.report_every == 0:
+            xents.append(report_stats.xent())
+            report_stats = Statistics()
+    if report_stats.n_docs > 0:
+        xents.append(report_stats.xent())
+    if args.device != 'cpu':
+        torch.cuda.synchronize()
+    return xents, (time.time() - start) / len(batches), activation_bytes
+
+
+def _step_batches(args):
+    torch.manual_seed(args.seed)
+    batches = []
+    for _ in range(args.n_steps):
+        lengths = torch.randint(1, args.n_sents + 1, (args.step_batch_size,))
+        mask = torch.arange(args.n_sents)[None] < lengths[:, None]
+        labels = (torch.rand(args.step_batch_size, args.n_sents) < 0.1).float() * mask.float()
+        vecs = torch.randn(args.step_batch_size, args.n_sents, args.hidden_size)
+        batches.append((vecs.to(args.device), mask.to(args.device), labels.to(args.device)))
+    return batches
+
+
+def _step_run(args, batches, host_sync, precision='fp32'):
+    torch.manual_seed(args.seed)
+    model = ExtTransformerEncoder(args.hidden_size, args.hidden_size * 4, 4, 0.1, args.layers).to(args.device)
+    optim = torch.optim.Adam(model.parameters(), lr=1e-4)
+    # Warm up on the first report's batches.
+    _train_steps(args, model, optim, batches[:args.report_every], host_sync, precision)
+    return _train_steps(args, model, optim, batches, host_sync, precision)
+
+
+def step(args):
+    """Step time of the extractive training loop with per-batch host syncs of the loss and without."""
+    batches = _step_batches(args)
+    results = {}
+    for host_sync in [True, False, True, False]:
+        xents, seconds, _ = _step_run(args, batches, host_sync)
+        # Keep the best of the repeated runs.
+        if host_sync in results:
+            seconds = min(seconds, results[host_sync][1])
+        results[host_sync] = (xents, seconds)
+
+    sync_xents, sync_time = results[True]
+    device_xents, device_time = results[False]
+    print('%12s %12s %12s %8s' % ('device', 'sync (ms)', 'no sync (ms)', 'speedup'))
+    print('%12s %12.2f %12.2f %7.2fx' % (args.device, sync_time * 1000, device_time * 1000, sync_time / device_time))
+    print('max xent difference: %g' % max(abs(a - b) for a, b in zip(sync_xents, device_xents)))
+
+
+def precision(args):
+    """Throughput and activation memory of the extractive training step in each `-precision`."""
+    batches = _step_batches(args)
+    n_docs = sum(len(labels) for _, _, labels in batches)
+    print('%10s %10s %10s %14s %10s' % ('precision', 'ms/step', 'docs/s', 'activations MB', 'xent diff'))
+    ref_xents = None
+    for prec in args.precisions:
+        xents, seconds, activation_bytes = _step_run(args, batches, False, prec)
+        seconds = min(seconds, _step_run(args, batches, False, prec)[1])
+        if ref_xents is None:
+            ref_xents = xents
+        print('%10s %10.2f %10.1f %14.2f %10.4f' % (prec, seconds * 1000, n_docs / (seconds * len(batches)),
+                                                   activation_bytes / 2. ** 20,
+                                                   max(abs(a - b) for a, b in zip(ref_xents, xents))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-mode", default='oracle', type=str)
+    parser.add_argument("-seed", default=666, type=int)
+
+    parser.add_argument("-n_docs", default=5, type=int)
+    parser.add_argument("-doc_lengths", default=[25, 50, 100, 200, 400], type=int, nargs='+')
+    parser.add_argument("-vocab_size", default=3000, type=int)
+    parser.add_argument("-summary_size", default=7, type=int)
+
+    parser.add_argument("-n_examples", default=2000, type=int)
+    parser.add_argument("-batch_sizes", default=[140, 3000], type=int, nargs='+')
+
+    parser.add_argument("-device", default='cpu', type=str)
+    parser.add_argument("-n_steps", default=200, type=int)
+    parser.add_argument("-step_batch_size", default=16, type=int)
+    parser.add_argument("-n_sents", default=32, type=int)
+    parser.add_argument("-hidden_size", default=64, type=int)
+    parser.add_argument("-layers", default=2, type=int)
+    parser.add_argument("-report_every", default=50, type=int)
+    parser.add_argument("-precisions", default=['fp32', 'bf16'], nargs='+', choices=PRECISIONS)
+
+    parser.add_argument("-candidate", default='../results/cnndm.candidate')
+    parser.add_argument("-gold", default='../results/cnndm.gold')
+    parser.add_argument("-temp_dir", default='../temp')
+    parser.add_argument("-perl", type=str2bool, nargs='?', const=True, default=True)
+
+    args = parser.parse_args()
+    if args.n_steps < 1 or args.report_every < 1:
+        parser.error('-n_steps and -report_every must be positive')
+    eval(args.mode + '(args)')
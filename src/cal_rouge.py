@@ -1,88 +1,91 @@
 import argparse
-import os
+import itertools
 import time
+from collections import deque
 # from multiprocess import Pool as Pool2
 from multiprocessing import Pool
 
-import shutil
 import sys
 import codecs
 
+import numpy as np
+
 # from onmt.utils.logging import init_logger, logger
-from others import pyrouge
+from others import rouge
 
 
 def process(data):
-    candidates, references, pool_id = data
-    cnt = len(candidates)
-    current_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime())
-    tmp_dir = "rouge-tmp-{}-{}".format(current_time,pool_id)
-    if not os.path.isdir(tmp_dir):
-        os.mkdir(tmp_dir)
-        os.mkdir(tmp_dir + "/candidate")
-        os.mkdir(tmp_dir + "/reference")
-    try:
-
-        for i in range(cnt):
-            if len(references[i]) < 1:
-                continue
-            with open(tmp_dir + "/candidate/cand.{}.txt".format(i), "w",
-                      encoding="utf-8") as f:
-                f.write(candidates[i])
-            with open(tmp_dir + "/reference/ref.{}.txt".format(i), "w",
-                      encoding="utf-8") as f:
-                f.write(references[i])
-        r = pyrouge.Rouge155()
-        r.model_dir = tmp_dir + "/reference/"
-        r.system_dir = tmp_dir + "/candidate/"
-        r.model_filename_pattern = 'ref.#ID#.txt'
-        r.system_filename_pattern = r'cand.(\d+).txt'
-        rouge_results = r.convert_and_evaluate()
-        print(rouge_results)
-        results_dict = r.output_to_dict(rouge_results)
-    finally:
-        pass
-        if os.path.isdir(tmp_dir):
-            shutil.rmtree(tmp_dir)
-    return results_dict
+    """Score one chunk of (candidate, reference) pairs, NaN rows for empty references."""
+    rows = np.full((len(data), len(rouge.SCORE_NAMES)), np.nan)
+    for i, (candidate, reference) in enumerate(data):
+        if len(reference) < 1:
+            continue
+        rows[i] = rouge.score(candidate, reference)
+    return rows
+
 
+def chunks(l, n):
+    """Yield successive n-sized chunks from the iterable l."""
+    l = iter(l)
+    while True:
+        chunk = list(itertools.islice(l, n))
+        if not chunk:
+            return
+        yield chunk
 
 
+def _pairs(cand, ref):
+    for c, r in itertools.zip_longest(cand, ref):
+        assert c is not None and r is not None, 'candidates and references differ in length'
+        yield c.strip(), r.strip()
+
+
+def write_rows(f, rows, start):
+    for i, row in enumerate(rows, start=start):
+        f.write('%d\t%s\n' % (i, '\t'.join('%.6f' % v for v in row)))
+
+
+def read_rows(path):
+    """Per-document score rows written by `test_rouge`, NaN for skipped documents."""
+    return np.loadtxt(path, delimiter='\t', skiprows=1, ndmin=2)[:, 1:]
 
-def chunks(l, n):
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
 
-def test_rouge(cand, ref,num_processes):
+def aggregate_rows(rows):
+    """Corpus-level averages and bootstrap confidence intervals from per-document rows."""
+    rows = rows[~np.isnan(rows).any(1)]
+    return rouge.aggregate(rows)
+
+
+def test_rouge(cand, ref, num_processes, rows_path, chunk_size=200):
     """Calculate ROUGE scores of sequences passed as an iterator
        e.g. a list of str, an open file, StringIO or even sys.stdin
+
+       Pairs are streamed to `num_processes` workers in chunks of
+       `chunk_size`, with at most two chunks per worker in flight, and the
+       per-document scores are written in input order to `rows_path`.
     """
-    candidates = [line.strip() for line in cand]
-    references = [line.strip() for line in ref]
-
-    print(len(candidates))
-    print(len(references))
-    assert len(candidates) == len(references)
-    candidates_chunks = list(chunks(candidates, int(len(candidates)/num_processes)))
-    references_chunks = list(chunks(references, int(len(references)/num_processes)))
-    n_pool = len(candidates_chunks)
-    arg_lst = []
-    for i in range(n_pool):
-        arg_lst.append((candidates_chunks[i],references_chunks[i],i))
-    pool = Pool(n_pool)
-    results = pool.map(process,arg_lst)
-    print("results:",results)
-    final_results = {}
-    for i,r in enumerate(results):
-        for k in r:
-            if(k not in final_results):
-                final_results[k] = r[k]*len(candidates_chunks[i])
-            else:
-                final_results[k] += r[k] * len(candidates_chunks[i])
-    for k in final_results:
-        final_results[k] = final_results[k]/len(candidates)
-    return final_results
+    pairs = _pairs(cand, ref)
+    n_docs = 0
+    pending = deque()
+    # Leaving the `with` terminates the workers, also when scoring a chunk failed.
+    with Pool(num_processes) as pool, open(rows_path, 'w') as f:
+        f.write('\t'.join(['doc'] + rouge.SCORE_NAMES) + '\n')
+        for chunk in chunks(pairs, chunk_size):
+            pending.append(pool.apply_async(process, (chunk,)))
+            if len(pending) >= 2 * num_processes:
+                rows = pending.popleft().get()
+                write_rows(f, rows, n_docs)
+                n_docs += len(rows)
+        while pending:
+            rows = pending.popleft().get()
+            write_rows(f, rows, n_docs)
+            n_docs += len(rows)
+        pool.close()
+        pool.join()
+    print('Scored %d documents, rows in %s' % (n_docs, rows_path))
+    return aggregate_rows(read_rows(rows_path))
+
+
 def rouge_results_to_str(results_dict):
     return ">> ROUGE-F(1/2/3/l): {:.2f}/{:.2f}/{:.2f}\nROUGE-R(1/2/3/l): {:.2f}/{:.2f}/{:.2f}\n".format(
         results_dict["rouge_1_f_score"] * 100,
@@ -98,6 +101,14 @@ def rouge_results_to_str(results_dict):
     )
 
 
+def rouge_results_to_ci_str(results_dict):
+    lines = []
+    for name in rouge.SCORE_NAMES:
+        lines.append('{}: {:.2f} (95%-conf.int. {:.2f} - {:.2f})'.format(
+            name, results_dict[name] * 100, results_dict[name + '_cb'] * 100, results_dict[name + '_ce'] * 100))
+    return '\n'.join(lines)
+
+
 if __name__ == "__main__":
     # init_logger('test_rouge.log')
     parser = argparse.ArgumentParser()
@@ -107,20 +118,34 @@ if __name__ == "__main__":
                         help='reference file')
     parser.add_argument('-p', type=int, default=1,
                         help='number of processes')
+    parser.add_argument('-o', type=str, default='',
+                        help='per-document scores file, defaults to the candidate file + .rouge.tsv')
+    parser.add_argument('-chunk_size', type=int, default=200,
+                        help='documents per worker task')
+    parser.add_argument('-aggregate_only', action='store_true',
+                        help='only aggregate an existing per-document scores file')
     args = parser.parse_args()
     print(args.c)
     print(args.r)
     print(args.p)
-    if args.c.upper() == "STDIN":
-        candidates = sys.stdin
+    rows_path = args.o
+    if not rows_path:
+        rows_path = 'stdin.rouge.tsv' if args.c.upper() == "STDIN" else args.c + '.rouge.tsv'
+
+    if args.aggregate_only:
+        results_dict = aggregate_rows(read_rows(rows_path))
     else:
-        candidates = codecs.open(args.c, encoding="utf-8")
-    references = codecs.open(args.r, encoding="utf-8")
+        if args.c.upper() == "STDIN":
+            candidates = sys.stdin
+        else:
+            candidates = codecs.open(args.c, encoding="utf-8")
+        references = codecs.open(args.r, encoding="utf-8")
 
-    results_dict = test_rouge(candidates, references,args.p)
+        results_dict = test_rouge(candidates, references, args.p, rows_path, args.chunk_size)
     # return 0
     #print('dict:', results_dict)
     print(time.strftime('%H:%M:%S', time.localtime())
 )
     print(rouge_results_to_str(results_dict))
+    print(rouge_results_to_ci_str(results_dict))
     # logger.info(rouge_results_to_str(results_dict))
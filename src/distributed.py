@@ -6,6 +6,7 @@
 
 from __future__ import print_function
 
+import collections
 import math
 import pickle
 
@@ -18,12 +19,12 @@ def is_master(gpu_ranks, device_id):
     return gpu_ranks[device_id] == 0
 
 
-def multi_init(device_id, world_size,gpu_ranks):
+def multi_init(device_id, world_size,gpu_ranks, backend='nccl'):
     print(gpu_ranks)
     dist_init_method = 'tcp://localhost:10000'
     dist_world_size = world_size
     torch.distributed.init_process_group(
-        backend='nccl', init_method=dist_init_method,
+        backend=backend, init_method=dist_init_method,
         world_size=dist_world_size, rank=gpu_ranks[device_id])
     gpu_rank = torch.distributed.get_rank()
     if not is_master(gpu_ranks, device_id):
@@ -88,14 +89,153 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
         all_reduce_buffer()
 
 
+def _comm_device():
+    # gloo reduces host tensors, nccl device ones.
+    return 'cpu' if torch.distributed.get_backend() == 'gloo' else 'cuda'
+
+
+class GradientSynchronizer(object):
+    """All-reduces the gradients of `params` while the backward pass runs.
+
+    Only parameters that require grad are synchronized. They are grouped,
+    in reverse order of `params` (roughly the order in which backward
+    produces their gradients), into flat buckets of at most `bucket_size`
+    bytes that are allocated once. After `arm`, a hook copies each gradient
+    into its bucket once it is accumulated, and a bucket is all-reduced
+    asynchronously as soon as all its gradients are in. Buckets are
+    launched in the same order on every rank, as the collectives require.
+    `finish` reduces what is left, waits, and copies the sums back into
+    the gradients, divided by `rescale_denom`.
+
+    Gradients of the parameters in `deferred`, which get several
+    contributions per step (e.g. from the sharded generator loss), are only
+    reduced in `finish`.
+
+    Args:
+        params: parameters of the model
+        bucket_size: bucket size in bytes
+        deferred: parameters not to reduce during backward
+    """
+
+    def __init__(self, params, bucket_size=10485760, deferred=()):
+        deferred = set(id(p) for p in deferred)
+        seen = set()
+        params = [p for p in params if p.requires_grad and not (id(p) in seen or seen.add(id(p)))]
+        self.buckets = self._make_buckets([p for p in reversed(params) if id(p) not in deferred], bucket_size)
+        self.deferred = self._make_buckets([p for p in reversed(params) if id(p) in deferred], bucket_size)
+        self.slots = {}
+        for bucket in self.buckets:
+            for i, p in enumerate(bucket['params']):
+                self.slots[p] = (bucket, i)
+        self.armed = False
+        self.next_bucket = 0
+        self._hooks = [self._register(p) for p in self.slots]
+
+    @staticmethod
+    def _make_buckets(params, bucket_size):
+        groups = collections.OrderedDict()
+        for p in params:
+            groups.setdefault((p.dtype, p.device), []).append(p)
+        buckets = []
+        for (dtype, device), group in groups.items():
+            chunk, filled = [], 0
+            for p in group:
+                sz = p.numel() * p.element_size()
+                if chunk and filled + sz > bucket_size:
+                    buckets.append(chunk)
+                    chunk, filled = [], 0
+                chunk.append(p)
+                filled += sz
+            if chunk:
+                buckets.append(chunk)
+        result = []
+        for chunk in buckets:
+            offsets = [0]
+            for p in chunk:
+                offsets.append(offsets[-1] + p.numel())
+            result.append({'params': chunk, 'offsets': offsets,
+                           'flat': chunk[0].new_zeros(offsets[-1]),
+                           'filled': [False] * len(chunk), 'n_filled': 0, 'handle': None})
+        return result
+
+    def _register(self, p):
+        if hasattr(p, 'register_post_accumulate_grad_hook'):
+            return p.register_post_accumulate_grad_hook(self._on_grad)
+        # Older torch: hook the node that accumulates into `p.grad`.
+        grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+        grad_acc.register_hook(lambda *unused: self._on_grad(p))
+        return grad_acc
+
+    def _fill(self, bucket, i):
+        p = bucket['params'][i]
+        view = bucket['flat'][bucket['offsets'][i]:bucket['offsets'][i + 1]]
+        if p.grad is None:
+            view.zero_()
+        else:
+            view.copy_(p.grad.detach().view(-1))
+        bucket['filled'][i] = True
+        bucket['n_filled'] += 1
+
+    def _on_grad(self, p):
+        if not self.armed:
+            return
+        bucket, i = self.slots[p]
+        if bucket['filled'][i]:
+            return
+        self._fill(bucket, i)
+        while (self.next_bucket < len(self.buckets)
+               and self.buckets[self.next_bucket]['n_filled'] == len(self.buckets[self.next_bucket]['params'])):
+            self._launch(self.buckets[self.next_bucket])
+            self.next_bucket += 1
+
+    @staticmethod
+    def _launch(bucket):
+        bucket['handle'] = torch.distributed.all_reduce(bucket['flat'], async_op=True)
+
+    def arm(self):
+        """Reduce gradients as they are produced by the next backward pass."""
+        self.armed = True
+
+    def finish(self, rescale_denom=1.):
+        """Reduce the remaining gradients and write the results back."""
+        for bucket in self.buckets[self.next_bucket:] + self.deferred:
+            for i, filled in enumerate(bucket['filled']):
+                if not filled:
+                    self._fill(bucket, i)
+            self._launch(bucket)
+        for bucket in self.buckets + self.deferred:
+            bucket['handle'].wait()
+            if rescale_denom != 1:
+                bucket['flat'].div_(rescale_denom)
+            for i, p in enumerate(bucket['params']):
+                if p.grad is not None:
+                    p.grad.detach().view(-1).copy_(bucket['flat'][bucket['offsets'][i]:bucket['offsets'][i + 1]])
+            bucket['filled'] = [False] * len(bucket['params'])
+            bucket['n_filled'] = 0
+            bucket['handle'] = None
+        self.armed = False
+        self.next_bucket = 0
+
+
+def all_reduce_values(values):
+    """Sums a list of numbers across all processes with one all-reduce.
+
+    The numbers are packed into a float64 tensor on the device the backend
+    communicates from, so counts stay exact and any backend works.
+    """
+    buffer_t = torch.tensor(values, dtype=torch.float64, device=_comm_device())
+    torch.distributed.all_reduce(buffer_t)
+    return buffer_t.tolist()
+
+
 def all_gather_list(data, max_size=4096):
     """Gathers arbitrary data from all nodes into a list."""
     world_size = torch.distributed.get_world_size()
     if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != all_gather_list._in_buffer.size():
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
+            max_size != all_gather_list._in_buffer.size(0):
+        all_gather_list._in_buffer = torch.zeros(max_size, dtype=torch.uint8, device=_comm_device())
         all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
+            torch.zeros(max_size, dtype=torch.uint8, device=_comm_device())
             for i in range(world_size)
         ]
     in_buffer = all_gather_list._in_buffer
@@ -111,7 +251,7 @@ def all_gather_list(data, max_size=4096):
     in_buffer[1] = enc_size % 255
     in_buffer[2:enc_size+2] = torch.ByteTensor(list(enc))
 
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
+    torch.distributed.all_gather(out_buffers, in_buffer)
 
     results = []
     for i in range(world_size):
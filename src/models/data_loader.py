@@ -1,23 +1,60 @@
 import bisect
-import gc
 import glob
+import itertools
+import os
 import random
+import threading
+from queue import Queue, Full
 
+import numpy as np
 import torch
 
+from others.columnar import ColumnarShard, is_columnar, SUFFIX as COLUMNAR_SUFFIX
 from others.logging import logger
 
 
 
 class Batch(object):
     def _pad(self, data, pad_id, width=-1):
-        if (width == -1):
-            width = max(len(d) for d in data)
-        rtn_data = [d + [pad_id] * (width - len(d)) for d in data]
-        return rtn_data
+        """Pad `data` into a preallocated (batch, width) long tensor.
 
-    def __init__(self, data=None, device=None, is_test=False):
-        """Create a Batch from a list of examples."""
+        Returns the tensor and the row lengths. The rows are copied in with a
+        single masked assignment instead of building padded Python lists.
+        """
+        lengths = np.fromiter((len(d) for d in data), dtype=np.int64, count=len(data))
+        if (width == -1):
+            width = int(lengths.max())
+        rtn_data = torch.empty((len(data), width), dtype=torch.long, pin_memory=self.pin_memory)
+        buf = rtn_data.numpy()
+        buf.fill(pad_id)
+        buf[np.arange(width) < lengths[:, None]] = np.fromiter(
+            itertools.chain.from_iterable(data), dtype=np.int64, count=int(lengths.sum()))
+        return rtn_data, lengths
+
+    def _mask(self, lengths, width):
+        mask = torch.empty((len(lengths), width), dtype=torch.bool, pin_memory=self.pin_memory)
+        np.less(np.arange(width), lengths[:, None], out=mask.numpy())
+        return mask
+
+    def _ne(self, data, value):
+        mask = torch.empty(data.size(), dtype=torch.bool, pin_memory=self.pin_memory)
+        return torch.ne(data, value, out=mask)
+
+    tensor_fields = ['clss', 'mask_cls', 'src_sent_labels', 'src', 'tgt', 'segs', 'mask_src', 'mask_tgt']
+
+    def __init__(self, data=None, device=None, is_test=False, pin_memory=False, shard=None, example_ids=None):
+        """Create a Batch from a list of examples.
+
+        With `device=None` the tensors stay on the host (in page-locked
+        memory if `pin_memory`) until `to` is called. `shard` and
+        `example_ids` say where the examples come from, see
+        `models.encoder_cache`. `src_lengths` holds the unpadded source
+        lengths, which `mask_src` does not give for tokenizers where the
+        pad id 0 is also a real token.
+        """
+        self.pin_memory = pin_memory
+        self.shard = shard
+        self.example_ids = example_ids
         if data is not None:
             self.batch_size = len(data)
             pre_src = [x[0] for x in data]
@@ -26,30 +63,32 @@ class Batch(object):
             pre_clss = [x[3] for x in data]
             pre_src_sent_labels = [x[4] for x in data]
 
-            #print("data 0:", data[0])
-            #print ("labels:", pre_src_sent_labels)
-            src = torch.tensor(self._pad(pre_src, 0))
-            tgt = torch.tensor(self._pad(pre_tgt, 0))
+            src, src_lengths = self._pad(pre_src, 0)
+            tgt, _ = self._pad(pre_tgt, 0)
 
-            segs = torch.tensor(self._pad(pre_segs, 0))
-            mask_src = ~(src == 0)
-            mask_tgt = ~(tgt == 0)
+            segs, _ = self._pad(pre_segs, 0)
+            mask_src = self._ne(src, 0)
+            mask_tgt = self._ne(tgt, 0)
 
+            # Sentence positions are never negative, so the cls mask follows
+            # from the lengths and padding with 0 directly is equivalent.
+            clss, clss_lengths = self._pad(pre_clss, 0)
+            src_sent_labels, _ = self._pad(pre_src_sent_labels, 0)
+            mask_cls = self._mask(clss_lengths, clss.size(1))
+            setattr(self, 'clss', clss)
+            setattr(self, 'mask_cls', mask_cls)
+            setattr(self, 'src_sent_labels', src_sent_labels)
 
-            clss = torch.tensor(self._pad(pre_clss, -1))
-            src_sent_labels = torch.tensor(self._pad(pre_src_sent_labels, 0))
-            mask_cls = ~(clss == -1)
-            clss[clss == -1] = 0
-            setattr(self, 'clss', clss.to(device))
-            setattr(self, 'mask_cls', mask_cls.to(device))
-            setattr(self, 'src_sent_labels', src_sent_labels.to(device))
 
+            setattr(self, 'src', src)
+            setattr(self, 'tgt', tgt)
+            setattr(self, 'segs', segs)
+            setattr(self, 'mask_src', mask_src)
+            setattr(self, 'mask_tgt', mask_tgt)
+            setattr(self, 'src_lengths', src_lengths)
 
-            setattr(self, 'src', src.to(device))
-            setattr(self, 'tgt', tgt.to(device))
-            setattr(self, 'segs', segs.to(device))
-            setattr(self, 'mask_src', mask_src.to(device))
-            setattr(self, 'mask_tgt', mask_tgt.to(device))
+            if (device is not None):
+                self.to(device)
 
 
             if (is_test):
@@ -58,17 +97,93 @@ class Batch(object):
                 tgt_str = [x[-1] for x in data]
                 setattr(self, 'tgt_str', tgt_str)
 
+    def to(self, device, non_blocking=False):
+        """Move the batch tensors to `device`, asynchronously from pinned memory if `non_blocking`."""
+        for name in self.tensor_fields:
+            setattr(self, name, getattr(self, name).to(device, non_blocking=non_blocking))
+        return self
+
     def __len__(self):
         return self.batch_size
 
 
 
 
-def load_dataset(args, corpus_type, shuffle):
+# Largest share of the data a rank may get, relative to an even split, for
+# shards to be assigned whole.
+_SHARD_IMBALANCE = 1.1
+
+
+class LoadedShard(list):
+    """Examples of a `torch.save`'d shard, with the `path` they were loaded from."""
+    path = None
+    partition = None
+
+
+def _shard_tokens(pt_file, max_pos):
+    """Number of `src` tokens of a shard, estimated without loading it.
+
+    Columnar shards are measured exactly from their offsets index; for
+    `torch.save`'d shards the file size stands in for it.
+    """
+    if is_columnar(pt_file):
+        return int(np.minimum(ColumnarShard(pt_file).lengths('src'), max_pos).sum())
+    return os.path.getsize(pt_file)
+
+
+def _example_tokens(dataset, max_pos):
+    if isinstance(dataset, ColumnarShard):
+        return np.minimum(dataset.lengths('src'), max_pos)
+    return np.array([min(len(ex['src']), max_pos) for ex in dataset], dtype=np.int64)
+
+
+def partition_shards(pts, sizes, world_size):
+    """Assigns whole shards to ranks, balancing the sum of `sizes` per rank.
+
+    Shards are taken from largest to smallest and each goes to the rank
+    with the least so far (ties by name and rank), so every rank gets the
+    same shards in every epoch and whatever the order of `pts`.
+    """
+    loads = [0] * world_size
+    parts = [[] for _ in range(world_size)]
+    for size, pt in sorted(zip(sizes, pts), key=lambda x: (-x[0], x[1])):
+        rank = loads.index(min(loads))
+        parts[rank].append(pt)
+        loads[rank] += size
+    return parts, loads
+
+
+def partition_examples(tokens, rank, world_size, offset=0):
+    """Indexes of the examples of a shard that belong to `rank`.
+
+    Examples are sorted by length and dealt to the ranks in a snake order
+    (0, 1, ..., n-1, n-1, ..., 0, ...), which balances their token counts.
+    The deal starts at rank `offset`, so that the rank getting the longest
+    example changes from shard to shard. A shard with fewer examples than
+    ranks is dealt round and round, so that ranks without an example of
+    their own get a copy of one: a rank with no data would keep reloading
+    it while the others wait for it in the gradient all-reduce.
+    """
+    order = np.argsort(-np.asarray(tokens), kind='stable')
+    if (0 < len(order) < world_size):
+        return order[[(rank - offset) % world_size % len(order)]]
+    lap = np.arange(len(order)) % (2 * world_size)
+    owner = (np.where(lap < world_size, lap, 2 * world_size - 1 - lap) + offset) % world_size
+    return np.sort(order[owner == rank])
+
+
+def load_dataset(args, corpus_type, shuffle, rank=0, world_size=1, epoch=0):
     """
     Dataset generator. Don't do extra stuff here, like printing,
     because they will be postponed to the first loading time.
 
+    With `world_size > 1` only the data of `rank` is yielded: whole shards
+    if they can be spread over the ranks within `_SHARD_IMBALANCE` of an
+    even split, see `partition_shards`, else every shard with a `partition`
+    of its examples, see `partition_examples`, which `DataIterator` keeps
+    to. The order of the shards of a rank only depends on `args.seed`,
+    `rank` and `epoch`.
+
     Args:
         corpus_type: 'train' or 'valid'
     Returns:
@@ -76,23 +191,55 @@ def load_dataset(args, corpus_type, shuffle):
     """
     assert corpus_type in ["train", "valid", "test"]
 
-    def _lazy_dataset_loader(pt_file, corpus_type):
-        dataset = torch.load(pt_file)
-        logger.info('Loading %s dataset from %s, number of examples: %d' %
-                    (corpus_type, pt_file, len(dataset)))
+    def _lazy_dataset_loader(pt_file, corpus_type, partition=None):
+        if is_columnar(pt_file):
+            dataset = ColumnarShard(pt_file)
+        else:
+            dataset = LoadedShard(torch.load(pt_file))
+            dataset.path = pt_file
+        if partition is not None:
+            dataset.partition = partition_examples(_example_tokens(dataset, args.max_pos), *partition)
+            logger.info('Loading %s dataset from %s, number of examples: %d, of rank %d: %d' %
+                        (corpus_type, pt_file, len(dataset), partition[0], len(dataset.partition)))
+        else:
+            logger.info('Loading %s dataset from %s, number of examples: %d' %
+                        (corpus_type, pt_file, len(dataset)))
         return dataset
 
     # Sort the glob output by file name (by increasing indexes).
-    pts = sorted(glob.glob(args.bert_data_path + '/' + corpus_type + '.[0-9]*.bert.pt'))
-    if pts:
-        if (shuffle):
-            random.shuffle(pts)
-
-        for pt in pts:
-            yield _lazy_dataset_loader(pt, corpus_type)
-    else:
+    # Columnar shards are memory-mapped, so prefer them over torch.save'd ones.
+    pts = sorted(glob.glob(args.bert_data_path + '/' + corpus_type + '.[0-9]*.bert' + COLUMNAR_SUFFIX))
+    if not pts:
+        pts = sorted(glob.glob(args.bert_data_path + '/' + corpus_type + '.[0-9]*.bert.pt'))
+    if not pts:
         # Only one inputters.*Dataset, simple!
-        pt = args.bert_data_path + '.' + corpus_type + '.pt'
+        pts = [args.bert_data_path + '.' + corpus_type + '.pt']
+
+    if (world_size > 1):
+        rng = random.Random('%s-%d-%d' % (args.seed, rank, epoch))
+        parts, loads = partition_shards(pts, [_shard_tokens(pt, args.max_pos) for pt in pts], world_size)
+        if (all(parts) and max(loads) <= _SHARD_IMBALANCE * sum(loads) / world_size):
+            pts = parts[rank]
+            if (epoch == 0):
+                logger.info('Rank %d: %d of %d shards, %.1f%% of the data' %
+                            (rank, len(pts), sum(len(p) for p in parts), 100. * loads[rank] / max(sum(loads), 1)))
+            if (shuffle):
+                rng.shuffle(pts)
+            for pt in pts:
+                yield _lazy_dataset_loader(pt, corpus_type)
+        else:
+            if (epoch == 0):
+                logger.info('Rank %d: %d shards too few to split evenly, splitting their examples' % (rank, len(pts)))
+            shards = list(enumerate(pts))
+            if (shuffle):
+                rng.shuffle(shards)
+            for offset, pt in shards:
+                yield _lazy_dataset_loader(pt, corpus_type, (rank, world_size, offset))
+        return
+
+    if (shuffle):
+        random.shuffle(pts)
+    for pt in pts:
         yield _lazy_dataset_loader(pt, corpus_type)
 
 
@@ -126,7 +273,45 @@ def ext_batch_size_fn(new, count):
     return src_elements
 
 
+class PaddingStats(object):
+    """Counts real and padded positions of the `src` and `clss` tensors."""
+
+    def __init__(self):
+        self.src_tokens = 0
+        self.src_positions = 0
+        self.cls_tokens = 0
+        self.cls_positions = 0
+
+    def update(self, minibatch):
+        src_lens = [len(x[0]) for x in minibatch]
+        cls_lens = [len(x[3]) for x in minibatch]
+        self.src_tokens += sum(src_lens)
+        self.src_positions += len(minibatch) * max(src_lens)
+        self.cls_tokens += sum(cls_lens)
+        self.cls_positions += len(minibatch) * max(cls_lens)
+
+    def merge(self, other):
+        self.src_tokens += other.src_tokens
+        self.src_positions += other.src_positions
+        self.cls_tokens += other.cls_tokens
+        self.cls_positions += other.cls_positions
+
+    def src_ratio(self):
+        return 1 - self.src_tokens / max(self.src_positions, 1)
+
+    def cls_ratio(self):
+        return 1 - self.cls_tokens / max(self.cls_positions, 1)
+
+
 class Dataloader(object):
+    """Iterates batches over a sequence of lazily loaded shards.
+
+    With `args.prefetch > 0` shards are loaded and batches are collated in a
+    background thread, up to `args.prefetch` batches ahead of the consumer,
+    and copied to a CUDA device from pinned memory with non-blocking
+    transfers.
+    """
+
     def __init__(self, args, datasets,  batch_size,
                  device, shuffle, is_test):
         self.args = args
@@ -135,56 +320,116 @@ class Dataloader(object):
         self.device = device
         self.shuffle = shuffle
         self.is_test = is_test
+        self.prefetch = args.prefetch
+        self.pin_memory = self.prefetch > 0 and torch.device(device).type == 'cuda'
         self.cur_iter = self._next_dataset_iterator(datasets)
         assert self.cur_iter is not None
 
     def __iter__(self):
+        if self.prefetch > 0:
+            batches = self._prefetch(self._batches())
+        else:
+            batches = self._batches()
+        for batch in batches:
+            yield batch
+
+    def _batches(self):
         dataset_iter = (d for d in self.datasets)
+        padding = PaddingStats()
         while self.cur_iter is not None:
             for batch in self.cur_iter:
                 yield batch
+            padding.merge(self.cur_iter.padding)
             self.cur_iter = self._next_dataset_iterator(dataset_iter)
-
+        logger.info('Padding ratio this epoch: src %.2f%%, clss %.2f%%' %
+                    (padding.src_ratio() * 100, padding.cls_ratio() * 100))
+
+    def _prefetch(self, batches):
+        queue = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _worker():
+            try:
+                for batch in batches:
+                    if not _put(batch):
+                        return
+            except Exception as e:
+                _put(e)
+                return
+            _put(None)
+
+        worker = threading.Thread(target=_worker, daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch.to(self.device, non_blocking=self.pin_memory)
+        finally:
+            # The consumer may stop early (e.g. at train_steps), release the worker.
+            stop.set()
 
     def _next_dataset_iterator(self, dataset_iter):
         try:
             # Drop the current dataset for decreasing memory
-            if hasattr(self, "cur_dataset"):
-                self.cur_dataset = None
-                gc.collect()
-                del self.cur_dataset
-                gc.collect()
-
+            self.cur_dataset = None
             self.cur_dataset = next(dataset_iter)
         except StopIteration:
             return None
 
+        if self.prefetch > 0:
+            # Batches are moved to the device by the consumer, see `_prefetch`.
+            device = None
+        else:
+            device = self.device
         return DataIterator(args = self.args,
             dataset=self.cur_dataset,  batch_size=self.batch_size,
-            device=self.device, shuffle=self.shuffle, is_test=self.is_test)
+            device=device, shuffle=self.shuffle, is_test=self.is_test,
+            pin_memory=self.pin_memory)
 
 
 class DataIterator(object):
     def __init__(self, args, dataset,  batch_size, device=None, is_test=False,
-                 shuffle=True):
+                 shuffle=True, pin_memory=False):
         self.args = args
         self.batch_size, self.is_test, self.dataset = batch_size, is_test, dataset
         self.iterations = 0
         self.device = device
         self.shuffle = shuffle
+        self.pin_memory = pin_memory
 
         self.sort_key = lambda x: len(x[1])
 
         self._iterations_this_epoch = 0
+        self.padding = PaddingStats()
         if (self.args.task == 'abs'):
             self.batch_size_fn = abs_batch_size_fn
         else:
             self.batch_size_fn = ext_batch_size_fn
 
     def data(self):
+        # Shuffle indexes rather than the dataset itself, which may be a
+        # read-only memory-mapped shard.
+        partition = getattr(self.dataset, 'partition', None)
+        if partition is not None:
+            order = partition.tolist()
+        else:
+            order = list(range(len(self.dataset)))
         if self.shuffle:
-            random.shuffle(self.dataset)
-        xs = self.dataset
+            random.shuffle(order)
+        xs = ((i, self.dataset[i]) for i in order)
         return xs
 
 
@@ -214,13 +459,15 @@ class DataIterator(object):
 
     def batch_buffer(self, data, batch_size):
         minibatch, size_so_far = [], 0
-        for ex in data:
+        for i, ex in data:
             if (len(ex['src'])==0): #or (len(ex['src'])<512) or (len(ex['segs'])<512):
                 continue
             ex = self.preprocess(ex, self.is_test)
             #print(ex)
             if(ex is None or any([not val for val in ex])):
                 continue
+            # The example index rides along at the end until the batch is built.
+            ex = ex + (i,)
             minibatch.append(ex)
             size_so_far = self.batch_size_fn(ex, len(minibatch))
             if size_so_far == batch_size:
@@ -256,7 +503,9 @@ class DataIterator(object):
                 p_batch = sorted(buffer, key=lambda x: len(x[2]))
                 p_batch = sorted(p_batch, key=lambda x: len(x[1]))
             else:
-                p_batch = sorted(buffer, key=lambda x: len(x[2]))
+                # Bucket by subtoken length, then by sentence count, so that
+                # batches packed under the token budget carry little padding.
+                p_batch = sorted(buffer, key=lambda x: (len(x[0]), len(x[3])))
 
             p_batch = self.batch(p_batch, self.batch_size)
 
@@ -278,8 +527,12 @@ class DataIterator(object):
                     continue
                 self.iterations += 1
                 self._iterations_this_epoch += 1
+                self.padding.update(minibatch)
                 #print(minibatch)
-                batch = Batch(minibatch, self.device, self.is_test)
+                example_ids = [x[-1] for x in minibatch]
+                minibatch = [x[:-1] for x in minibatch]
+                batch = Batch(minibatch, self.device, self.is_test, pin_memory=self.pin_memory,
+                              shard=getattr(self.dataset, 'path', None), example_ids=example_ids)
 
                 yield batch
             return
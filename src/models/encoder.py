@@ -12,8 +12,11 @@ class Classifier(nn.Module):
         self.linear1 = nn.Linear(hidden_size, 1)
         self.sigmoid = nn.Sigmoid()
 
+    def logits(self, x, mask_cls):
+        return self.linear1(x).squeeze(-1)
+
     def forward(self, x, mask_cls):
-        h = self.linear1(x).squeeze(-1)
+        h = self.logits(x, mask_cls)
         sent_scores = self.sigmoid(h) * mask_cls.float()
         return sent_scores
 
@@ -84,8 +87,8 @@ class ExtTransformerEncoder(nn.Module):
         self.wo = nn.Linear(d_model, 1, bias=True)
         self.sigmoid = nn.Sigmoid()
 
-    def forward(self, top_vecs, mask):
-        """ See :obj:`EncoderBase.forward()`"""
+    def logits(self, top_vecs, mask):
+        """ Sentence scores before the sigmoid, for losses that take logits. """
 
         batch_size, n_sents = top_vecs.size(0), top_vecs.size(1)
         pos_emb = self.pos_emb.pe[:, :n_sents]
@@ -96,8 +99,12 @@ class ExtTransformerEncoder(nn.Module):
             x = self.transformer_inter[i](i, x, x, ~mask)  # all_sents * max_tokens * dim
 
         x = self.layer_norm(x)
-        sent_scores = self.sigmoid(self.wo(x))
-        sent_scores = sent_scores.squeeze(-1) * mask.float()
+        return self.wo(x).squeeze(-1)
+
+    def forward(self, top_vecs, mask):
+        """ See :obj:`EncoderBase.forward()`"""
+        sent_scores = self.sigmoid(self.logits(top_vecs, mask))
+        sent_scores = sent_scores * mask.float()
 
         return sent_scores
 
@@ -0,0 +1,146 @@
+"""
+On-disk cache of the sentence vectors `ExtSummarizer` feeds to `ext_layer`.
+
+With `finetune_bert=False` the encoder runs frozen under `torch.no_grad`, so
+its output for an example only depends on the encoder/adapter weights and
+on the example's input ids. Vectors are stored under
+
+    <cache_dir>/<weights hash>/<shard name>.<shard path hash>/
+        vecs.f16     float16 rows of all cached examples, memory-mapped
+        index.npy    int64 (row offset, number of rows, input digest) per example
+
+Entries are looked up by shard and example index and only used if the
+digest of the example's `src`/`segs`/`clss` still matches, so a rebuilt shard
+or a different `-max_pos` falls back to the encoder. A weights hash is
+shared by every checkpoint of a run that did not fine-tune the encoder, so
+`-test_all` and repeated validation only run the encoder once per example.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+_MISSING = -1
+
+
+def weights_hash(module):
+    """SHA-1 of the names and values of all parameters and buffers of `module`."""
+    h = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def _digest(*rows):
+    h = hashlib.sha1()
+    for row in rows:
+        h.update(np.ascontiguousarray(row, dtype=np.int64).tobytes())
+    return int(np.frombuffer(h.digest()[:8], dtype=np.int64)[0])
+
+
+class _ShardCache(object):
+    def __init__(self, path, hidden_size):
+        self.hidden_size = hidden_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.vecs_path = os.path.join(path, 'vecs.f16')
+        self.index_path = os.path.join(path, 'index.npy')
+        if os.path.exists(self.index_path):
+            self.index = np.load(self.index_path)
+        else:
+            self.index = np.zeros((0, 3), dtype=np.int64)
+        # Rows past the last saved index entry are from an interrupted write.
+        self.n_rows = int((self.index[:, 0] + np.maximum(self.index[:, 1], 0)).max()) if len(self.index) else 0
+        self.vecs = None
+
+    def _rows(self, end):
+        if self.vecs is None or len(self.vecs) < end:
+            self.vecs = np.memmap(self.vecs_path, dtype=np.float16, mode='r').reshape(-1, self.hidden_size)
+        return self.vecs
+
+    def get(self, example_ids, digests):
+        if max(example_ids) >= len(self.index):
+            return None
+        entries = self.index[example_ids]
+        if (entries[:, 1] == _MISSING).any() or (entries[:, 2] != digests).any():
+            return None
+        vecs = self._rows(int((entries[:, 0] + entries[:, 1]).max()))
+        return [vecs[start:start + n] for start, n, _ in entries]
+
+    def put(self, example_ids, digests, vecs):
+        """Store the vectors of the examples that are not cached yet or whose digest changed."""
+        if max(example_ids) >= len(self.index):
+            index = np.zeros((max(example_ids) + 1, 3), dtype=np.int64)
+            index[:, 1] = _MISSING
+            index[:len(self.index)] = self.index
+            self.index = index
+        entries = self.index[example_ids]
+        stale = np.flatnonzero((entries[:, 1] == _MISSING) | (entries[:, 2] != digests))
+        if (len(stale) == 0):
+            return
+        with open(self.vecs_path, 'r+b' if os.path.exists(self.vecs_path) else 'wb') as f:
+            f.seek(self.n_rows * self.hidden_size * 2)
+            for k in stale:
+                v = vecs[k]
+                f.write(np.ascontiguousarray(v, dtype=np.float16).tobytes())
+                self.index[example_ids[k]] = (self.n_rows, len(v), digests[k])
+                self.n_rows += len(v)
+        # Replace the index atomically so that it never points past written rows.
+        tmp_path = self.index_path + '.tmp.npy'
+        np.save(tmp_path, self.index)
+        os.replace(tmp_path, self.index_path)
+
+
+class EncoderCache(object):
+    """Looks up and stores per-example sentence vectors of a frozen encoder.
+
+    Args:
+        cache_dir (str): root directory of the cache
+        encoder (`nn.Module`): the frozen encoder, hashed on first use
+    """
+
+    def __init__(self, cache_dir, encoder):
+        self.cache_dir = cache_dir
+        self.encoder = encoder
+        self.key = None
+        self.shards = {}
+
+    def _shard(self, shard, hidden_size):
+        if self.key is None:
+            self.key = weights_hash(self.encoder)
+        if shard not in self.shards:
+            path = os.path.abspath(shard)
+            name = '%s.%s' % (os.path.basename(path), hashlib.sha1(path.encode('utf-8')).hexdigest()[:12])
+            self.shards[shard] = _ShardCache(os.path.join(self.cache_dir, self.key, name), hidden_size)
+        return self.shards[shard]
+
+    def sents_vec(self, encode, cache_keys, src, segs, clss, mask_src, mask_cls, hidden_size):
+        """Sentence vectors of a batch, read from the cache or computed with `encode`.
+
+        `cache_keys` is the (shard, example ids, unpadded source lengths)
+        triple of the batch. Computed
+        vectors are stored and returned rounded to float16, so a batch scores
+        the same whether or not it was cached.
+        """
+        shard, example_ids, src_len = cache_keys
+        cache = self._shard(shard, hidden_size)
+        src_len = [int(n) for n in src_len]
+        cls_len = mask_cls.sum(1).tolist()
+        src_, segs_, clss_ = src.cpu().numpy(), segs.cpu().numpy(), clss.cpu().numpy()
+        digests = np.array([_digest(src_[i, :src_len[i]], segs_[i, :src_len[i]], clss_[i, :cls_len[i]])
+                            for i in range(len(example_ids))], dtype=np.int64)
+
+        rows = cache.get(example_ids, digests)
+        if rows is None:
+            sents_vec = encode(src, segs, clss, mask_src, mask_cls).half()
+            rows = [sents_vec[i, :cls_len[i]].cpu().numpy() for i in range(len(example_ids))]
+            cache.put(example_ids, digests, rows)
+            return sents_vec.float()
+
+        sents_vec = np.zeros((len(rows), clss.size(1), hidden_size), dtype=np.float16)
+        for i, r in enumerate(rows):
+            sents_vec[i, :len(r)] = r
+        return torch.from_numpy(sents_vec).to(src.device).float()
@@ -9,6 +9,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from models.precision import autocast
 from models.reporter import Statistics
 
 
@@ -45,6 +46,10 @@ class LossComputeBase(nn.Module):
         super(LossComputeBase, self).__init__()
         self.generator = generator
         self.padding_idx = pad_id
+        # Set by the trainer: `-precision` of the generator forward, and the
+        # fp16 loss scale backward starts from.
+        self.precision = 'fp32'
+        self.loss_scale = 1.
 
 
 
@@ -90,7 +95,8 @@ class LossComputeBase(nn.Module):
             :obj:`onmt.utils.Statistics`: loss statistics
         """
         shard_state = self._make_shard_state(batch, output)
-        _, batch_stats = self._compute_loss(batch, **shard_state)
+        with autocast(self.precision, output.device):
+            _, batch_stats = self._compute_loss(batch, **shard_state)
 
         return batch_stats
 
@@ -127,7 +133,10 @@ class LossComputeBase(nn.Module):
         batch_stats = Statistics()
         shard_state = self._make_shard_state(batch, output)
         for shard in shards(shard_state, shard_size):
-            loss, stats = self._compute_loss(batch, **shard)
+            with autocast(self.precision, output.device):
+                loss, stats = self._compute_loss(batch, **shard)
+            if (self.loss_scale != 1.):
+                loss = loss * self.loss_scale
             loss.div(float(normalization)).backward()
             batch_stats.update(stats)
 
@@ -214,7 +223,8 @@ class NMTLossCompute(LossComputeBase):
 
     def _compute_loss(self, batch, output, target):
         bottled_output = self._bottle(output)
-        scores = self.generator(bottled_output)
+        # The log-softmax runs on fp32 logits whatever the `-precision`.
+        scores = self.generator[1](self.generator[0](bottled_output).float())
         gtruth =target.contiguous().view(-1)
 
         loss = self.criterion(scores, gtruth)
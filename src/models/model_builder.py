@@ -7,6 +7,7 @@ from torch.nn.init import xavier_uniform_
 
 from models.decoder import TransformerDecoder
 from models.encoder import Classifier, ExtTransformerEncoder
+from models.encoder_cache import EncoderCache
 from models.optimizers import Optimizer
 from transformers.adapters.composition import Fuse
 
@@ -255,10 +256,26 @@ class ExtSummarizer(nn.Module):
 
         self.to(device)
 
-    def forward(self, src, segs, clss, mask_src, mask_cls):
+        # Only a frozen encoder gives the same vectors for every checkpoint.
+        self.encoder_cache = None
+        if (args.encoder_cache and not args.finetune_bert):
+            self.encoder_cache = EncoderCache(args.encoder_cache, self.RoBerta)
+
+    def _sents_vec(self, src, segs, clss, mask_src, mask_cls):
         top_vec = self.RoBerta(src, segs, mask_src)
         sents_vec = top_vec[torch.arange(top_vec.size(0)).unsqueeze(1), clss]
         sents_vec = sents_vec * mask_cls[:, :, None].float()
+        return sents_vec
+
+    def forward(self, src, segs, clss, mask_src, mask_cls, cache_keys=None, logits=False):
+        """ Sentence scores, or their logits if `logits`, and the sentence mask. """
+        if (self.encoder_cache is not None and cache_keys is not None and cache_keys[0] is not None):
+            sents_vec = self.encoder_cache.sents_vec(self._sents_vec, cache_keys, src, segs, clss, mask_src,
+                                                     mask_cls, self.RoBerta.model.config.hidden_size)
+        else:
+            sents_vec = self._sents_vec(src, segs, clss, mask_src, mask_cls)
+        if (logits):
+            return self.ext_layer.logits(sents_vec, mask_cls), mask_cls
         sent_scores = self.ext_layer(sents_vec, mask_cls).squeeze(-1)
         return sent_scores, mask_cls
 
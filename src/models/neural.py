@@ -411,7 +411,8 @@ class MultiHeadedAttention(nn.Module):
 
         if mask is not None:
             mask = mask.unsqueeze(1).expand_as(scores)
-            scores = scores.masked_fill(mask, -1e18)
+            # -1e18 overflows fp16 scores under `-precision fp16`.
+            scores = scores.masked_fill(mask, -1e18 if scores.dtype != torch.float16 else torch.finfo(scores.dtype).min)
 
         # 3) Apply attention dropout and compute context vectors.
 
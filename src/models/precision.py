@@ -0,0 +1,70 @@
+"""
+Mixed-precision support for `-precision {fp32,bf16,fp16}`.
+
+Parameters, optimizer state and checkpoints stay fp32 in every mode; only
+the forward passes run under `torch.autocast`, in bfloat16 or float16. fp16
+gradients can underflow, so `fp16` training scales the loss with a
+`DynamicLossScaler`. bf16 has the exponent range of fp32 and needs no
+scaling; it is also the mode CPU autocast supports best.
+"""
+
+import contextlib
+
+import torch
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(precision, device):
+    """ Context running the forward pass of a model in `precision` on `device`. """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=_DTYPES[precision])
+
+
+class DynamicLossScaler(object):
+    """
+    Loss scaling for fp16 training.
+
+    The loss is multiplied by `scale` before backward, and the gradients
+    are divided by it before the optimizer step. A step whose gradients
+    overflowed is skipped and the scale is halved. After `growth_interval`
+    steps without overflow the scale is doubled again. The trainers save
+    its `state_dict` in their checkpoints and restore it on `-train_from`.
+    """
+
+    def __init__(self, init_scale=2. ** 16, growth_interval=2000, min_scale=1.):
+        self.scale = init_scale
+        self.growth_interval = growth_interval
+        self.min_scale = min_scale
+        self._good_steps = 0
+
+    def unscale_(self, params):
+        """
+        Divide the gradients of `params` by the scale and update the scale.
+        Returns False if they overflowed and the step should be skipped.
+        """
+        grads = [p.grad for p in params if p.grad is not None]
+        finite = True
+        if grads:
+            norms = torch.stack([g.detach().float().abs().max() for g in grads])
+            finite = bool(torch.isfinite(norms).all())
+        if finite:
+            for g in grads:
+                g.div_(self.scale)
+            self._good_steps += 1
+            if self._good_steps % self.growth_interval == 0:
+                self.scale *= 2.
+        else:
+            self.scale = max(self.scale / 2., self.min_scale)
+            self._good_steps = 0
+        return finite
+
+    def state_dict(self):
+        return {'scale': self.scale, 'good_steps': self._good_steps}
+
+    def load_state_dict(self, state):
+        self.scale = state['scale']
+        self._good_steps = state['good_steps']
@@ -9,8 +9,10 @@ import torch
 
 from tensorboardX import SummaryWriter
 
+from models.precision import autocast
 from others.utils import rouge_results_to_str, test_rouge, tile
 from translate.beam import GNMTGlobalScorer
+from translate.trigram_block import TrigramBlocker
 
 
 def build_predictor(args, tokenizer, symbols, model, logger=None):
@@ -65,6 +67,7 @@ class Translator(object):
         self.max_length = args.max_length
 
         self.dump_beam = dump_beam
+        self.trigram_blocker = None
 
         # for debugging
         self.beam_trace = self.dump_beam != ""
@@ -194,7 +197,7 @@ class Translator(object):
 
     def _report_rouge(self, gold_path, can_path):
         self.logger.info("Calculating Rouge")
-        results_dict = test_rouge(self.args.temp_dir, can_path, gold_path)
+        results_dict = test_rouge(self.args.temp_dir, can_path, gold_path, engine=self.args.rouge_engine)
         return results_dict
 
     def translate_batch(self, batch, fast=False):
@@ -211,12 +214,17 @@ class Translator(object):
         Todo:
            Shouldn't need the original dataset.
         """
-        with torch.no_grad():
+        with torch.no_grad(), autocast(getattr(self.args, 'precision', 'fp32'), batch.src.device):
             return self._fast_translate_batch(
                 batch,
                 self.max_length,
                 min_length=self.min_length)
 
+    def _get_trigram_blocker(self, device):
+        if (self.trigram_blocker is None or self.trigram_blocker.piece_hash.device != device):
+            self.trigram_blocker = TrigramBlocker(self.vocab.ids_to_tokens, device)
+        return self.trigram_blocker
+
     def _fast_translate_batch(self,
                               batch,
                               max_length,
@@ -254,6 +262,10 @@ class Translator(object):
             dtype=torch.long,
             device=device)
 
+        if(self.args.block_trigram):
+            blocker = self._get_trigram_blocker(device)
+            trigram_state = blocker.init_state(alive_seq[:, 0])
+
         # Give full probability to the first beam on the first step.
         topk_log_probs = (
             torch.tensor([0.0] + [float("-inf")] * (beam_size - 1),
@@ -278,7 +290,8 @@ class Translator(object):
                                                      step=step)
 
             # Generator forward.
-            log_probs = self.generator.forward(dec_out.transpose(0,1).squeeze(0))
+            # The log-softmax and the beam scores stay fp32 whatever the `-precision`.
+            log_probs = self.generator[1](self.generator[0](dec_out.transpose(0,1).squeeze(0)).float())
             vocab_size = log_probs.size(-1)
 
             if step < min_length:
@@ -294,21 +307,7 @@ class Translator(object):
             curr_scores = log_probs / length_penalty
 
             if(self.args.block_trigram):
-                cur_len = alive_seq.size(1)
-                if(cur_len>3):
-                    for i in range(alive_seq.size(0)):
-                        fail = False
-                        words = [int(w) for w in alive_seq[i]]
-                        words = [self.vocab.ids_to_tokens[w] for w in words]
-                        words = ' '.join(words).replace(' ##','').split()
-                        if(len(words)<=3):
-                            continue
-                        trigrams = [(words[i-1],words[i],words[i+1]) for i in range(1,len(words)-1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -10e20
+                curr_scores.masked_fill_(blocker.blocked(trigram_state).unsqueeze(1), -10e20)
 
             curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
             topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
@@ -330,6 +329,9 @@ class Translator(object):
             alive_seq = torch.cat(
                 [alive_seq.index_select(0, select_indices),
                  topk_ids.view(-1, 1)], -1)
+            if(self.args.block_trigram):
+                trigram_state = blocker.advance(blocker.index_select(trigram_state, select_indices),
+                                                topk_ids.view(-1))
 
             is_finished = topk_ids.eq(self.end_token)
             if step + 1 == max_length:
@@ -367,6 +369,9 @@ class Translator(object):
                 batch_offset = batch_offset.index_select(0, non_finished)
                 alive_seq = predictions.index_select(0, non_finished) \
                     .view(-1, alive_seq.size(-1))
+                if(self.args.block_trigram):
+                    rows = non_finished.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)
+                    trigram_state = blocker.index_select(trigram_state, rows.view(-1))
             # Reorder states.
             select_indices = batch_index.view(-1)
             src_features = src_features.index_select(0, select_indices)
@@ -6,7 +6,7 @@ import time
 import math
 import sys
 
-from distributed import all_gather_list
+from distributed import all_reduce_values
 from others.logging import logger
 
 
@@ -67,10 +67,9 @@ class ReportMgrBase(object):
             raise ValueError("""ReportMgr needs to be started
                                 (set 'start_time' or use 'start()'""")
 
-        if multigpu:
-            report_stats = Statistics.all_gather_stats(report_stats)
-
         if step % self.report_every == 0:
+            if multigpu:
+                report_stats = Statistics.all_gather_stats(report_stats)
             self._report_training(
                 step, num_steps, learning_rate, report_stats)
             self.progress_step += 1
@@ -165,6 +164,9 @@ class Statistics(object):
     * elapsed time
     """
 
+    # Fields summed accross processes by `all_gather_stats_list`.
+    reduced_fields = ['loss', 'n_words', 'n_correct', 'n_docs', 'n_src_words']
+
     def __init__(self, loss=0, n_words=0, n_correct=0):
         self.loss = loss
         self.n_words = n_words
@@ -176,12 +178,12 @@ class Statistics(object):
     @staticmethod
     def all_gather_stats(stat, max_size=4096):
         """
-        Gather a `Statistics` object accross multiple process/nodes
+        Sum a `Statistics` object accross multiple process/nodes
 
         Args:
             stat(:obj:Statistics): the statistics object to gather
                 accross all processes/nodes
-            max_size(int): max buffer size to use
+            max_size(int): unused, kept for compatibility
 
         Returns:
             `Statistics`, the update stats object
@@ -191,30 +193,26 @@ class Statistics(object):
 
     @staticmethod
     def all_gather_stats_list(stat_list, max_size=4096):
-        from torch.distributed import get_rank
-
         """
-        Gather a `Statistics` list accross all processes/nodes
+        Sum a `Statistics` list accross all processes/nodes, in place
+
+        The counters of all the statistics are packed into one tensor and
+        all-reduced at once.
 
         Args:
             stat_list(list([`Statistics`])): list of statistics objects to
                 gather accross all processes/nodes
-            max_size(int): max buffer size to use
+            max_size(int): unused, kept for compatibility
 
         Returns:
             our_stats(list([`Statistics`])): list of updated stats
         """
-        # Get a list of world_size lists with len(stat_list) Statistics objects
-        all_stats = all_gather_list(stat_list, max_size=max_size)
-
-        our_rank = get_rank()
-        our_stats = all_stats[our_rank]
-        for other_rank, stats in enumerate(all_stats):
-            if other_rank == our_rank:
-                continue
-            for i, stat in enumerate(stats):
-                our_stats[i].update(stat, update_n_src_words=True)
-        return our_stats
+        fields = Statistics.reduced_fields
+        values = all_reduce_values([float(getattr(stat, f)) for stat in stat_list for f in fields])
+        for i, stat in enumerate(stat_list):
+            for f, v in zip(fields, values[i * len(fields):(i + 1) * len(fields)]):
+                setattr(stat, f, int(round(v)) if f.startswith('n_') else v)
+        return stat_list
 
     def update(self, stat, update_n_src_words=False):
         """
@@ -5,6 +5,8 @@ import sys
 import time
 from datetime import datetime
 
+import torch
+
 from others.logging import logger
 
 
@@ -70,6 +72,7 @@ class ReportMgrBase(object):
                                 (set 'start_time' or use 'start()'""")
 
         if step % self.report_every == 0:
+            report_stats.materialize()
             if multigpu:
                 report_stats = \
                     Statistics.all_gather_stats(report_stats)
@@ -167,20 +170,36 @@ class Statistics(object):
     * elapsed time
     """
 
+    # Fields summed accross processes by `all_gather_stats_list`.
+    reduced_fields = ['loss', 'n_docs']
+
     def __init__(self, loss=0, n_docs=0, n_correct=0):
+        """
+        `loss` may be a 0-dim tensor on the training device. It is then
+        summed there, without waiting for the device, until `materialize`
+        copies it to the host once the statistics are read.
+        """
+        if torch.is_tensor(loss):
+            loss = loss.detach()
         self.loss = loss
         self.n_docs = n_docs
         self.start_time = time.time()
 
+    def materialize(self):
+        """ Copy a device-resident loss to the host. """
+        if torch.is_tensor(self.loss):
+            self.loss = self.loss.item()
+        return self
+
     @staticmethod
     def all_gather_stats(stat, max_size=4096):
         """
-        Gather a `Statistics` object accross multiple process/nodes
+        Sum a `Statistics` object accross multiple process/nodes
 
         Args:
             stat(:obj:Statistics): the statistics object to gather
                 accross all processes/nodes
-            max_size(int): max buffer size to use
+            max_size(int): unused, kept for compatibility
 
         Returns:
             `Statistics`, the update stats object
@@ -191,30 +210,27 @@ class Statistics(object):
     @staticmethod
     def all_gather_stats_list(stat_list, max_size=4096):
         """
-        Gather a `Statistics` list accross all processes/nodes
+        Sum a `Statistics` list accross all processes/nodes, in place
+
+        The counters of all the statistics are packed into one tensor and
+        all-reduced at once.
 
         Args:
             stat_list(list([`Statistics`])): list of statistics objects to
                 gather accross all processes/nodes
-            max_size(int): max buffer size to use
+            max_size(int): unused, kept for compatibility
 
         Returns:
             our_stats(list([`Statistics`])): list of updated stats
         """
-        from torch.distributed import get_rank
-        from distributed import all_gather_list
-
-        # Get a list of world_size lists with len(stat_list) Statistics objects
-        all_stats = all_gather_list(stat_list, max_size=max_size)
+        from distributed import all_reduce_values
 
-        our_rank = get_rank()
-        our_stats = all_stats[our_rank]
-        for other_rank, stats in enumerate(all_stats):
-            if other_rank == our_rank:
-                continue
-            for i, stat in enumerate(stats):
-                our_stats[i].update(stat, update_n_src_words=True)
-        return our_stats
+        fields = Statistics.reduced_fields
+        values = all_reduce_values([float(getattr(stat, f)) for stat in stat_list for f in fields])
+        for i, stat in enumerate(stat_list):
+            for f, v in zip(fields, values[i * len(fields):(i + 1) * len(fields)]):
+                setattr(stat, f, int(round(v)) if f.startswith('n_') else v)
+        return stat_list
 
     def update(self, stat, update_n_src_words=False):
         """
@@ -226,12 +242,14 @@ class Statistics(object):
                 or not
 
         """
-        self.loss += stat.loss
+        # Not in place: a tensor loss may be shared with `stat`.
+        self.loss = self.loss + stat.loss
 
         self.n_docs += stat.n_docs
 
     def xent(self):
         """ compute cross entropy """
+        self.materialize()
         if (self.n_docs == 0):
             return 0
         return self.loss / self.n_docs
@@ -5,6 +5,7 @@ import torch
 from tensorboardX import SummaryWriter
 
 import distributed
+from models.precision import autocast, DynamicLossScaler
 from models.reporter import ReportMgr, Statistics
 from others.logging import logger
 from others.utils import test_rouge, rouge_results_to_str
@@ -98,8 +99,19 @@ class Trainer(object):
         self.report_manager = report_manager
 
         self.loss = loss
+        self.precision = getattr(args, 'precision', 'fp32')
+        self.scaler = DynamicLossScaler() if self.precision == 'fp16' else None
+        if (loss is not None):
+            self.loss.precision = self.precision
 
         assert grad_accum_count > 0
+        # Gradients are all-reduced during the backward pass of the last
+        # batch of a step. The generator gets a backward pass per loss shard,
+        # so its gradients are only reduced after the last one.
+        self.grad_sync = None
+        if (model and n_gpu > 1):
+            self.grad_sync = distributed.GradientSynchronizer(
+                model.parameters(), deferred=list(model.generator.parameters()))
         # Set model in training mode.
         if (model):
             self.model.train()
@@ -114,6 +126,8 @@ class Trainer(object):
             train_iter_fct(function): a function that returns the train
                 iterator. e.g. something like
                 train_iter_fct = lambda: generator(*args, **kwargs)
+                With several GPUs it only yields the batches of this rank,
+                see `data_loader.load_dataset`.
             valid_iter_fct(function): same as train_iter_fct, for valid data
             train_steps(int):
             valid_steps(int):
@@ -139,38 +153,35 @@ class Trainer(object):
         while step <= train_steps:
 
             reduce_counter = 0
-            for i, batch in enumerate(train_iter):
-                if self.n_gpu == 0 or (i % self.n_gpu == self.gpu_rank):
-
-                    true_batchs.append(batch)
-                    num_tokens = batch.tgt[:, 1:].ne(self.loss.padding_idx).sum()
-                    normalization += num_tokens.item()
-                    accum += 1
-                    if accum == self.grad_accum_count:
-                        reduce_counter += 1
-                        if self.n_gpu > 1:
-                            normalization = sum(distributed
-                                                .all_gather_list
-                                                (normalization))
-
-                        self._gradient_accumulation(
-                            true_batchs, normalization, total_stats,
-                            report_stats)
-
-                        report_stats = self._maybe_report_training(
-                            step, train_steps,
-                            self.optims[0].learning_rate,
-                            report_stats)
-
-                        true_batchs = []
-                        accum = 0
-                        normalization = 0
-                        if (step % self.save_checkpoint_steps == 0 and self.gpu_rank == 0):
-                            self._save(step)
-
-                        step += 1
-                        if step > train_steps:
-                            break
+            for batch in train_iter:
+                true_batchs.append(batch)
+                num_tokens = batch.tgt[:, 1:].ne(self.loss.padding_idx).sum()
+                normalization += num_tokens.item()
+                accum += 1
+                if accum == self.grad_accum_count:
+                    reduce_counter += 1
+                    if self.n_gpu > 1:
+                        # The loss is normalized by the tokens of all ranks.
+                        normalization = int(distributed.all_reduce_values([normalization])[0])
+
+                    self._gradient_accumulation(
+                        true_batchs, normalization, total_stats,
+                        report_stats)
+
+                    report_stats = self._maybe_report_training(
+                        step, train_steps,
+                        self.optims[0].learning_rate,
+                        report_stats)
+
+                    true_batchs = []
+                    accum = 0
+                    normalization = 0
+                    if (step % self.save_checkpoint_steps == 0 and self.gpu_rank == 0):
+                        self._save(step)
+
+                    step += 1
+                    if step > train_steps:
+                        break
             train_iter = train_iter_fct()
 
         return total_stats
@@ -195,7 +206,8 @@ class Trainer(object):
                 mask_tgt = batch.mask_tgt
                 mask_cls = batch.mask_cls
 
-                outputs, _ = self.model(src, tgt, segs, clss, mask_src, mask_tgt, mask_cls)
+                with autocast(self.precision, src.device):
+                    outputs, _ = self.model(src, tgt, segs, clss, mask_src, mask_tgt, mask_cls)
 
                 batch_stats = self.loss.monolithic_compute_loss(batch, outputs)
                 stats.update(batch_stats)
@@ -211,6 +223,8 @@ class Trainer(object):
         for batch in true_batchs:
             if self.grad_accum_count == 1:
                 self.model.zero_grad()
+            if self.grad_sync is not None and (self.grad_accum_count == 1 or batch is true_batchs[-1]):
+                self.grad_sync.arm()
 
             src = batch.src
             tgt = batch.tgt
@@ -220,7 +234,10 @@ class Trainer(object):
             mask_tgt = batch.mask_tgt
             mask_cls = batch.mask_cls
 
-            outputs, scores = self.model(src, tgt,segs, clss, mask_src, mask_tgt, mask_cls)
+            with autocast(self.precision, src.device):
+                outputs, scores = self.model(src, tgt,segs, clss, mask_src, mask_tgt, mask_cls)
+            if (self.scaler is not None):
+                self.loss.loss_scale = self.scaler.scale
             batch_stats = self.loss.sharded_compute_loss(batch, outputs, self.args.generator_shard_size, normalization)
 
             batch_stats.n_docs = int(src.size(0))
@@ -232,24 +249,20 @@ class Trainer(object):
             if self.grad_accum_count == 1:
                 # Multi GPU gradient gather
                 if self.n_gpu > 1:
-                    grads = [p.grad.data for p in self.model.parameters()
-                             if p.requires_grad
-                             and p.grad is not None]
-                    distributed.all_reduce_and_rescale_tensors(
-                        grads, float(1))
+                    self.grad_sync.finish(float(1))
 
-                for o in self.optims:
-                    o.step()
+                self._optim_step()
 
         # in case of multi step gradient accumulation,
         # update only after accum batches
         if self.grad_accum_count > 1:
             if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                distributed.all_reduce_and_rescale_tensors(
-                    grads, float(1))
+                self.grad_sync.finish(float(1))
+            self._optim_step()
+
+    def _optim_step(self):
+        # A step whose scaled fp16 gradients overflowed is skipped.
+        if self.scaler is None or self.scaler.unscale_(self.model.parameters()):
             for o in self.optims:
                 o.step()
 
@@ -316,7 +329,7 @@ class Trainer(object):
                         for i in range(len(pred)):
                             save_pred.write(pred[i].strip()+'\n')
         if(step!=-1 and self.args.report_rouge):
-            rouges = test_rouge(self.args.temp_dir, can_path, gold_path)
+            rouges = test_rouge(self.args.temp_dir, can_path, gold_path, engine=self.args.rouge_engine)
             logger.info('Rouges at step %d \n%s' % (step, rouge_results_to_str(rouges)))
         self._report_step(0, step, valid_stats=stats)
 
@@ -336,6 +349,8 @@ class Trainer(object):
             'opt': self.args,
             'optims': self.optims,
         }
+        if (self.scaler is not None):
+            checkpoint['scaler'] = self.scaler.state_dict()
         checkpoint_path = os.path.join(self.args.model_path, 'model_step_%d.pt' % step)
         logger.info("Saving checkpoint %s" % checkpoint_path)
         # checkpoint_path = '%s_step_%d.pt' % (FLAGS.model_path, step)
@@ -1,15 +1,21 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 
 import distributed
+from models.precision import autocast, DynamicLossScaler
 from models.reporter_ext import ReportMgr, Statistics
 from others.logging import logger
 from others.utils import test_rouge, rouge_results_to_str
 
 
+def _get_trigrams(tokens):
+    return set(zip(tokens, tokens[1:], tokens[2:]))
+
+
 def _tally_parameters(model):
     n_params = sum([p.nelement() for p in model.parameters()])
     return n_params
@@ -94,8 +100,21 @@ class Trainer(object):
         self.gpu_rank = gpu_rank
         self.report_manager = report_manager
 
-        self.loss = torch.nn.BCELoss(reduction='none')
+        # Under mixed precision the model returns logits, as the sigmoid
+        # output is not safe to take the log of in half precision.
+        self.precision = getattr(args, 'precision', 'fp32')
+        self.mixed_precision = self.precision != 'fp32'
+        if (self.mixed_precision):
+            self.loss = torch.nn.BCEWithLogitsLoss(reduction='none')
+        else:
+            self.loss = torch.nn.BCELoss(reduction='none')
+        self.scaler = DynamicLossScaler() if self.precision == 'fp16' else None
         assert grad_accum_count > 0
+        # Gradients are all-reduced during the backward pass of the last
+        # batch of a step.
+        self.grad_sync = None
+        if (model and n_gpu > 1):
+            self.grad_sync = distributed.GradientSynchronizer(model.parameters())
         # Set model in training mode.
         if (model):
             self.model.train()
@@ -110,6 +129,8 @@ class Trainer(object):
             train_iter_fct(function): a function that returns the train
                 iterator. e.g. something like
                 train_iter_fct = lambda: generator(*args, **kwargs)
+                With several GPUs it only yields the batches of this rank,
+                see `data_loader.load_dataset`.
             valid_iter_fct(function): same as train_iter_fct, for valid data
             train_steps(int):
             valid_steps(int):
@@ -134,37 +155,32 @@ class Trainer(object):
         while step <= train_steps:
 
             reduce_counter = 0
-            for i, batch in enumerate(train_iter):
-                if self.n_gpu == 0 or (i % self.n_gpu == self.gpu_rank):
-
-                    true_batchs.append(batch)
-                    normalization += batch.batch_size
-                    accum += 1
-                    if accum == self.grad_accum_count:
-                        reduce_counter += 1
-                        if self.n_gpu > 1:
-                            normalization = sum(distributed
-                                                .all_gather_list
-                                                (normalization))
-
-                        self._gradient_accumulation(
-                            true_batchs, normalization, total_stats,
-                            report_stats)
-
-                        report_stats = self._maybe_report_training(
-                            step, train_steps,
-                            self.optim.learning_rate,
-                            report_stats)
-
-                        true_batchs = []
-                        accum = 0
-                        normalization = 0
-                        if (step % self.save_checkpoint_steps == 0 and self.gpu_rank == 0):
-                            self._save(step)
-
-                        step += 1
-                        if step > train_steps:
-                            break
+            for batch in train_iter:
+                true_batchs.append(batch)
+                normalization += batch.batch_size
+                accum += 1
+                if accum == self.grad_accum_count:
+                    reduce_counter += 1
+                    # `normalization` only counts documents for the statistics,
+                    # which are summed accross ranks when they are reported.
+                    self._gradient_accumulation(
+                        true_batchs, normalization, total_stats,
+                        report_stats)
+
+                    report_stats = self._maybe_report_training(
+                        step, train_steps,
+                        self.optim.learning_rate,
+                        report_stats)
+
+                    true_batchs = []
+                    accum = 0
+                    normalization = 0
+                    if (step % self.save_checkpoint_steps == 0 and self.gpu_rank == 0):
+                        self._save(step)
+
+                    step += 1
+                    if step > train_steps:
+                        break
             train_iter = train_iter_fct()
 
         return total_stats
@@ -188,11 +204,11 @@ class Trainer(object):
                 mask = batch.mask_src
                 mask_cls = batch.mask_cls
 
-                sent_scores, mask = self.model(src, segs, clss, mask, mask_cls)
+                sent_scores, mask = self._forward(src, segs, clss, mask, mask_cls, (batch.shard, batch.example_ids, batch.src_lengths))
 
                 loss = self.loss(sent_scores, labels.float())
                 loss = (loss * mask.float()).sum()
-                batch_stats = Statistics(float(loss.cpu().data.numpy()), len(labels))
+                batch_stats = Statistics(loss, len(labels))
                 stats.update(batch_stats)
             self._report_step(0, step, valid_stats=stats)
             return stats
@@ -205,29 +221,24 @@ class Trainer(object):
         """
 
         # Set model in validating mode.
-        def _get_ngrams(n, text):
-            ngram_set = set()
-            text_length = len(text)
-            max_index_ngram_start = text_length - n
-            for i in range(max_index_ngram_start + 1):
-                ngram_set.add(tuple(text[i:i + n]))
-            return ngram_set
-
-        def _block_tri(c, p):
-            tri_c = _get_ngrams(3, c.split())
-            for s in p:
-                tri_s = _get_ngrams(3, s.split())
-                if len(tri_c.intersection(tri_s)) > 0:
-                    return True
-            return False
-
         if (not cal_lead and not cal_oracle):
             self.model.eval()
         stats = Statistics()
 
         can_path = '%s_step%d.candidate' % (self.args.result_path, step)
         gold_path = '%s_step%d.gold' % (self.args.result_path, step)
-        with open(can_path, 'w') as save_pred:
+
+        def _write(selection):
+            pred, gold = selection.result()
+            for i in range(len(gold)):
+                save_gold.write(gold[i].strip() + '\n')
+            for i in range(len(pred)):
+                save_pred.write(pred[i].strip() + '\n')
+
+        # Sentence selection of a batch runs on `selector` while the model
+        # scores the next one; results are written back in batch order.
+        pending = None
+        with ThreadPoolExecutor(max_workers=1) as selector, open(can_path, 'w') as save_pred:
             with open(gold_path, 'w') as save_gold:
                 with torch.no_grad():
                     for batch in test_iter:
@@ -238,16 +249,14 @@ class Trainer(object):
                         mask = batch.mask_src
                         mask_cls = batch.mask_cls
 
-                        gold = []
-                        pred = []
-
                         if (cal_lead):
                             selected_ids = [list(range(batch.clss.size(1)))] * batch.batch_size
                         elif (cal_oracle):
                             selected_ids = [[j for j in range(batch.clss.size(1)) if labels[i][j] == 1] for i in
                                             range(batch.batch_size)]
                         else:
-                            sent_scores, mask = self.model(src, segs, clss, mask, mask_cls)
+                            sent_scores, mask = self._forward(src, segs, clss, mask, mask_cls,
+                                                              (batch.shard, batch.example_ids, batch.src_lengths))
 
                             if len(list(sent_scores.shape)) == 1:
                                 sent_scores = sent_scores.unsqueeze(1)
@@ -255,48 +264,66 @@ class Trainer(object):
                             assert sent_scores.shape==labels.float().shape,(labels,src)
                             loss = self.loss(sent_scores, labels.float())
                             loss = (loss * mask.float()).sum()
-                            batch_stats = Statistics(float(loss.cpu().data.numpy()), len(labels))
+                            batch_stats = Statistics(loss, len(labels))
                             stats.update(batch_stats)
 
+                            if (self.mixed_precision):
+                                sent_scores = torch.sigmoid(sent_scores) * mask.float()
                             sent_scores = sent_scores + mask.float()
                             sent_scores = sent_scores.cpu().data.numpy()
                             selected_ids = np.argsort(-sent_scores, 1)
                         # selected_ids = np.sort(selected_ids,1)
-                        for i, idx in enumerate(selected_ids):
-                            _pred = []
-                            if (len(batch.src_str[i]) == 0):
-                                continue
-                            for j in selected_ids[i][:len(batch.src_str[i])]:
-                                if (j >= len(batch.src_str[i])):
-                                    continue
-                                candidate = batch.src_str[i][j].strip()
-                                if (self.args.block_trigram):
-                                    if (not _block_tri(candidate, _pred)):
-                                        _pred.append(candidate)
-                                else:
-                                    _pred.append(candidate)
-
-                                if ((not cal_oracle) and (not self.args.recall_eval) and len(_pred) == 6):
-                                    break
-
-                            _pred = '<q>'.join(_pred)
-                            if (self.args.recall_eval):
-                                _pred = ' '.join(_pred.split()[:len(batch.tgt_str[i].split())])
-
-                            pred.append(_pred)
-                            gold.append(batch.tgt_str[i])
-
-                        for i in range(len(gold)):
-                            save_gold.write(gold[i].strip() + '\n')
-                        for i in range(len(pred)):
-                            save_pred.write(pred[i].strip() + '\n')
+                        if (pending is not None):
+                            _write(pending)
+                        pending = selector.submit(self._select, batch.src_str, batch.tgt_str, selected_ids,
+                                                  cal_oracle)
+                if (pending is not None):
+                    _write(pending)
         if (step != -1 and self.args.report_rouge):
-            rouges = test_rouge(self.args.temp_dir, can_path, gold_path)
+            rouges = test_rouge(self.args.temp_dir, can_path, gold_path, engine=self.args.rouge_engine)
             logger.info('Rouges at step %d \n%s' % (step, rouge_results_to_str(rouges)))
         self._report_step(0, step, valid_stats=stats)
 
         return stats
 
+    def _select(self, src_str, tgt_str, selected_ids, cal_oracle=False):
+        """ Pick the summary sentences of one test batch from its ranked sentence ids.
+            With `block_trigram`, a sentence is dropped if it shares a trigram with
+            the sentences already picked for its document.
+        Returns:
+            (pred, gold) lists of `<q>`-joined predictions and gold summaries
+        """
+        gold = []
+        pred = []
+        for i, idx in enumerate(selected_ids):
+            _pred = []
+            if (len(src_str[i]) == 0):
+                continue
+            sents = [s.strip() for s in src_str[i]]
+            if (self.args.block_trigram):
+                trigrams = [_get_trigrams(s.split()) for s in sents]
+                selected_trigrams = set()
+            for j in selected_ids[i][:len(sents)]:
+                if (j >= len(sents)):
+                    continue
+                if (self.args.block_trigram):
+                    if (trigrams[j].isdisjoint(selected_trigrams)):
+                        _pred.append(sents[j])
+                        selected_trigrams |= trigrams[j]
+                else:
+                    _pred.append(sents[j])
+
+                if ((not cal_oracle) and (not self.args.recall_eval) and len(_pred) == 6):
+                    break
+
+            _pred = '<q>'.join(_pred)
+            if (self.args.recall_eval):
+                _pred = ' '.join(_pred.split()[:len(tgt_str[i].split())])
+
+            pred.append(_pred)
+            gold.append(tgt_str[i])
+        return pred, gold
+
     def _gradient_accumulation(self, true_batchs, normalization, total_stats,
                                report_stats):
         if self.grad_accum_count > 1:
@@ -305,6 +332,8 @@ class Trainer(object):
         for batch in true_batchs:
             if self.grad_accum_count == 1:
                 self.model.zero_grad()
+            if self.grad_sync is not None and (self.grad_accum_count == 1 or batch is true_batchs[-1]):
+                self.grad_sync.arm()
 
             src = batch.src
             labels = batch.src_sent_labels
@@ -313,14 +342,17 @@ class Trainer(object):
             mask = batch.mask_src
             mask_cls = batch.mask_cls
 
-            sent_scores, mask= self.model(src, segs, clss, mask, mask_cls)
+            sent_scores, mask = self._forward(src, segs, clss, mask, mask_cls)
 
             loss = self.loss(sent_scores, labels.float())
             loss = (loss * mask.float()).sum()
-            (loss / loss.numel()).backward()
+            if (self.scaler is not None):
+                (loss * self.scaler.scale / loss.numel()).backward()
+            else:
+                (loss / loss.numel()).backward()
             # loss.div(float(normalization)).backward()
 
-            batch_stats = Statistics(float(loss.cpu().data.numpy()), normalization)
+            batch_stats = Statistics(loss, normalization)
 
             total_stats.update(batch_stats)
             report_stats.update(batch_stats)
@@ -329,22 +361,26 @@ class Trainer(object):
             if self.grad_accum_count == 1:
                 # Multi GPU gradient gather
                 if self.n_gpu > 1:
-                    grads = [p.grad.data for p in self.model.parameters()
-                             if p.requires_grad
-                             and p.grad is not None]
-                    distributed.all_reduce_and_rescale_tensors(
-                        grads, float(1))
-                self.optim.step()
+                    self.grad_sync.finish(float(1))
+                self._optim_step()
 
         # in case of multi step gradient accumulation,
         # update only after accum batches
         if self.grad_accum_count > 1:
             if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                distributed.all_reduce_and_rescale_tensors(
-                    grads, float(1))
+                self.grad_sync.finish(float(1))
+            self._optim_step()
+
+    def _forward(self, src, segs, clss, mask, mask_cls, cache_keys=None):
+        """ Run the model in `-precision`; scores, or their logits under mixed precision, come back in fp32. """
+        with autocast(self.precision, src.device):
+            sent_scores, mask = self.model(src, segs, clss, mask, mask_cls, cache_keys,
+                                           logits=self.mixed_precision)
+        return sent_scores.float(), mask
+
+    def _optim_step(self):
+        # A step whose scaled fp16 gradients overflowed is skipped.
+        if self.scaler is None or self.scaler.unscale_(self.model.parameters()):
             self.optim.step()
 
     def _save(self, step):
@@ -361,6 +397,8 @@ class Trainer(object):
             'opt': self.args,
             'optim': self.optim,
         }
+        if (self.scaler is not None):
+            checkpoint['scaler'] = self.scaler.state_dict()
         checkpoint_path = os.path.join(self.args.model_path, 'model_step_%d.pt' % step)
         logger.info("Saving checkpoint %s" % checkpoint_path)
         # checkpoint_path = '%s_step_%d.pt' % (FLAGS.model_path, step)
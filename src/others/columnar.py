@@ -0,0 +1,149 @@
+"""
+Columnar on-disk format for the `.bert` training shards.
+
+A shard is a directory holding one flat int32 array per id column plus an
+int64 offsets index, and a side file with the raw text of every example:
+
+    train.0.bert.col/
+        src.npy  src.offsets.npy
+        tgt.npy  tgt.offsets.npy
+        ...
+        text.bin  text.offsets.npy
+
+All arrays are opened with `np.load(mmap_mode='r')` and the text with
+`np.memmap`, so opening a shard does not read it and examples are only paged
+in when they are indexed.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+ID_COLUMNS = ['src', 'tgt', 'segs', 'clss', 'src_sent_labels']
+TEXT_COLUMNS = ['src_txt', 'tgt_txt']
+
+SUFFIX = '.col'
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class ColumnarWriter(object):
+    """Writes a columnar shard one example at a time.
+
+    Column values are appended to raw side files and only the per-example
+    lengths are kept in memory. `close` turns the side files into `.npy`
+    arrays and moves the finished shard from `path + '.tmp'` into place, so
+    an interrupted write never leaves a shard at `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.files = {name: open(self._file(name + '.raw'), 'wb') for name in ID_COLUMNS + ['text']}
+        self.lengths = {name: [] for name in ID_COLUMNS + ['text']}
+
+    def _file(self, name):
+        return os.path.join(self.tmp_path, name)
+
+    def __len__(self):
+        return len(self.lengths['text'])
+
+    def add(self, ex):
+        for name in ID_COLUMNS:
+            values = np.asarray(ex[name], dtype=np.int32)
+            self.files[name].write(values.tobytes())
+            self.lengths[name].append(len(values))
+        line = json.dumps([ex[name] for name in TEXT_COLUMNS]).encode('utf-8')
+        self.files['text'].write(line)
+        self.lengths['text'].append(len(line))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for name in ID_COLUMNS:
+            raw = self._file(name + '.raw')
+            with open(self._file(name + '.npy'), 'wb') as out:
+                np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.int32)),
+                                                          'fortran_order': False,
+                                                          'shape': (sum(self.lengths[name]),)})
+                with open(raw, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+            os.remove(raw)
+            np.save(self._file(name + '.offsets.npy'), _offsets(self.lengths[name]))
+        os.rename(self._file('text.raw'), self._file('text.bin'))
+        np.save(self._file('text.offsets.npy'), _offsets(self.lengths['text']))
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+def save_columnar(dataset, path):
+    """Write an iterable of `_format_to_bert` example dicts as a columnar shard."""
+    writer = ColumnarWriter(path)
+    for ex in dataset:
+        writer.add(ex)
+    writer.close()
+
+
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'src.offsets.npy'))
+
+
+class ColumnarShard(object):
+    """Read-only, memory-mapped view of a columnar shard.
+
+    Indexing returns the same example dict that `torch.load` of a `.bert.pt`
+    shard would contain, so it can stand in for that list wherever examples
+    are only read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = {}
+        for name in ID_COLUMNS:
+            self.columns[name] = (np.load(os.path.join(path, name + '.npy'), mmap_mode='r'),
+                                  np.load(os.path.join(path, name + '.offsets.npy'), mmap_mode='r'))
+        text_file = os.path.join(path, 'text.bin')
+        if os.path.getsize(text_file) > 0:
+            text = np.memmap(text_file, dtype=np.uint8, mode='r')
+        else:
+            text = np.zeros(0, dtype=np.uint8)
+        self.text = (text, np.load(os.path.join(path, 'text.offsets.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.columns['src'][1]) - 1
+
+    def column(self, name, i):
+        """The `name` column of example `i` as an int32 array view."""
+        values, offsets = self.columns[name]
+        return values[offsets[i]:offsets[i + 1]]
+
+    def lengths(self, name):
+        """Per-example lengths of column `name`, read from the offsets index only."""
+        return np.diff(self.columns[name][1])
+
+    def text_of(self, i):
+        text, offsets = self.text
+        return json.loads(bytes(text[offsets[i]:offsets[i + 1]]).decode('utf-8'))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('example index out of range')
+        ex = {name: self.column(name, i).tolist() for name in ID_COLUMNS}
+        ex.update(zip(TEXT_COLUMNS, self.text_of(i)))
+        return ex
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,116 @@
+"""
+Consolidated store of per-document preprocessing results, used by `-doc_cache`.
+
+As in `others.tag_store`, values are json lines in a data file with an index
+of byte ranges, but entries are keyed by a content hash and a store is a
+directory of segments
+
+    <segment>.jsonl         one json value per line
+    <segment>.index.json    key -> [byte offset, byte length] in <segment>.jsonl
+
+Every writer adds a segment of its own, renamed into place on `close`, so
+parallel jobs can add to a store without sharing a file. A reader sees the
+segments that were complete when it was opened; a key found in several of
+them is read from the newest. `compact` merges the segments into one once
+the writers are done, so a store does not gain a segment per job forever.
+"""
+
+import json
+import os
+import time
+import uuid
+
+DATA_SUFFIX = '.jsonl'
+INDEX_SUFFIX = '.index.json'
+
+
+class DocStore(object):
+    """Reads single entries from the store in `directory`, which need not exist."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}
+        self.files = {}
+        self.segments = []
+        if os.path.isdir(directory):
+            # Segment names start with their creation time, so newer entries come last.
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(INDEX_SUFFIX):
+                    segment = name[:-len(INDEX_SUFFIX)]
+                    self.segments.append(segment)
+                    with open(os.path.join(directory, name)) as f:
+                        for key, (offset, length) in json.load(f).items():
+                            self.index[key] = (segment, offset, length)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        segment, offset, length = self.index[key]
+        if (segment not in self.files):
+            self.files[segment] = open(os.path.join(self.directory, segment + DATA_SUFFIX), 'rb')
+        f = self.files[segment]
+        f.seek(offset)
+        return json.loads(f.read(length).decode('utf-8'))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class DocStoreWriter(object):
+    """Appends entries to a new segment of the store in `directory`, renamed into place on `close`."""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment = '%s-%d-%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), uuid.uuid4().hex[:8])
+        self.data_path = os.path.join(directory, self.segment + DATA_SUFFIX)
+        self.f = open(self.data_path + '.tmp', 'wb')
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, key, value):
+        line = (json.dumps(value) + '\n').encode('utf-8')
+        self.index[key] = [self.f.tell(), len(line)]
+        self.f.write(line)
+
+    def close(self):
+        self.f.close()
+        if not self.index:
+            os.remove(self.data_path + '.tmp')
+            return
+        index_path = os.path.join(self.directory, self.segment + INDEX_SUFFIX)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        # The data goes first: a segment is only read once its index exists.
+        os.replace(self.data_path + '.tmp', self.data_path)
+        os.replace(index_path + '.tmp', index_path)
+
+
+def compact(directory):
+    """Rewrites the segments of the store in `directory` as a single one, with the newest value of each key.
+
+    Nothing may read or write the store meanwhile, so call it at the end of
+    a run. Returns the number of entries kept.
+    """
+    store = DocStore(directory)
+    if len(store.segments) < 2:
+        return len(store)
+    writer = DocStoreWriter(directory)
+    for key in store.index:
+        writer.add(key, store.get(key))
+    store.close()
+    writer.close()
+    for segment in store.segments:
+        # The index goes first, as a segment without one is never read.
+        os.remove(os.path.join(directory, segment + INDEX_SUFFIX))
+        os.remove(os.path.join(directory, segment + DATA_SUFFIX))
+    return len(writer)
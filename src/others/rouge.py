@@ -0,0 +1,184 @@
+"""
+In-process ROUGE-1/2/L scorer.
+
+Reproduces the settings `pyrouge.Rouge155` runs ROUGE-1.5.5 with here
+(`-c 95 -m -r 1000 -n 2 -a`): text is lowercased and `clean`ed as
+pyrouge's DirectoryProcessor does, split on non-alphanumerics, tokens longer
+than three characters are Porter-stemmed, ROUGE-N counts clipped n-gram
+matches over the whole summary and ROUGE-L is the summary-level union LCS
+over the `<q>`-separated sentences. Scores are averaged over documents with
+bootstrap confidence intervals, and returned with the same keys as
+`Rouge155.output_to_dict`.
+
+ROUGE-1.5.5 also maps irregular forms through the WordNet exception
+database before stemming; that lookup is not reproduced.
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+from nltk.stem import porter
+
+ROUGE_TYPES = ['rouge_1', 'rouge_2', 'rouge_l']
+MEASURES = ['precision', 'recall', 'f_score']
+SCORE_NAMES = ['%s_%s' % (t, m) for t in ROUGE_TYPES for m in MEASURES]
+
+REMAP = {"-lrb-": "(", "-rrb-": ")", "-lcb-": "{", "-rcb-": "}",
+         "-lsb-": "[", "-rsb-": "]", "``": '"', "''": '"'}
+
+_NON_ALPHANUM = re.compile(r'[^a-z0-9]+')
+_stemmer = porter.PorterStemmer('ORIGINAL_ALGORITHM')
+_stems = {}
+
+
+def clean(x):
+    return re.sub(
+        r"-lrb-|-rrb-|-lcb-|-rcb-|-lsb-|-rsb-|``|''",
+        lambda m: REMAP.get(m.group()), x)
+
+
+def _stem(token):
+    stem = _stems.get(token)
+    if stem is None:
+        stem = _stems[token] = _stemmer.stem(token) if len(token) > 3 else token
+    return stem
+
+
+def tokenize(text):
+    """Split a `<q>`-separated summary into sentences of stemmed tokens."""
+    sents = []
+    for sent in clean(text.lower()).split('<q>'):
+        tokens = [_stem(t) for t in _NON_ALPHANUM.sub(' ', sent).split()]
+        if tokens:
+            sents.append(tokens)
+    return sents
+
+
+def _prf(hits, n_candidate, n_reference):
+    precision = hits / n_candidate if n_candidate > 0 else 0.0
+    recall = hits / n_reference if n_reference > 0 else 0.0
+    if precision + recall > 0:
+        f_score = 2 * precision * recall / (precision + recall)
+    else:
+        f_score = 0.0
+    return precision, recall, f_score
+
+
+def _ngram_prf(candidate, reference, n):
+    c_grams = Counter(tuple(candidate[i:i + n]) for i in range(len(candidate) - n + 1))
+    r_grams = Counter(tuple(reference[i:i + n]) for i in range(len(reference) - n + 1))
+    hits = sum((c_grams & r_grams).values())
+    return _prf(hits, sum(c_grams.values()), sum(r_grams.values()))
+
+
+def _lcs_tables(ref_sent, cand_cols, offsets):
+    """LCS tables of `ref_sent` against every candidate sentence at once.
+
+    `cand_cols` holds all candidate sentences, each preceded by a boundary
+    column (-1). Row i of the table is the cumulative maximum of the
+    diagonal/upper candidates, computed per sentence by lifting sentence k
+    by k * offset before `np.maximum.accumulate`.
+    """
+    table = np.zeros((len(ref_sent) + 1, len(cand_cols)), dtype=np.int64)
+    for i, token in enumerate(ref_sent, start=1):
+        up = table[i - 1]
+        best = up.copy()
+        best[1:] = np.maximum(up[1:], up[:-1] + (cand_cols[1:] == token))
+        best[cand_cols == -1] = 0
+        table[i] = np.maximum.accumulate(best + offsets) - offsets
+    return table
+
+
+def _lcs_positions(table, ref_sent, cand_cols, start, end):
+    """Reference positions of the LCS with the candidate in columns (start, end)."""
+    positions = set()
+    i, j = len(ref_sent), end - 1
+    while i > 0 and j > start:
+        if ref_sent[i - 1] == cand_cols[j]:
+            positions.add(i - 1)
+            i -= 1
+            j -= 1
+        elif table[i][j - 1] > table[i - 1][j]:
+            j -= 1
+        else:
+            i -= 1
+    return positions
+
+
+def _lcs_prf(cand_sents, ref_sents):
+    vocab = {}
+    cand_ids = [[vocab.setdefault(t, len(vocab)) for t in sent] for sent in cand_sents]
+    ref_ids = [[vocab.setdefault(t, len(vocab)) for t in sent] for sent in ref_sents]
+    n_candidate = sum(len(s) for s in cand_ids)
+    n_reference = sum(len(s) for s in ref_ids)
+    if n_candidate == 0 or n_reference == 0:
+        return _prf(0, n_candidate, n_reference)
+
+    cols, bounds = [], []
+    for sent in cand_ids:
+        bounds.append((len(cols), len(cols) + len(sent) + 1))
+        cols += [-1] + sent
+    cand_cols = np.array(cols, dtype=np.int64)
+    segment = np.cumsum(cand_cols == -1) - 1
+    offsets = segment * (len(cand_cols) + 1)
+
+    c_counts = Counter(t for sent in cand_ids for t in sent)
+    r_counts = Counter(t for sent in ref_ids for t in sent)
+    hits = 0
+    for ref_sent in ref_ids:
+        table = _lcs_tables(ref_sent, cand_cols, offsets)
+        union = set()
+        for start, end in bounds:
+            union |= _lcs_positions(table, ref_sent, cand_cols, start, end)
+        for i in sorted(union):
+            t = ref_sent[i]
+            if c_counts[t] > 0 and r_counts[t] > 0:
+                hits += 1
+                c_counts[t] -= 1
+                r_counts[t] -= 1
+    return _prf(hits, n_candidate, n_reference)
+
+
+def score(candidate, reference):
+    """Per-document scores, in the order of `SCORE_NAMES`."""
+    cand_sents = tokenize(candidate)
+    ref_sents = tokenize(reference)
+    cand_tokens = [t for sent in cand_sents for t in sent]
+    ref_tokens = [t for sent in ref_sents for t in sent]
+    return (_ngram_prf(cand_tokens, ref_tokens, 1) +
+            _ngram_prf(cand_tokens, ref_tokens, 2) +
+            _lcs_prf(cand_sents, ref_sents))
+
+
+def aggregate(rows, n_samples=1000, confidence=95, seed=0):
+    """Average per-document score rows into a `Rouge155.output_to_dict` style dict.
+
+    The confidence interval is the bootstrap percentile interval of the mean
+    over `n_samples` resamples of the documents.
+    """
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, len(SCORE_NAMES))
+    results = {}
+    if len(rows) == 0:
+        for name in SCORE_NAMES:
+            results[name] = results[name + '_cb'] = results[name + '_ce'] = 0.0
+        return results
+    rng = np.random.RandomState(seed)
+    means = np.empty((n_samples, rows.shape[1]))
+    for k in range(n_samples):
+        means[k] = rows[rng.randint(0, len(rows), len(rows))].mean(0)
+    lower, upper = np.percentile(means, [(100 - confidence) / 2, (100 + confidence) / 2], axis=0)
+    for i, name in enumerate(SCORE_NAMES):
+        results[name] = float(rows[:, i].mean())
+        results[name + '_cb'] = float(lower[i])
+        results[name + '_ce'] = float(upper[i])
+    return results
+
+
+def rouge_scores(candidates, references):
+    """Corpus ROUGE of line-aligned candidates and references.
+
+    Like `others.utils.test_rouge`, pairs with an empty reference are skipped.
+    """
+    rows = [score(c, r) for c, r in zip(candidates, references) if len(r) > 0]
+    return aggregate(rows)
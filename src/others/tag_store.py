@@ -0,0 +1,64 @@
+"""
+Consolidated store of the PICO tags `pico_predict_read.py` writes.
+
+Instead of one `<doc>.tag.json` per document, a directory can hold
+
+    pico_tags.jsonl         the tags of every document, one json list per line
+    pico_tags.index.json    document name -> [byte offset, byte length] in pico_tags.jsonl
+
+`load_json` falls back to the store of the directory a missing
+`<doc>.tag.json` would have been in, so both layouts are read the same way.
+"""
+
+import json
+import os
+
+DATA_FILE = 'pico_tags.jsonl'
+INDEX_FILE = 'pico_tags.index.json'
+
+
+def has_store(directory):
+    return os.path.exists(os.path.join(directory, INDEX_FILE))
+
+
+class TagStore(object):
+    """Reads the tags of single documents from the store in `directory`."""
+
+    def __init__(self, directory):
+        self.data_path = os.path.join(directory, DATA_FILE)
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, name):
+        offset, length = self.index[name]
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode('utf-8'))
+
+
+class TagStoreWriter(object):
+    """Appends documents to a new store in `directory`, renamed into place on `close`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.f = open(os.path.join(directory, DATA_FILE + '.tmp'), 'wb')
+        self.index = {}
+
+    def add(self, name, tags):
+        line = (json.dumps(tags) + '\n').encode('utf-8')
+        self.index[name] = [self.f.tell(), len(line)]
+        self.f.write(line)
+
+    def close(self):
+        self.f.close()
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(os.path.join(self.directory, DATA_FILE + '.tmp'), os.path.join(self.directory, DATA_FILE))
+        os.replace(index_path + '.tmp', index_path)
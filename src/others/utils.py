@@ -4,6 +4,7 @@ import shutil
 import time
 
 from others import pyrouge
+from others.rouge import rouge_scores
 
 REMAP = {"-lrb-": "(", "-rrb-": ")", "-lcb-": "{", "-rcb-": "}",
          "-lsb-": "[", "-rsb-": "]", "``": '"', "''": '"'}
@@ -51,12 +52,19 @@ def process(params):
     return results_dict
 
 
-def test_rouge(temp_dir, cand, ref):
+def test_rouge(temp_dir, cand, ref, engine='native'):
+    """ROUGE of the candidate file against the reference file.
+
+    `engine='native'` scores in memory with `others.rouge`, `'perl'` runs
+    ROUGE-1.5.5 through pyrouge on temporary files.
+    """
     candidates = [line.strip() for line in open(cand, encoding='utf-8')]
     references = [line.strip() for line in open(ref, encoding='utf-8')]
     print(len(candidates))
     print(len(references))
     assert len(candidates) == len(references)
+    if engine == 'native':
+        return rouge_scores(candidates, references)
 
     cnt = len(candidates)
     current_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime())
@@ -111,14 +111,14 @@ class PicoDataset(torch.utils.data.Dataset):
         self.input_ids = src_idx
         self.token_type_ids = [0] * len(self.input_ids)
         self.labels = labels
-        self.attention_mask = np.ones((len(mask), len(mask[0]))) #[1]* len(self.input_ids)
+        self.attention_mask = [np.ones(len(ids), dtype=np.int64) for ids in src_idx] #[1]* len(self.input_ids)
     def __getitem__(self, idx):
         #item = {key: torch.tensor(val[idx]) for key, val in self.input_ids.items()}
         item = {}
         #print(self.labels[idx],type(self.labels[idx]))
         item['labels'] = self.labels[idx]
         item['input_ids'] = self.input_ids[idx]
-        item['attention_mask'] = self.attention_mask[idx]
+        item['attention_mask'] = self.attention_mask[idx].tolist()
         #print(item['input_ids'])
         #print(len(item['input_ids']))
         return item
@@ -131,7 +131,7 @@ class PicoBertDataset(torch.utils.data.Dataset):
         self.token_type_ids = type_ids
         self.labels = labels
         #print(len(mask))
-        self.attention_mask = np.ones((len(mask), len(mask[0])))#mask
+        self.attention_mask = [np.ones(len(ids), dtype=np.int64) for ids in src_idx]#mask
     def __getitem__(self, idx):
         #item = {key: torch.tensor(val[idx]) for key, val in self.input_ids.items()}
         item = {}
@@ -146,6 +146,8 @@ class PicoBertDataset(torch.utils.data.Dataset):
         #print(item['attention_mask'])
         item['attention_mask'][torch.where(torch.tensor(self.input_ids[idx]) == 1)] = 0
         item['attention_mask'][torch.where(torch.tensor(self.input_ids[idx]) == 2)] = 0
+        # `tokenizer.pad` extends the masks of shorter examples with lists.
+        item['attention_mask'] = item['attention_mask'].tolist()
         item['token_type_ids'] = self.token_type_ids[idx]
         
         #print(item['input_ids'])
@@ -252,7 +254,7 @@ def main():
         weight_decay=0.001,
         logging_dir= logging_data_dir,
     )
-    data_collator = DataCollatorForTokenClassification(tokenizer)
+    data_collator = DataCollatorForTokenClassification(tokenizer, label_pad_token_id=0)
     #metric = load_metric("seqeval")
     trainer = Trainer(
         model=model,
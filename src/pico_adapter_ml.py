@@ -117,7 +117,7 @@ class PicoDataset(torch.utils.data.Dataset):
         self.input_ids = src_idx
         self.token_type_ids = [0] * len(self.input_ids)
         self.labels = labels
-        self.attention_mask = np.ones((len(mask), len(mask[0])))  # [1]* len(self.input_ids)
+        self.attention_mask = [np.ones(len(ids), dtype=np.int64) for ids in src_idx]  # [1]* len(self.input_ids)
 
     def __getitem__(self, idx):
         # item = {key: torch.tensor(val[idx]) for key, val in self.input_ids.items()}
@@ -125,7 +125,7 @@ class PicoDataset(torch.utils.data.Dataset):
         # print(self.labels[idx],type(self.labels[idx]))
         item['labels'] = self.labels[idx]
         item['input_ids'] = self.input_ids[idx]
-        item['attention_mask'] = self.attention_mask[idx]
+        item['attention_mask'] = self.attention_mask[idx].tolist()
         # print(item['input_ids'])
         # print(len(item['input_ids']))
         return item
@@ -140,7 +140,7 @@ class PicoBertDataset(torch.utils.data.Dataset):
         self.token_type_ids = type_ids
         self.labels = labels
         # print(len(mask))
-        self.attention_mask = np.ones((len(mask), len(mask[0])))  # mask
+        self.attention_mask = [np.ones(len(ids), dtype=np.int64) for ids in src_idx]  # mask
 
     def __getitem__(self, idx):
         # item = {key: torch.tensor(val[idx]) for key, val in self.input_ids.items()}
@@ -148,7 +148,7 @@ class PicoBertDataset(torch.utils.data.Dataset):
         # print(self.labels[idx],type(self.labels[idx]))
         item['labels'] = self.labels[idx]
         item['input_ids'] = self.input_ids[idx]
-        item['attention_mask'] = self.attention_mask[idx]
+        item['attention_mask'] = self.attention_mask[idx].tolist()
         item['token_type_ids'] = self.token_type_ids[idx]
 
         # print(item['input_ids'])
@@ -160,6 +160,20 @@ class PicoBertDataset(torch.utils.data.Dataset):
         return len(self.labels)
 
 
+
+class PicoDataCollatorForLanguageModeling(DataCollatorForLanguageModeling):
+    """`DataCollatorForLanguageModeling` for examples of different lengths.
+
+    `tokenizer.pad` pads the model inputs of a batch but not its `labels`,
+    so they are padded with 0 here before the MLM masking.
+    """
+
+    def __call__(self, features, return_tensors=None):
+        width = max(len(f['labels']) for f in features)
+        features = [dict(f, labels=list(f['labels']) + [0] * (width - len(f['labels']))) for f in features]
+        return super().__call__(features, return_tensors)
+
+
 def main():
     args = parser.parse_args()
     if args.model == "robert":
@@ -230,7 +244,7 @@ def main():
         weight_decay=0.001,
         logging_dir=logging_data_dir,
     )
-    data_collator =  DataCollatorForLanguageModeling(tokenizer=tokenizer)
+    data_collator = PicoDataCollatorForLanguageModeling(tokenizer=tokenizer)
     # metric = load_metric("seqeval")
     trainer = Trainer(
         model=model,
@@ -3,10 +3,11 @@ import os
 import random
 import re
 import math
-from collections import Counter
+from collections import Counter, deque
 from os.path import join as pjoin
 
-from others.logging import logger
+from others.logging import logger, init_logger
+from others.tag_store import TagStoreWriter
 import pandas as pd
 import time
 from datetime import datetime
@@ -18,8 +19,11 @@ parser.add_argument("-raw_path", default="/home/qianqian/scibert/data/pico/ebmnl
 parser.add_argument("-save_path", default="/home/qianqian/covid-bert/token_data/", type=str)
 parser.add_argument("-predict_path", default="/home/qianqian/scibert/out.txt", type=str)
 parser.add_argument("-corpus", default="cord-19", type=str)
+parser.add_argument("-tag_store", action="store_true",
+                    help="write the tags of each output directory into one indexed store instead of .tag.json files")
 
 args = parser.parse_args()
+init_logger()
 raw_path = os.path.abspath(args.raw_path)
 save_path = os.path.abspath(args.save_path)
 predict_path = os.path.abspath(args.predict_path)
@@ -33,86 +37,126 @@ if args.corpus =='pubmed':
     val_path = os.path.join(save_path, 'val_pubmed')
     train_path = os.path.join(save_path, 'train_pubmed')
     test_corpora = sorted([os.path.join(test_path, f) for f in os.listdir(test_path)
-                           if not f.startswith('.') and not f.endswith('.abs.txt.json')])
+                           if not f.startswith('.') and not f.endswith('.abs.txt.json')
+                           and not f.endswith('.tag.json') and not f.startswith('pico_tags.')])
     val_corpora = sorted([os.path.join(val_path, f) for f in os.listdir(val_path)
-                          if not f.startswith('.') and not f.endswith('.abs.txt.json')])
+                          if not f.startswith('.') and not f.endswith('.abs.txt.json')
+                          and not f.endswith('.tag.json') and not f.startswith('pico_tags.')])
     train_corpora = sorted([os.path.join(train_path, f) for f in os.listdir(train_path)
-                            if not f.startswith('.') and not f.endswith('.abs.txt.json')])
+                            if not f.startswith('.') and not f.endswith('.abs.txt.json')
+                            and not f.endswith('.tag.json') and not f.startswith('pico_tags.')])
     test_len = len(test_corpora)
     val_len = len(val_corpora)
     train_len = len(train_corpora)
 
-predict_json = []
-with open(predict_path, "r") as f:
-    for line in f:
+
+
+class PredictionStream(object):
+    """The tags and words of the prediction file, read one line at a time as they are taken.
+
+    Like the flattened lists this replaces, tags and words are consumed
+    independently, so a line with more words than tags shifts the tags of
+    the following tokens rather than dropping words.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, "r")
+        self.tags = deque()
+        self.words = deque()
+        self.n_lines = 0
+
+    def _read_line(self):
+        line = self.f.readline()
+        if not line:
+            return False
         content = json.loads(line)
-        predict_json.append(content)
+        self.n_lines += 1
         tag_leng = len(content['tags'])
         words_leng = len(content['words'])
-        try:
-            assert tag_leng == words_leng, (content['tags'], content['words'])
-        except Exception:
-            print (words_leng - tag_leng)
-            print ([key for key, val in dict(Counter(content['words'])).items() if val == (words_leng - tag_leng)])
-tags = [item for v in predict_json for item in v['tags']]
-words = [item for v in predict_json for item in v['words']]
-#is_divider = False
-print (len(tags), len(words))
-count = 0
-doc_id = 0
-with open(raw_path, "r") as data_file:
-    temp_tags = []
-    for line in tqdm(data_file):
-        if line.strip() == '':
-            continue
-        else:
-            first_token = line.strip().split()[0]
-            if first_token == "-DOCSTART-":
-                if temp_tags:
-                    if args.corpus == 'pubmed':
-                        doc_id = int(doc_id)
-                        if doc_id <= train_len-1:
-                            s_path=os.path.join(save_path,'train_pubmed')
-                        if train_len -1 < doc_id and doc_id <=train_len+val_len-1:
-                            s_path = os.path.join(save_path, 'val_pubmed')
-                            doc_id = doc_id - train_len
-                        if train_len+val_len-1 < doc_id and doc_id <= train_len + val_len+test_len - 1:
-                            s_path = os.path.join(save_path, 'test_pubmed')
-                            doc_id = doc_id - train_len - val_len
-                        tpath = os.path.join(s_path, '{}.tag.json'.format(doc_id))
-                    else:
-                        tpath = os.path.join(save_path, '{}.tag.json'.format(doc_id))
-                    with open(tpath, 'w') as f:
-                        f.write(json.dumps(temp_tags))
-                    # Save tags to json
-                temp_tags = []
-                doc_id = line.strip().split()[1][1:-1]
-            else:
-                fields = line.strip().split()
-                if len(fields) == 4:
-                    word = fields[0]
-                else:
-                    word = " ".join([w for w in fields[:-3]])
-                pred_word = words[count]
-                #print(word, pred_word)
-                try:
-                    assert word==pred_word
-                except AssertionError as e:
-                    print (word, pred_word)
-                temp_tags.append((tags[count],pred_word))
-                count += 1
-    doc_id = int(doc_id)
-    if args.corpus == 'pubmed':
-        s_path = os.path.join(save_path, 'test_pubmed')
-        doc_id = doc_id - train_len - val_len
-    tpath = os.path.join(s_path, '{}.tag.json'.format(doc_id))
-    with open(tpath, 'w') as f:
-        f.write(json.dumps(temp_tags))
+        if tag_leng != words_leng:
+            logger.warning('Prediction %d has %d words but %d tags, repeated words: %s'
+                           % (self.n_lines, words_leng, tag_leng,
+                              [key for key, val in dict(Counter(content['words'])).items()
+                               if val == (words_leng - tag_leng)]))
+        self.tags.extend(content['tags'])
+        self.words.extend(content['words'])
+        return True
 
+    def take(self, n):
+        """The next `n` (tag, word) pairs; fewer if the predictions run out."""
+        while (len(self.tags) < n or len(self.words) < n) and self._read_line():
+            pass
+        n = min(n, len(self.tags), len(self.words))
+        return [(self.tags.popleft(), self.words.popleft()) for _ in range(n)]
 
+    def close(self):
+        self.f.close()
 
 
+def conll_documents(path):
+    """(doc id, words) of every document of the CoNLL file, in order."""
+    doc_id = 0
+    words = []
+    with open(path, "r") as data_file:
+        for line in tqdm(data_file):
+            if line.strip() == '':
+                continue
+            fields = line.strip().split()
+            if fields[0] == "-DOCSTART-":
+                if words:
+                    yield doc_id, words
+                words = []
+                doc_id = fields[1][1:-1]
+            elif len(fields) == 4:
+                words.append(fields[0])
+            else:
+                words.append(" ".join([w for w in fields[:-3]]))
+    # The last document is written even if it has no tokens.
+    yield doc_id, words
 
 
+def tag_location(doc_id):
+    """(directory, name) of the tags of a document."""
+    if args.corpus != 'pubmed':
+        return save_path, str(doc_id)
+    doc_id = int(doc_id)
+    if doc_id < train_len:
+        return os.path.join(save_path, 'train_pubmed'), str(doc_id)
+    if doc_id < train_len + val_len:
+        return os.path.join(save_path, 'val_pubmed'), str(doc_id - train_len)
+    if doc_id < train_len + val_len + test_len:
+        return os.path.join(save_path, 'test_pubmed'), str(doc_id - train_len - val_len)
+    return None, None
 
 
+predictions = PredictionStream(predict_path)
+stores = {}
+n_docs, n_misaligned, n_skipped = 0, 0, 0
+for doc_id, words in conll_documents(raw_path):
+    pairs = predictions.take(len(words))
+    n_diff = sum(word != pred_word for word, (_, pred_word) in zip(words, pairs)) + len(words) - len(pairs)
+    if n_diff:
+        n_misaligned += 1
+        logger.warning('Document %s: %d of %d words differ from the predictions' % (doc_id, n_diff, len(words)))
+    s_path, name = tag_location(doc_id)
+    if s_path is None:
+        n_skipped += 1
+        logger.warning('Document %s is not in any pubmed split, skipped' % doc_id)
+        continue
+    temp_tags = [(tag, pred_word) for tag, pred_word in pairs]
+    if args.tag_store:
+        if s_path not in stores:
+            stores[s_path] = TagStoreWriter(s_path)
+        stores[s_path].add(name, temp_tags)
+    else:
+        # Save tags to json
+        with open(os.path.join(s_path, '{}.tag.json'.format(name)), 'w') as f:
+            f.write(json.dumps(temp_tags))
+    n_docs += 1
+for store in stores.values():
+    store.close()
+left = len(predictions.take(1))
+predictions.close()
+if left:
+    logger.warning('Predictions left over after the last document')
+logger.info('Wrote the tags of %d documents, %d misaligned, %d skipped' % (n_docs, n_misaligned, n_skipped))
@@ -0,0 +1,210 @@
+"""
+Tags CoreNLP-tokenized documents with a trained scibert `PicoCrfTagger`.
+
+Does in one pass what `preprocess_pico.py`, `allennlp predict` and
+`pico_predict_read.py` do in three: documents are read straight from the
+tokenized `.json` files, split into sentences the way `preprocess_pico.py`
+writes them to `cord.txt`, and tagged by a pool of workers, each holding
+its own copy of the model. A worker sorts the sentences of its documents by
+length before batching them, so batches carry little padding. The
+(tag, word) pairs of every document are written to the tag store of its
+directory (`others.tag_store`), keyed by paper id, where `format_to_lines`
+reads them. With `-doc_cache` the tags are also kept in an
+`others.doc_store`, keyed by a hash of the model archive and the tokenized
+document, and documents tagged by an earlier run are not tagged again.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+
+from multiprocess import Pool, current_process
+from tqdm import tqdm
+
+from others.doc_store import DocStore, DocStoreWriter, compact
+from others.logging import logger, init_logger
+from others.tag_store import TagStoreWriter
+
+# `preprocess_pico.py` ends a sentence after a full stop or this many tokens.
+MAX_SENT_TOKENS = 250
+
+_model = None
+_reader = None
+
+
+def list_documents(raw_path, corpus):
+    """Paths of the tokenized documents, in the order `preprocess_pico.py` writes them."""
+    if corpus != "pubmed":
+        dirs = [raw_path]
+    else:
+        dirs = [os.path.join(raw_path, d) for d in ['train_pubmed', 'val_pubmed', 'test_pubmed']]
+    docs = []
+    for d in dirs:
+        docs += sorted([os.path.join(d, f) for f in os.listdir(d)
+                        if not f.startswith('.') and f.endswith('.json') and not f.endswith('.abs.txt.json')
+                        and not f.endswith('.tag.json') and not f.startswith('pico_tags.')])
+    return docs
+
+
+def split_sentences(json_main):
+    """Word lists of the sentences `preprocess_pico.py` writes for a document."""
+    for sent in json_main['sentences']:
+        words = []
+        for token in sent['tokens']:
+            # Words go through a whitespace separated CoNLL line on the old path.
+            words.append(' '.join(token['word'].split()))
+            if len(words) >= MAX_SENT_TOKENS or token['word'] == '.':
+                yield words
+                words = []
+        if words:
+            yield words
+
+
+def _init_worker(archive_path, cuda_devices, scibert_path):
+    global _model, _reader
+    os.environ['PICO_MODE'] = 'PREDICT'
+    sys.path.insert(0, scibert_path)
+    from allennlp.common.util import import_submodules
+    from allennlp.data import DatasetReader
+    from allennlp.models.archival import load_archive
+    import_submodules('scibert')
+
+    # Spread the workers over the given GPUs, or run them all on the CPU.
+    worker_id = current_process()._identity[0] - 1 if current_process()._identity else 0
+    cuda_device = cuda_devices[worker_id % len(cuda_devices)] if cuda_devices else -1
+    archive = load_archive(archive_path, cuda_device=cuda_device)
+    _model = archive.model
+    _model.eval()
+    # Decodes whole batches at once; the paths are those of `crf.viterbi_tags`.
+    _model.batched_viterbi = True
+    _reader = DatasetReader.from_params(archive.config['dataset_reader'].duplicate())
+
+
+def _tag_documents(params):
+    docs, batch_size = params
+    from allennlp.data.tokenizers import Token
+    import torch
+
+    sentences = []
+    for i, (_, _, f_main) in enumerate(docs):
+        with open(f_main, 'r') as f:
+            sentences += [(i, words) for words in split_sentences(json.load(f))]
+
+    # Batch the sentences of all documents by length.
+    order = sorted(range(len(sentences)), key=lambda k: len(sentences[k][1]))
+    sent_tags = [None] * len(sentences)
+    with torch.no_grad():
+        for b in range(0, len(order), batch_size):
+            batch = order[b:b + batch_size]
+            instances = [_reader.text_to_instance([Token(w) for w in sentences[k][1]]) for k in batch]
+            for k, output in zip(batch, _model.forward_on_instances(instances)):
+                sent_tags[k] = output['tags']
+
+    doc_tags = [[] for _ in docs]
+    for (i, words), tags in zip(sentences, sent_tags):
+        doc_tags[i] += list(zip(tags, words))
+    return [(out_dir, name, tags) for (out_dir, name, _), tags in zip(docs, doc_tags)], len(sentences)
+
+
+def _file_hash(path, h=None):
+    h = h or hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h
+
+
+def _tasks(docs, args):
+    for i in range(0, len(docs), args.docs_per_task):
+        yield docs[i:i + args.docs_per_task], args.batch_size
+
+
+def main(args):
+    raw_path = os.path.abspath(args.raw_path)
+    save_path = os.path.abspath(args.save_path) if args.save_path else raw_path
+    docs = []
+    for f_main in list_documents(raw_path, args.corpus):
+        out_dir = os.path.join(save_path, os.path.relpath(os.path.dirname(f_main), raw_path))
+        docs.append((os.path.normpath(out_dir), os.path.basename(f_main).split('.')[0], f_main))
+
+    stores = {}
+    for out_dir in sorted(set(d[0] for d in docs)):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        stores[out_dir] = TagStoreWriter(out_dir)
+
+    cache_writer, cache_keys = None, {}
+    if args.doc_cache:
+        cache = DocStore(os.path.join(args.doc_cache, 'pico_tags'))
+        cache_writer = DocStoreWriter(os.path.join(args.doc_cache, 'pico_tags'))
+        model_hash = _file_hash(args.model_archive)
+        todo = []
+        for out_dir, name, f_main in docs:
+            key = _file_hash(f_main, model_hash.copy()).hexdigest()
+            if key in cache:
+                stores[out_dir].add(name, cache.get(key))
+            else:
+                cache_keys[out_dir, name] = key
+                todo.append((out_dir, name, f_main))
+        cache.close()
+        logger.info('Tag cache: %d reused, %d to tag' % (len(docs) - len(todo), len(todo)))
+        docs = todo
+
+    cuda_devices = [int(d) for d in args.cuda_devices.split(',')] if args.cuda_devices else []
+    pool = Pool(args.n_workers, initializer=_init_worker,
+                initargs=(args.model_archive, cuda_devices, os.path.abspath(args.scibert_path)))
+    start = time.time()
+    n_sents = 0
+    pending = deque()
+
+    def _write(result):
+        tagged, n = result.get()
+        for out_dir, name, tags in tagged:
+            stores[out_dir].add(name, tags)
+            if cache_writer is not None:
+                cache_writer.add(cache_keys[out_dir, name], tags)
+        pbar.update(len(tagged))
+        return n
+
+    with tqdm(total=len(docs)) as pbar:
+        for task in _tasks(docs, args):
+            pending.append(pool.apply_async(_tag_documents, (task,)))
+            # Keep at most two tasks per worker queued or waiting to be written.
+            if len(pending) >= 2 * args.n_workers:
+                n_sents += _write(pending.popleft())
+        while pending:
+            n_sents += _write(pending.popleft())
+    pool.close()
+    pool.join()
+    for store in stores.values():
+        store.close()
+    if cache_writer is not None:
+        cache_writer.close()
+        compact(os.path.join(args.doc_cache, 'pico_tags'))
+
+    elapsed = time.time() - start
+    logger.info('Tagged %d documents, %d sentences in %.1fs (%.1f docs/s)'
+                % (len(docs), n_sents, elapsed, len(docs) / max(elapsed, 1e-6)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-raw_path", default="./token_data/", type=str)
+    parser.add_argument("-save_path", default="", type=str,
+                        help="root of the tag stores, the directories of the documents by default")
+    parser.add_argument("-model_archive", default="./scibert/wotune_model/model.tar.gz", type=str)
+    parser.add_argument("-scibert_path", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scibert'),
+                        type=str)
+    parser.add_argument("-corpus", default="cord-19", type=str)
+    parser.add_argument("-n_workers", default=1, type=int)
+    parser.add_argument("-cuda_devices", default="", type=str, help="comma separated GPU ids shared by the workers")
+    parser.add_argument("-batch_size", default=32, type=int)
+    parser.add_argument("-docs_per_task", default=64, type=int)
+    parser.add_argument("-doc_cache", default="", type=str,
+                        help="directory of the preprocessing cache, tags of unchanged documents are reused from it")
+
+    init_logger()
+    main(parser.parse_args())
@@ -0,0 +1,223 @@
+"""
+Tokenization stage of `tokenize_allenai_datasets` and `tokenize_pubmed_dataset`.
+
+Documents are (name, text) pairs. Every document becomes `<name>.json` in
+the output directory, in the format of CoreNLP's `-outputFormat json`, of
+which `load_json` reads `sentences[].tokens[].word`. Two backends:
+
+    corenlp  texts are written to `<name>` files and the file list is split
+             across N StanfordCoreNLP JVMs running side by side
+    python   texts are streamed to N worker processes that split sentences
+             with NLTK's Punkt and tokenize them with the Penn Treebank
+             tokenizer; no intermediate files are written
+
+Both split sentences at every newline, as `-ssplit.newlineIsSentenceBreak
+always` does, but otherwise the python backend only approximates CoreNLP.
+It writes json of the same shape, not the same contents:
+
+    - Punkt ends sentences after abbreviations CoreNLP knows, such as
+      "e.g.", "et al.", "Fig." or "vs.", and without its trained English
+      model (`nltk.download('punkt')`) it does so after every full stop
+    - the Treebank tokenizer splits the full stop off such abbreviations
+      ("e.g" "."), keeps hyphenated words and "mg/kg" whole, and its
+      quote and ellipsis handling differs in places from CoreNLP's
+
+Sentence splits feed the oracle labels, the PICO tags and the shards, so
+data tokenized by the two backends should not be mixed, and corenlp stays
+the default. With a cache directory, the output of every text is kept in
+an `others.doc_store` keyed by a hash of the text, and texts tokenized
+before are written out from there instead of going to the tokenizer again.
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import time
+
+from multiprocess import Pool
+
+from others.doc_store import DocStore, DocStoreWriter, compact
+from others.logging import logger
+
+BACKENDS = ['corenlp', 'python']
+
+# CoreNLP escapes brackets the way the Penn Treebank does.
+_PTB_ESCAPES = {'(': '-LRB-', ')': '-RRB-', '{': '-LCB-', '}': '-RCB-', '[': '-LSB-', ']': '-RSB-'}
+
+_CHUNK_SIZE = 64
+
+_splitter = None
+_word_tokenizer = None
+
+
+def _load_nltk():
+    global _splitter, _word_tokenizer
+    if (_splitter is None):
+        import nltk
+        from nltk.tokenize import PunktSentenceTokenizer, TreebankWordTokenizer
+        try:
+            _splitter = nltk.data.load('tokenizers/punkt/english.pickle')
+        except LookupError:
+            # Without the trained English model Punkt still splits at sentence-final punctuation.
+            logger.warning('NLTK punkt model not found, splitting sentences at every full stop')
+            _splitter = PunktSentenceTokenizer()
+        _word_tokenizer = TreebankWordTokenizer()
+
+
+def annotate(text):
+    """CoreNLP-style `tokenize,ssplit` json of `text`."""
+    _load_nltk()
+    sentences = []
+    for line in text.split('\n'):
+        for sent in _splitter.tokenize(line):
+            words = _word_tokenizer.tokenize(sent)
+            if not words:
+                continue
+            sentences.append({'index': len(sentences),
+                              'tokens': [{'index': i + 1, 'word': _PTB_ESCAPES.get(w, w), 'originalText': w}
+                                         for i, w in enumerate(words)]})
+    return {'sentences': sentences}
+
+
+def _python_worker(params):
+    docs, out_dir = params
+    start = time.time()
+    for name, text in docs:
+        doc = annotate(text)
+        tmp_path = os.path.join(out_dir, '.{}.json'.format(name))
+        with open(tmp_path, 'w') as f:
+            json.dump(doc, f)
+        os.replace(tmp_path, os.path.join(out_dir, '{}.json'.format(name)))
+    return os.getpid(), len(docs), time.time() - start
+
+
+def _corenlp_worker(params):
+    worker_id, paths, out_dir = params
+    start = time.time()
+    filelist = os.path.join(out_dir, '.mapping_for_corenlp.{}.txt'.format(worker_id))
+    with open(filelist, 'w') as fi:
+        for fpath in paths:
+            fi.write('{}\n'.format(fpath))
+    command = ['java', 'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators', 'tokenize,ssplit',
+               '-ssplit.newlineIsSentenceBreak', 'always', '-filelist', filelist, '-outputFormat',
+               'json', '-outputDirectory', out_dir]
+    # A failed JVM must not pass for an empty partition; the missing json would only show up much later.
+    subprocess.check_call(command)
+    os.remove(filelist)
+    return worker_id, len(paths), time.time() - start
+
+
+def _report(stats, start, n_cached=0):
+    total = sum(n for n, _ in stats.values())
+    for worker, (n_docs, seconds) in sorted(stats.items()):
+        logger.info('Tokenizer worker %s: %d documents in %.1fs (%.1f docs/s)'
+                    % (worker, n_docs, seconds, n_docs / max(seconds, 1e-6)))
+    elapsed = time.time() - start
+    total += n_cached
+    logger.info('Tokenized %d documents (%d from the cache) in %.1fs (%.1f docs/s)'
+                % (total, n_cached, elapsed, total / max(elapsed, 1e-6)))
+    return total
+
+
+def _tokenize_python(docs, out_dir, n_workers):
+    stats = collections.defaultdict(lambda: [0, 0.])
+    pool = Pool(n_workers)
+    pending = collections.deque()
+
+    def _collect(result):
+        pid, n_docs, seconds = result.get()
+        stats[pid][0] += n_docs
+        stats[pid][1] += seconds
+
+    docs = iter(docs)
+    while True:
+        chunk = list(itertools.islice(docs, _CHUNK_SIZE))
+        if not chunk:
+            break
+        pending.append(pool.apply_async(_python_worker, ((chunk, out_dir),)))
+        # Keep only a few chunks per worker in flight so that texts are not all held in memory.
+        if (len(pending) >= 2 * n_workers):
+            _collect(pending.popleft())
+    while pending:
+        _collect(pending.popleft())
+    pool.close()
+    pool.join()
+    return stats
+
+
+def _tokenize_corenlp(docs, out_dir, txt_dir, n_workers):
+    paths = []
+    for name, text in docs:
+        fpath = os.path.join(txt_dir, name)
+        with open(fpath, 'w') as fil:
+            fil.write(text)
+        paths.append(fpath)
+    # Round-robin keeps the partitions balanced when neighbouring files differ in size.
+    partitions = [(i, paths[i::n_workers], out_dir) for i in range(n_workers) if paths[i::n_workers]]
+    stats = {}
+    with Pool(len(partitions) or 1) as pool:
+        for worker_id, n_docs, seconds in pool.imap_unordered(_corenlp_worker, partitions):
+            stats[worker_id] = [n_docs, seconds]
+        pool.close()
+        pool.join()
+    return stats
+
+
+def _write_json(doc, path):
+    tmp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+    with open(tmp_path, 'w') as f:
+        json.dump(doc, f)
+    os.replace(tmp_path, path)
+
+
+def _cached_documents(docs, out_dir, store, backend, misses, hits):
+    """The documents of `docs` that are not in `store`; the others are written to `out_dir` from it.
+
+    The (name, key) of every document is appended to `misses` or `hits`.
+    """
+    for name, text in docs:
+        key = hashlib.sha1(json.dumps([backend, text]).encode('utf-8')).hexdigest()
+        if (key in store):
+            _write_json(store.get(key), os.path.join(out_dir, '{}.json'.format(name)))
+            hits.append((name, key))
+        else:
+            misses.append((name, key))
+            yield name, text
+    logger.info('Tokenization cache: %d reused, %d to tokenize' % (len(hits), len(misses)))
+
+
+def tokenize_documents(docs, out_dir, txt_dir, backend='corenlp', n_workers=1, cache_dir=''):
+    """Tokenizes the (name, text) pairs of `docs` into `<out_dir>/<name>.json`.
+
+    `txt_dir` holds the text files the CoreNLP backend reads. With
+    `cache_dir` only texts that are not cached there are tokenized. Returns
+    the number of documents written, cached ones included.
+    """
+    assert backend in BACKENDS, backend
+    n_workers = max(n_workers, 1)
+    start = time.time()
+    misses, hits = [], []
+    if (cache_dir):
+        store = DocStore(os.path.join(cache_dir, 'tokens'))
+        docs = _cached_documents(docs, out_dir, store, backend, misses, hits)
+    print("Tokenizing into %s with %d %s worker(s)..." % (out_dir, n_workers, backend))
+    if (backend == 'python'):
+        logger.warning('The python tokenizer backend does not reproduce the sentence splits and tokens of CoreNLP; '
+                       'do not mix its output with CoreNLP-tokenized data')
+        stats = _tokenize_python(docs, out_dir, n_workers)
+    else:
+        stats = _tokenize_corenlp(docs, out_dir, txt_dir, n_workers)
+    if (cache_dir):
+        store.close()
+        writer = DocStoreWriter(os.path.join(cache_dir, 'tokens'))
+        for name, key in misses:
+            path = os.path.join(out_dir, '{}.json'.format(name))
+            if (os.path.exists(path)):
+                with open(path) as f:
+                    writer.add(key, json.load(f))
+        writer.close()
+        compact(os.path.join(cache_dir, 'tokens'))
+    return _report(stats, start, len(hits))
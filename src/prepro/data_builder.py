@@ -10,22 +10,28 @@ import random
 import pickle
 import re
 import math
-import subprocess
 import csv
 import shutil
-from collections import Counter
+from collections import Counter, deque, namedtuple
 from os.path import join as pjoin
 from zhon.hanzi import punctuation
+import numpy as np
 import torch
 from multiprocess import Pool
+from tokenizers import Tokenizer
+from tokenizers.models import WordPiece
 
 from others.logging import logger
 from others.tokenization import BertTokenizer
-from transformers import RobertaTokenizer, AutoTokenizer
+from transformers import RobertaTokenizer, RobertaTokenizerFast, AutoTokenizer
 from pytorch_transformers import XLNetTokenizer
 
+from others.columnar import ColumnarWriter, SUFFIX as COLUMNAR_SUFFIX
+from others.doc_store import DocStore, DocStoreWriter, compact
+from others.tag_store import TagStore, has_store
 from others.utils import clean
-from prepro.utils import _get_word_ngrams
+from prepro.corenlp import tokenize_documents
+from prepro.utils import NgramOracle
 
 import xml.etree.ElementTree as ET
 import pandas as pd
@@ -41,6 +47,64 @@ def recover_from_corenlp(s):
     s = re.sub(r'\'\' {\w}', '\'\'\g<1>', s)
 
 
+# The cleaning steps of `clean_json`, in order. Each step sees the output of the
+# previous one, so they cannot be merged into one pattern without changing the
+# result; compiling them once saves re-parsing them for every paragraph.
+_JSON_CLEAN_PATTERNS = [(re.compile(pattern), repl) for pattern, repl in [
+    ('\[[\d\s,]+?\]', ''), # matches references e.g. [12]
+    ('\(Table \d+?\)', ''), # matches table references e.g. (Table 1)
+    ('\(Fig. \d+?\)', ''), # matches fig references e.g. (Fig. 1)
+    ('(?<=[0-9]),(?=[0-9])', ''), # matches numbers seperated by commas
+    ('[^\x00-\x7f]+', r''), # strips non ascii
+    ('[\<\>]', r' '), # strips  <> tokens which are not compatable StanfordNLPtokenizer
+    ('(\([0-9]+\))(?= [0-9]+)', ' '), # removes numbers in brackets followed by another number are not compatable StanfordNLPtokenizer
+    ('[\n\r]', ' '), # replaces line breaks with blank spaces
+    (' +', ' '), # removes multipe blank spaces.
+    ('(?<=[0-9])( +)(?=[0-9])', ''), # matches numbers seperated by space and combines
+    ('(?<=\.)( +)(?=\.)', ''), # matches several full stops with one or more spaces in between and removes spaces
+]]
+
+# Same for `clean_text`, which works on lower cased sentences.
+_TEXT_CLEAN_PATTERNS = [(re.compile(pattern), repl) for pattern, repl in [
+    ('\[[\d\s\,]+?\]', ''),
+    ('\(table \d+?\)', ''),
+    ('\(fig. \d+?\)', ''),
+    ('[^\x00-\x7f]+', r''),
+    ('[\<\>]', r' '),
+    ('(\([0-9]+\))(?= [0-9]+)', ' '),
+    ('[\n\r]', ' '),
+    (' +', ' '),
+    ('(?<=[0-9])( +)(?=[0-9])', ''),
+    ('(?<=\.)( +)(?=\.)', ''),
+]]
+
+
+def _apply_patterns(text, patterns):
+    for pattern, repl in patterns:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def _blank_spans(text, spans):
+    """Replaces the characters of every (start, end) span of `text` with blanks."""
+    if not all(0 <= start <= end <= len(text) for start, end in spans):
+        # Spans past the end of the text grow it; keep the exact splice for those.
+        for start, end in spans:
+            text = text[:start] + ' ' * (end - start) + text[end:]
+        return text
+    pieces = []
+    pos = 0
+    for start, end in sorted(spans):
+        if end <= pos:
+            continue
+        start = max(start, pos)
+        pieces.append(text[pos:start])
+        pieces.append(' ' * (end - start))
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
 def clean_json(json_dict):
     #
     # how about bib? they also indicate what the paper is about in general
@@ -49,35 +113,31 @@ def clean_json(json_dict):
         title = json_dict['metadata']['title']
     except KeyError:
         title = 'NA'
-    text = ''
+    paragraphs = []
     for p in json_dict['body_text']:
-        p_text = p['text']
         if p['section'] == 'Pre-publication history':
             continue
         # remove references and citations from text
         citations = [*p['cite_spans'],*p['ref_spans']]
-        if len(citations):
-            for citation in citations:
-                cite_span_len = citation['end']-citation['start']
-                cite_span_replace = ' '*cite_span_len
-                p_text  = p_text[:citation['start']] + cite_span_replace  + p_text[citation['end']:]
-        # do other cleaning of text 
-        p_text = p_text.strip()
-        p_text = re.sub('\[[\d\s,]+?\]', '', p_text) # matches references e.g. [12]
-        p_text = re.sub('\(Table \d+?\)', '', p_text) # matches table references e.g. (Table 1)
-        p_text = re.sub('\(Fig. \d+?\)', '', p_text) # matches fig references e.g. (Fig. 1)
-        p_text = re.sub('(?<=[0-9]),(?=[0-9])', '', p_text) # matches numbers seperated by commas
-        p_text = re.sub('[^\x00-\x7f]+',r'', p_text) # strips non ascii
-        p_text = re.sub('[\<\>]',r' ', p_text) # strips  <> tokens which are not compatable StanfordNLPtokenizer
-        p_text = re.sub('(\([0-9]+\))(?= [0-9]+)',' ',p_text) # removes numbers in brackets followed by another number are not compatable StanfordNLPtokenizer
-        p_text = re.sub('\n',' ',p_text) # replaces line break with full stop
-        p_text = re.sub('\r',' ',p_text) # replaces line break with full stop
-        p_text = re.sub(' +',' ',p_text) # removes multipe blank spaces. 
-        p_text = re.sub('(?<=[0-9])( +)(?=[0-9])', '', p_text) # matches numbers seperated by space and combines
-        p_text = re.sub('(?<=\.)( +)(?=\.)', '', p_text) # matches several full stops with one or more spaces in between and removes spaces
-        text += '{:s}\n'.format(p_text)
-
-    return {'title': title, 'text': text}
+        p_text = _blank_spans(p['text'], [(citation['start'], citation['end']) for citation in citations])
+        # do other cleaning of text
+        paragraphs.append('{:s}\n'.format(_apply_patterns(p_text.strip(), _JSON_CLEAN_PATTERNS)))
+
+    return {'title': title, 'text': ''.join(paragraphs)}
+
+_tag_stores = {}
+
+
+def _load_tags(f_tag):
+    """Tags of `<doc>.tag.json`, read from the tag store of its directory if there is no such file."""
+    directory = os.path.dirname(f_tag)
+    if (os.path.exists(f_tag) or not has_store(directory)):
+        with open(f_tag, 'r') as f:
+            return json.load(f)
+    if (directory not in _tag_stores):
+        _tag_stores[directory] = TagStore(directory)
+    return _tag_stores[directory].get(os.path.basename(f_tag)[:-len('.tag.json')])
+
 
 def load_json(f_main, f_abs, f_tag):
     with open(f_main, 'r') as f:
@@ -95,8 +155,7 @@ def load_json(f_main, f_abs, f_tag):
         list(t['word'].lower() for t in sent['tokens'])
         for sent in json_abs['sentences']]
 
-        with open(f_tag, 'r') as f:
-            json_tag = json.load(f)
+        json_tag = _load_tags(f_tag)
         tag_tokens = []
         tag_tags = []
         sent_lengths = [len(val) for val in src_sent_tokens]
@@ -192,6 +251,19 @@ def load_xml(p):
         return None, None
 
 
+def _clean_pmc_file(params):
+    pmc_dir, pid = params
+    # read in pubmed file if available
+    ppath = os.path.join(pmc_dir, '{}.xml.json'.format(pid))
+    if not os.path.isfile(ppath):
+        return None
+    with open(ppath, 'r') as fi:
+        json_dict = json.load(fi)
+
+    # preprocess / clean file
+    return clean_json(json_dict)
+
+
 def tokenize_allenai_datasets(args):
     root_data_dir = os.path.abspath(args.raw_path)
     tokenized_data_dir = os.path.abspath(args.save_path)
@@ -226,77 +298,60 @@ def tokenize_allenai_datasets(args):
     print('Number of files once articles deduplicated: \t{}'.format(len_before)) # 56341 
     
     start = time.time()
-    print('... (1) Processing pubmed files into readable .txt format for tokenizer into path: {}...'.format(txt_dir))
-    
-    write_head = False
-
-    # write out new csv containing files we use in our dataset
-    with open(new_meta_path, 'w') as f:
-        w = csv.writer(f)
-        for i,row in tqdm(df.iterrows(),total=df.shape[0]):
-                
-            # read in pubmed file if available
-            pid = row['pmcid']
-            try:
-                pubtime = row['publish_time']
-            except KeyError: 
-                pubtime = row['year']
-            # pubtime = datetime.strptime(row['publish_time'], '%Y-%m-%d').timestamp()
-            ppath = os.path.join(pmc_dir, '{}.xml.json'.format(pid))
-            if not os.path.isfile(ppath):
-                no_path_counter +=1
-                continue
-            with open(ppath, 'r') as fi:
-                json_dict = json.load(fi)
-            
-            # preprocess / clean file
-            cleaned_dict = clean_json(json_dict)
-            tpath = os.path.join(txt_dir, '{}-{}.txt'.format(pubtime, pid))
-            tpath_abs = os.path.join(txt_dir, '{}-{}.abs.txt'.format(pubtime, pid))
-            
-            # write out main text and abstract 
-            with open(tpath, 'w') as fil:
-                fil.write(cleaned_dict['text'])
-            with open(tpath_abs, 'w') as fil:
-                fil.write(row['abstract'])
-            files_count_real += 1
-            
-            # write csv row
-            cleaned_dict['abstract'] = row['abstract']
-            if cleaned_dict['title'] == 'NA':
-                cleaned_dict['title'] = row['title']
-            if not write_head:
-                w.writerow(cleaned_dict.keys())
-                write_head = True       
-            w.writerow(cleaned_dict.values())
+    print('... (1) Cleaning pubmed files and tokenizing them into path: {}...'.format(tokenized_data_dir))
+
+    def _docs():
+        nonlocal files_count_real, no_path_counter
+        write_head = False
+        time_col = 'publish_time' if 'publish_time' in df.columns else 'year'
+        rows = [(pmc_dir, pid) for pid in df['pmcid']]
+        clean_start = time.time()
+        pool = Pool(args.n_cpus)
+
+        # write out new csv containing files we use in our dataset
+        with open(new_meta_path, 'w') as f:
+            w = csv.writer(f)
+            # read in and clean the pubmed files in parallel, keeping the order of the metadata
+            cleaned = pool.imap(_clean_pmc_file, rows, chunksize=64)
+            for (i, row), cleaned_dict in tqdm(zip(df.iterrows(), cleaned), total=df.shape[0]):
+                pid = row['pmcid']
+                pubtime = row[time_col]
+                # pubtime = datetime.strptime(row['publish_time'], '%Y-%m-%d').timestamp()
+                if cleaned_dict is None:
+                    no_path_counter +=1
+                    continue
+
+                # hand main text and abstract to the tokenizer
+                yield '{}-{}.txt'.format(pubtime, pid), cleaned_dict['text']
+                yield '{}-{}.abs.txt'.format(pubtime, pid), row['abstract']
+                files_count_real += 1
+
+                # write csv row
+                cleaned_dict['abstract'] = row['abstract']
+                if cleaned_dict['title'] == 'NA':
+                    cleaned_dict['title'] = row['title']
+                if not write_head:
+                    w.writerow(cleaned_dict.keys())
+                    write_head = True
+                w.writerow(cleaned_dict.values())
+        pool.close()
+        pool.join()
+        elapsed = time.time() - clean_start
+        logger.info('Cleaned %d documents in %.1fs (%.1f docs/s)'
+                    % (files_count_real, elapsed, files_count_real / max(elapsed, 1e-6)))
+
+    print("Preparing to tokenize %s to %s..." % (root_data_dir, tokenized_data_dir))
+    tokenize_documents(_docs(), tokenized_data_dir, txt_dir, args.tokenizer_backend, args.n_cpus,
+                       args.doc_cache)
+    print("Tokenizer has finished.")
 
     end = time.time()
     print('Real count for files with abstract: {} ({}%)'.format(files_count_real,files_count_real / len_before * 100))
     print('... Ending (1), time elapsed {}'.format(end - start))
 
-    print("Preparing to tokenize %s to %s..." % (root_data_dir, tokenized_data_dir))
-    num_files_to_tokenize = 0
-    # make IO list file
-    print("Making list of files to tokenize...")
-    with open('mapping_for_corenlp.txt', 'w') as fi:
-        for fname in os.listdir(txt_dir):
-            fpath = os.path.join(txt_dir, fname)
-            fi.write('{}\n'.format(fpath))
-            num_files_to_tokenize+=1
-
-    command = ['java', 'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators', 'tokenize,ssplit',
-               '-ssplit.newlineIsSentenceBreak', 'always', '-filelist', 'mapping_for_corenlp.txt', '-outputFormat',
-               'json', '-outputDirectory', tokenized_data_dir]
-
-    print("Tokenizing %i files in %s and saving in %s..." % (num_files_to_tokenize, txt_dir, tokenized_data_dir))
-    subprocess.call(command)
-    print("Stanford CoreNLP Tokenizer has finished.")
-    os.remove("mapping_for_corenlp.txt")
-    
-
-    # Check that the tokenized data directory contains the same number of files as the original directory
-    num_orig = len(os.listdir(txt_dir))
-    num_tokenized = len(os.listdir(tokenized_data_dir))
+    # Check that the tokenizer wrote a json file for every text it was given
+    num_orig = 2 * files_count_real
+    num_tokenized = len([fname for fname in os.listdir(tokenized_data_dir) if not fname.startswith('.')])
     if num_orig != num_tokenized:
         raise Exception(
             "The tokenized data directory %s contains %i files, but it should contain the same number as %s (which has %i files). Was there an error during tokenization?" % (
@@ -305,34 +360,13 @@ def tokenize_allenai_datasets(args):
     shutil.rmtree(txt_dir)
 
 def clean_abstract(text_array):
-    abstract = ''
-    for sentence in text_array:
-        sentence = sentence.replace("<S>","")
-        sentence = sentence.replace("</S>","")
-        abstract += sentence
-    return abstract
+    return ''.join([sentence.replace("<S>","").replace("</S>","") for sentence in text_array])
 
 
 def clean_text(doc):
-    text = ''
-    for paragraph in doc:
-        for sentence in paragraph:
-            # do other cleaning of text 
-            sentence = sentence.strip()
-            sentence = re.sub('\[[\d\s\,]+?\]', '', sentence) # matches references e.g. [12]
-            sentence = re.sub('\(table \d+?\)', '', sentence) # matches table references e.g. (Table 1)
-            sentence = re.sub('\(fig. \d+?\)', '', sentence) # matches fig references e.g. (Fig. 1)
-            sentence = re.sub('[^\x00-\x7f]+',r'', sentence) # strips non ascii
-            sentence = re.sub('[\<\>]',r' ', sentence) # strips  <> tokens which are not compatable StanfordNLPtokenizer
-            sentence = re.sub('(\([0-9]+\))(?= [0-9]+)',' ',sentence) # removes numbers in brackets followed by another number are not compatable StanfordNLPtokenizer
-            sentence = re.sub('\n',' ',sentence) # replaces line break with full stop
-            sentence = re.sub('\r',' ',sentence) # replaces line break with full stop
-            sentence = re.sub(' +',' ',sentence) # removes multipe blank spaces. 
-            sentence = re.sub('(?<=[0-9])( +)(?=[0-9])', '', sentence) # matches numbers seperated by space and combines
-            sentence = re.sub('(?<=\.)( +)(?=\.)', '', sentence) # matches several full stops with one or more spaces in between and removes spaces
-            text += '{:s}\n'.format(sentence)
-
-    return text
+    # do other cleaning of text
+    return ''.join(['{:s}\n'.format(_apply_patterns(sentence.strip(), _TEXT_CLEAN_PATTERNS))
+                    for paragraph in doc for sentence in paragraph])
 
 
 
@@ -361,70 +395,53 @@ def tokenize_pubmed_dataset(args):
         len_before = df.shape[0]
         
         start = time.time()
-        print('... (1) Processing pubmed files into readable .txt format for tokenizer into path: {}...'.format(txt_dir))
-        
-        # write out new csv containing files we use in our dataset
-        pid = 0
+        print('... (1) Cleaning pubmed files and tokenizing them into path: {}...'.format(tokenized_data_dir))
+
         labels = []
-        for i,row in tqdm(df.iterrows(),total=df.shape[0]):
-                
-            # read in pubmed file if available
-        
-            # preprocess / clean file
-            try:
-               label =  row['label']
-            except KeyError:
-                label = []
-            cleaned_text = clean_abstract(row['text'])
-            tpath = os.path.join(txt_dir, '{}.txt'.format(pid))
-            tpath_abs = os.path.join(txt_dir, '{}.abs.txt'.format(pid))
-            # preprocess/ clean abstract
-            abstract = clean_abstract(row['summary'])
-            #print(row)
-            labels.append(label)
-            #print('text:', cleaned_text)
-            #print('summary:', abstract)
-        
-            # write out main text and abstract 
-            with open(tpath, 'w') as fil:
-                fil.write(cleaned_text)
-            with open(tpath_abs, 'w') as fil:
-                fil.write(abstract)
-            files_count_real += 1
-            pid += 1
+
+        def _docs():
+            nonlocal files_count_real
+            pid = 0
+            for i,row in tqdm(df.iterrows(),total=df.shape[0]):
+
+                # read in pubmed file if available
+
+                # preprocess / clean file
+                try:
+                   label =  row['label']
+                except KeyError:
+                    label = []
+                cleaned_text = clean_abstract(row['text'])
+                # preprocess/ clean abstract
+                abstract = clean_abstract(row['summary'])
+                #print(row)
+                labels.append(label)
+                #print('text:', cleaned_text)
+                #print('summary:', abstract)
+
+                # hand main text and abstract to the tokenizer
+                yield '{}.txt'.format(pid), cleaned_text
+                yield '{}.abs.txt'.format(pid), abstract
+                files_count_real += 1
+                pid += 1
+
+        print("Preparing to tokenize %s to %s..." % (root_data_dir, tokenized_data_dir))
+        tokenize_documents(_docs(), tokenized_data_dir, txt_dir, args.tokenizer_backend, args.n_cpus,
+                           args.doc_cache)
+        print("Tokenizer has finished.")
 
         pic_path = os.path.join(args.save_path, '{}.pkl'.format(dirs_rename[idx]))
         with open(pic_path, 'wb') as f:
             pickle.dump(labels, f)
 
         end = time.time()
-    
+
         print('Real count for files with abstract: {} ({}%)'.format(files_count_real,files_count_real / len_before * 100))
         print('... Ending (1), time elapsed {}'.format(end - start))
 
-        print("Preparing to tokenize %s to %s..." % (root_data_dir, tokenized_data_dir))
-        num_files_to_tokenize = 0
-        # make IO list file
-        print("Making list of files to tokenize...")
-        with open('mapping_for_corenlp.txt', 'w') as fi:
-            for fname in os.listdir(txt_dir):
-                fpath = os.path.join(txt_dir, fname)
-                fi.write('{}\n'.format(fpath))
-                num_files_to_tokenize+=1
-
-        command = ['java', 'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators', 'tokenize,ssplit',
-                '-ssplit.newlineIsSentenceBreak', 'always', '-filelist', 'mapping_for_corenlp.txt', '-outputFormat',
-                'json', '-outputDirectory', tokenized_data_dir]
-
-        print("Tokenizing %i files in %s and saving in %s..." % (num_files_to_tokenize, txt_dir, tokenized_data_dir))
-        subprocess.call(command)
-        print("Stanford CoreNLP Tokenizer has finished.")
-        os.remove("mapping_for_corenlp.txt")
-        
-
         # Check that the tokenized data directory contains the same number of files as the original directory
-        num_orig = len(os.listdir(txt_dir))
-        num_tokenized = len(os.listdir(tokenized_data_dir))
+        #num_orig = len(os.listdir(txt_dir))
+        #num_tokenized = len(os.listdir(tokenized_data_dir))
         #if num_orig != num_tokenized:
         #    raise Exception(
         #        "The tokenized data directory %s contains %i files, but it should contain the same number as %s (which has %i files). Was there an error during tokenization?" % (
@@ -456,39 +473,10 @@ def greedy_selection(doc_sent_list, abstract_sent_list, summary_size):
     def _rouge_clean(s):
         return re.sub(r'[^a-zA-Z0-9 ]', '', s)
 
-    max_rouge = 0.0
     abstract = sum(abstract_sent_list, [])
     abstract = _rouge_clean(' '.join(abstract)).split()
     sents = [_rouge_clean(' '.join(s)).split() for s in doc_sent_list]
-    evaluated_1grams = [_get_word_ngrams(1, [sent]) for sent in sents]
-    reference_1grams = _get_word_ngrams(1, [abstract])
-    evaluated_2grams = [_get_word_ngrams(2, [sent]) for sent in sents]
-    reference_2grams = _get_word_ngrams(2, [abstract])
-
-    selected = []
-    for s in range(summary_size):
-        cur_max_rouge = max_rouge
-        cur_id = -1
-        for i in range(len(sents)):
-            if (i in selected):
-                continue
-            c = selected + [i]
-            candidates_1 = [evaluated_1grams[idx] for idx in c]
-            candidates_1 = set.union(*map(set, candidates_1))
-            candidates_2 = [evaluated_2grams[idx] for idx in c]
-            candidates_2 = set.union(*map(set, candidates_2))
-            rouge_1 = cal_rouge(candidates_1, reference_1grams)['f']
-            rouge_2 = cal_rouge(candidates_2, reference_2grams)['f']
-            rouge_score = rouge_1 + rouge_2
-            if rouge_score > cur_max_rouge:
-                cur_max_rouge = rouge_score
-                cur_id = i
-        if (cur_id == -1):
-            return selected
-        selected.append(cur_id)
-        max_rouge = cur_max_rouge
-
-    return sorted(selected)
+    return NgramOracle(sents, abstract).select(summary_size)
 
 
 def hashhex(s):
@@ -498,7 +486,105 @@ def hashhex(s):
     return h.hexdigest()
 
 
-class RoBertData():
+def _select_sentences(args, src, sent_labels, is_test):
+    """The sentence filtering of `*Data.preprocess` and `preprocess_batch`, before tokenization.
+
+    Returns (src, sent_labels, src_txt) or None if the document is dropped.
+    """
+    if ((not is_test) and len(src) == 0):
+        return None
+
+    original_src_txt = [' '.join(s) for s in src]
+
+    idxs = [i for i, s in enumerate(src) if (len(s) > args.min_src_ntokens_per_sent)]
+
+    _sent_labels = [0] * len(src)
+    for l in sent_labels:
+        _sent_labels[l] = 1
+
+    src = [src[i][:args.max_src_ntokens_per_sent] for i in idxs]
+    sent_labels = [_sent_labels[i] for i in idxs]
+    src = src[:args.max_src_nsents]
+    sent_labels = sent_labels[:args.max_src_nsents]
+
+    if ((not is_test) and len(src) < args.min_src_nsents):
+        return None
+
+    return src, sent_labels, [original_src_txt[i] for i in idxs]
+
+
+_EMPTY_ENCODING = namedtuple('Encoding', ['ids', 'tokens'])([], [])
+
+
+class BatchTokenizeMixin(object):
+    """Batched `preprocess` for the `*Data` classes.
+
+    `preprocess_batch` pushes the sources of a whole chunk of documents
+    through a Rust-backed fast tokenizer in one call, and their target
+    sentences in a second one, then builds ids, segments and cls positions
+    as `preprocess` does. `check_tokenize` compares the two over a corpus.
+    """
+
+    def _can_batch(self, use_bert_basic_tokenizer):
+        return True
+
+    def _fast_tokenizer(self):
+        # AutoTokenizer already returns the fast tokenizer.
+        return self.tokenizer
+
+    def _encode(self, texts):
+        if not texts:
+            return []
+        return self._fast_tokenizer()(texts, add_special_tokens=False).encodings
+
+    def _segments(self, src_subtoken_idxs):
+        # Alternate 0/1 per sentence, each sentence ending with its [SEP].
+        is_sep = np.asarray(src_subtoken_idxs) == self.sep_vid
+        return ((np.cumsum(is_sep) - is_sep) % 2).tolist()
+
+    def _tgt_subtokens(self, sent_subtokens):
+        return ('[unused0] ' + ' [unused2] '.join([' '.join(tt) for tt in sent_subtokens]) + ' [unused1]').split()
+
+    def preprocess_batch(self, docs, use_bert_basic_tokenizer=False, is_test=False):
+        """`preprocess` of every (src, tgt, sent_labels) in `docs`, in order."""
+        if (not self._can_batch(use_bert_basic_tokenizer)):
+            return [self.preprocess(src, tgt, sent_labels, use_bert_basic_tokenizer=use_bert_basic_tokenizer,
+                                    is_test=is_test) for src, tgt, sent_labels in docs]
+        return self._preprocess_batch(docs, is_test)
+
+    def _preprocess_batch(self, docs, is_test):
+        selected = [_select_sentences(self.args, src, sent_labels, is_test) for src, _, sent_labels in docs]
+        sep = ' {} {} '.format(self.sep_token, self.cls_token)
+        src_encodings = iter(self._encode([sep.join([' '.join(sent) for sent in s[0]])
+                                           for s in selected if s is not None]))
+        tgt_encodings = iter(self._encode([' '.join(tt) for (_, tgt, _), s in zip(docs, selected)
+                                           if s is not None for tt in tgt]))
+
+        results = []
+        for (_, tgt, _), s in zip(docs, selected):
+            if (s is None):
+                results.append(None)
+                continue
+            src, sent_labels, src_txt = s
+            src_subtoken_idxs = [self.cls_vid] + list(next(src_encodings).ids) + [self.sep_vid]
+            segments_ids = self._segments(src_subtoken_idxs)
+            cls_ids = np.flatnonzero(np.asarray(src_subtoken_idxs) == self.cls_vid).tolist()
+            sent_labels = sent_labels[:len(cls_ids)]
+
+            tgt_subtoken = self._tgt_subtokens([next(tgt_encodings).tokens for _ in tgt])
+            tgt_subtoken = tgt_subtoken[:self.args.max_tgt_ntokens]
+            if ((not is_test) and len(tgt_subtoken) < self.args.min_tgt_ntokens):
+                results.append(None)
+                continue
+
+            tgt_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(tgt_subtoken)
+            tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
+            results.append((src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt,
+                            tgt_txt))
+        return results
+
+
+class RoBertData(BatchTokenizeMixin):
     def __init__(self, args):
         self.args = args
         self.tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
@@ -516,27 +602,25 @@ class RoBertData():
         self.tgt_bos_vid = self.tokenizer.convert_tokens_to_ids(self.tgt_bos)
         self.tgt_eos_vid = self.tokenizer.convert_tokens_to_ids(self.tgt_eos)
         self.tgt_sent_split_vid = self.tokenizer.convert_tokens_to_ids(self.tgt_sent_split)
+        self.fast_tokenizer = None
 
-    def preprocess(self, src, tgt, sent_labels, use_bert_basic_tokenizer=False, is_test=False):
+    def _fast_tokenizer(self):
+        if (self.fast_tokenizer is None):
+            self.fast_tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
+        return self.fast_tokenizer
 
-        if ((not is_test) and len(src) == 0):
-            return None
-
-        original_src_txt = [' '.join(s) for s in src]
-
-        idxs = [i for i, s in enumerate(src) if (len(s) > self.args.min_src_ntokens_per_sent)]
+    def _segments(self, src_subtoken_idxs):
+        return [0] * len(src_subtoken_idxs)
 
-        _sent_labels = [0] * len(src)
-        for l in sent_labels:
-            _sent_labels[l] = 1
+    def _tgt_subtokens(self, sent_subtokens):
+        return ('<s>' + ' </s>'.join([' '.join(tt) for tt in sent_subtokens]) + ' </s>').split()
 
-        src = [src[i][:self.args.max_src_ntokens_per_sent] for i in idxs]
-        sent_labels = [_sent_labels[i] for i in idxs]
-        src = src[:self.args.max_src_nsents]
-        sent_labels = sent_labels[:self.args.max_src_nsents]
+    def preprocess(self, src, tgt, sent_labels, use_bert_basic_tokenizer=False, is_test=False):
 
-        if ((not is_test) and len(src) < self.args.min_src_nsents):
+        selected = _select_sentences(self.args, src, sent_labels, is_test)
+        if (selected is None):
             return None
+        src, sent_labels, original_src_txt = selected
 
         src_txt = [' '.join(sent) for sent in src]
         text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
@@ -565,11 +649,11 @@ class RoBertData():
         tgt_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(tgt_subtoken)
 
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
-        src_txt = [original_src_txt[i] for i in idxs]
+        src_txt = original_src_txt
 
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt
 
-class BertData():
+class BertData(BatchTokenizeMixin):
     def __init__(self, args):
         self.args = args
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
@@ -582,27 +666,28 @@ class BertData():
         self.sep_vid = self.tokenizer.vocab[self.sep_token]
         self.cls_vid = self.tokenizer.vocab[self.cls_token]
         self.pad_vid = self.tokenizer.vocab[self.pad_token]
+        self.wordpiece = None
+
+    def _can_batch(self, use_bert_basic_tokenizer):
+        return not use_bert_basic_tokenizer
+
+    def _encode(self, texts):
+        # `tokenize` splits on whitespace only and word-pieces each word, which
+        # is a plain WordPiece model over pre-split words.
+        if (self.wordpiece is None):
+            self.wordpiece = Tokenizer(WordPiece(dict(self.tokenizer.vocab), unk_token='[UNK]',
+                                                 max_input_chars_per_word=100))
+        words = [text.split() for text in texts]
+        encodings = iter(self.wordpiece.encode_batch([w for w in words if w], is_pretokenized=True,
+                                                     add_special_tokens=False) if any(words) else [])
+        return [next(encodings) if w else _EMPTY_ENCODING for w in words]
 
     def preprocess(self, src, tgt, sent_labels, use_bert_basic_tokenizer=False, is_test=False):
 
-        if ((not is_test) and len(src) == 0):
-            return None
-
-        original_src_txt = [' '.join(s) for s in src]
-
-        idxs = [i for i, s in enumerate(src) if (len(s) > self.args.min_src_ntokens_per_sent)]
-
-        _sent_labels = [0] * len(src)
-        for l in sent_labels:
-            _sent_labels[l] = 1
-
-        src = [src[i][:self.args.max_src_ntokens_per_sent] for i in idxs]
-        sent_labels = [_sent_labels[i] for i in idxs]
-        src = src[:self.args.max_src_nsents]
-        sent_labels = sent_labels[:self.args.max_src_nsents]
-
-        if ((not is_test) and len(src) < self.args.min_src_nsents):
+        selected = _select_sentences(self.args, src, sent_labels, is_test)
+        if (selected is None):
             return None
+        src, sent_labels, original_src_txt = selected
 
         src_txt = [' '.join(sent) for sent in src]
         text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
@@ -631,11 +716,11 @@ class BertData():
         tgt_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(tgt_subtoken)
 
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
-        src_txt = [original_src_txt[i] for i in idxs]
+        src_txt = original_src_txt
 
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt
 
-class PubmedData():
+class PubmedData(BatchTokenizeMixin):
     def __init__(self, args):
         self.args = args
         model_name = 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract'
@@ -652,24 +737,10 @@ class PubmedData():
 
     def preprocess(self, src, tgt, sent_labels, use_bert_basic_tokenizer=False, is_test=False):
 
-        if ((not is_test) and len(src) == 0):
-            return None
-
-        original_src_txt = [' '.join(s) for s in src]
-
-        idxs = [i for i, s in enumerate(src) if (len(s) > self.args.min_src_ntokens_per_sent)]
-
-        _sent_labels = [0] * len(src)
-        for l in sent_labels:
-            _sent_labels[l] = 1
-
-        src = [src[i][:self.args.max_src_ntokens_per_sent] for i in idxs]
-        sent_labels = [_sent_labels[i] for i in idxs]
-        src = src[:self.args.max_src_nsents]
-        sent_labels = sent_labels[:self.args.max_src_nsents]
-
-        if ((not is_test) and len(src) < self.args.min_src_nsents):
+        selected = _select_sentences(self.args, src, sent_labels, is_test)
+        if (selected is None):
             return None
+        src, sent_labels, original_src_txt = selected
 
         src_txt = [' '.join(sent) for sent in src]
         text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
@@ -701,11 +772,11 @@ class PubmedData():
         tgt_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(tgt_subtoken)
 
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
-        src_txt = [original_src_txt[i] for i in idxs]
+        src_txt = original_src_txt
 
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt
 
-class BioBertData():
+class BioBertData(BatchTokenizeMixin):
     def __init__(self, args):
         self.args = args
         model_name = 'dmis-lab/biobert-v1.1'
@@ -722,24 +793,10 @@ class BioBertData():
 
     def preprocess(self, src, tgt, sent_labels, use_bert_basic_tokenizer=False, is_test=False):
 
-        if ((not is_test) and len(src) == 0):
-            return None
-
-        original_src_txt = [' '.join(s) for s in src]
-
-        idxs = [i for i, s in enumerate(src) if (len(s) > self.args.min_src_ntokens_per_sent)]
-
-        _sent_labels = [0] * len(src)
-        for l in sent_labels:
-            _sent_labels[l] = 1
-
-        src = [src[i][:self.args.max_src_ntokens_per_sent] for i in idxs]
-        sent_labels = [_sent_labels[i] for i in idxs]
-        src = src[:self.args.max_src_nsents]
-        sent_labels = sent_labels[:self.args.max_src_nsents]
-
-        if ((not is_test) and len(src) < self.args.min_src_nsents):
+        selected = _select_sentences(self.args, src, sent_labels, is_test)
+        if (selected is None):
             return None
+        src, sent_labels, original_src_txt = selected
 
         src_txt = [' '.join(sent) for sent in src]
         text = ' {} {} '.format(self.sep_token, self.cls_token).join(src_txt)
@@ -769,14 +826,107 @@ class BioBertData():
         tgt_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(tgt_subtoken)
 
         tgt_txt = '<q>'.join([' '.join(tt) for tt in tgt])
-        src_txt = [original_src_txt[i] for i in idxs]
+        src_txt = original_src_txt
 
         return src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt
 
-class PicoAdapterData():
+
+_PICO_DELETE = str.maketrans("", "", string.punctuation + "‘" + "’" + "‐" + '‑' + '”' + punctuation)
+_PICO_ZH = re.compile(u'[\u4e00-\u9fa5]+')
+_PICO_TAGS = {'O': 0, "I-INT": 1, "I-PAR": 2, "I-OUT": 3}
+
+
+class PicoAlignMixin(object):
+    """`preprocess` of the `Pico*AdapterData` classes.
+
+    Source words are normalized once per distinct word, sentences joined
+    with `sep_token cls_token` and each document tokenized without padding.
+    Every subtoken takes the tag of the word its character offsets fall in,
+    special tokens and the sentence separators are tagged 'O'.
+    """
+    empty_word = '[UNK]'
+    cjk_word = '[UNK]'
+    max_length = None
+    with_token_type_ids = True
+
+    def _normalize_word(self, token):
+        if (token.startswith("http")):
+            word = "http"
+        elif (len(token) > 1):
+            word = token.translate(_PICO_DELETE)
+        else:
+            word = token
+        if (word == ""):
+            word = self.empty_word
+        if (token.startswith("www")):
+            word = "www"
+        if (_PICO_ZH.search(token)):
+            word = self.cjk_word
+        return word
+
+    def _doc_words(self, doc, doc_tags, cache):
+        words, tags = [], []
+        aligned = True
+        for sent, sent_tags in zip(doc, doc_tags):
+            if (words):
+                words += [self.sep_token, self.cls_token]
+                tags += [0, 0]
+            for token in sent:
+                word = cache.get(token)
+                if (word is None):
+                    word = cache[token] = self._normalize_word(token)
+                words.append(word)
+            if (len(sent_tags) != len(sent)):
+                aligned = False
+                sent_tags = (list(sent_tags) + ['O'] * len(sent))[:len(sent)]
+            tags += [_PICO_TAGS[t] for t in sent_tags]
+        return words, tags, aligned
+
+    def preprocess(self, src, tag, is_test=False):
+        src_filt, tag_filt = [], []
+        for d, d_tag in zip(src, tag):
+            idxs = [j for j, s in enumerate(d) if len(s) > self.args.min_src_ntokens_per_sent]
+            if (self.args.min_src_nsents < len(idxs)):
+                idxs = idxs[:self.args.max_src_nsents]
+                src_filt.append([d[j][:self.args.max_src_ntokens_per_sent] for j in idxs])
+                tag_filt.append([d_tag[j][:self.args.max_src_ntokens_per_sent] for j in idxs])
+
+        cache = {}
+        docs = [self._doc_words(d, d_tag, cache) for d, d_tag in zip(src_filt, tag_filt)]
+        kwargs = {} if self.max_length is None else {'max_length': self.max_length}
+        encodings = self.tokenizer([' '.join(words) for words, _, _ in docs], truncation=True,
+                                   return_offsets_mapping=True, **kwargs).encodings
+
+        data = []
+        for (words, tags, _), enc in zip(docs, encodings):
+            starts = np.cumsum([0] + [len(w) + 1 for w in words[:-1]])
+            offsets = np.asarray(enc.offsets, dtype=np.int64).reshape(-1, 2)
+            word_ids = np.searchsorted(starts, offsets[:, 0], side='right') - 1
+            # Tokens covering no characters (<s>, [CLS], ...) point past the last word, at 'O'.
+            word_ids[offsets[:, 1] <= offsets[:, 0]] = len(words)
+            tag_id = np.asarray(tags + [0], dtype=np.int64)[word_ids]
+            mask = tag_id != 0
+            src_orig = list(enc.ids)
+            ex = {"src": np.where(mask, self.mask_vid, src_orig).tolist(), "tag": tag_id.tolist(),
+                  "mask": mask.astype(np.float64).tolist(), "src_orig": src_orig}
+            if (self.with_token_type_ids):
+                ex["token_type_ids"] = list(enc.type_ids)
+            data.append(ex)
+        n_mismatch = sum(not aligned for _, _, aligned in docs)
+        if (n_mismatch):
+            logger.warning('%d of %d documents have sentences with a different number of tags and tokens'
+                           % (n_mismatch, len(docs)))
+        return data
+
+
+class PicoAdapterData(PicoAlignMixin):
+    empty_word = '.'
+    cjk_word = '<unk>'
+    with_token_type_ids = False
+
     def __init__(self, args):
         self.args = args
-        self.tokenizer = RobertaTokenizer.from_pretrained("roberta-base")
+        self.tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
 
         #BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
 
@@ -795,140 +945,12 @@ class PicoAdapterData():
         self.tgt_sent_split_vid = self.tokenizer.convert_tokens_to_ids(self.tgt_sent_split)
         self.mask_vid = self.tokenizer.convert_tokens_to_ids(self.mask_token)
 
-    def preprocess(self, src, tag, is_test=False):
 
-        idxs = []
-        new_src = []
-        new_tag = []
-        for i, d in enumerate(src):
-            new_src.append([])
-            new_tag.append([])
-            for j, s in enumerate(d):
-                #assert len(s)==len(tag[i][j]),(len(s),len(tag[i][j]))
-                if len(s) > self.args.min_src_ntokens_per_sent:
-                    new_src[-1].append(s[:self.args.max_src_ntokens_per_sent])
-                    new_tag[-1].append(tag[i][j][:self.args.max_src_ntokens_per_sent])
-        #print(len(new_tag))
-    
-        src_filt = [d[:self.args.max_src_nsents][:] for d in new_src if self.args.min_src_nsents < len(d)]
-        tag_filt = [d_tag[:self.args.max_src_nsents][:] for d_tag in new_tag if self.args.min_src_nsents < len(d_tag)]
-        print(len(src_filt), len(src_filt[0]))
-
-        src_txt = []
-        trans = str.maketrans("", "", string.punctuation + "‘" + "’" + "‐" + '‑' + '”')
-        chin_trans = str.maketrans("", "", punctuation)
-        zhPattern = re.compile(u'[\u4e00-\u9fa5]+')
-        # anotrans = str.maketrans("", "", "’")
-        for d in src_filt:
-            temp = []
-            for sent in d:
-                temp_s = sent
-                for index, each_token in enumerate(sent):
-                    if each_token.startswith("http"):
-                        temp_s[index] = "http"
-                    elif len(each_token) > 1:
-                        temp_s[index] = each_token.translate(trans)
-                        temp_s[index] = temp_s[index].translate(chin_trans)
-                    if temp_s[index] == "":
-                        temp_s[index] = "."
-                    if each_token.startswith("www"):
-                        temp_s[index] = "www"
-                    if zhPattern.search(each_token):
-                        temp_s[index] = "<unk>"
-                        # temp_s[index] = temp_s[index].translate(anotrans)
-                temp.append(' '.join(temp_s))
-            src_txt.append(temp)
-        #src_txt = [' '.join(sent) for d in src for sent in d]
-        #print(len(src_txt))
-
-        text = [' {} {} '.format(self.sep_token, self.cls_token).join(d) for d in src_txt]
-        #print(len(text))
-        #text = ['{} '.format(self.cls_token) + d + ' {}'.format(self.sep_token) for d in text]
-        #print(len(text))
-        tags = []
-        for i, t in enumerate(tag_filt):
-            temp = []
-            temp.append('O')
-            for tag_list in t:
-                for tag in tag_list:
-                    temp.append(tag)
-                temp.append('O')
-                temp.append('O')
-            temp = temp[:-2]
-            temp.append('O')
-            tags.append(temp)
-            #assert len(text[i].split())==len(temp), (i, len(text[i].split()),len(temp))
-
-        src_encoding = self.tokenizer(text,truncation=True,padding=True)
-
-        src_subtoken_idxs = src_encoding['input_ids']
-        src_subtoken_origin_idxs = src_subtoken_idxs
-        #print(len(src_subtoken_idxs), len(src_subtoken_idxs[0]))
-        src_subtokens = [self.tokenizer.convert_ids_to_tokens(idx) for idx in src_subtoken_idxs]
-        #print(text[3].split()[:10])
-        #print(src_subtokens[3][:50])
-        tag_align = []
-        for i, subtoken in enumerate(src_subtokens):
-            print(len(subtoken))
-            aligned_labels = ["O"] * len(subtoken)
-            head = 0
-            count = 0
-            subtoken[1] = "Ġ" + subtoken[1] 
-            temp_src = text[i].split("</s>")
-            temp = " ".join([val for val in subtoken if val != '<pad>'])
-            temp = temp.split("</s>")
-            #print("last temp:", temp[-1])
-            for j, temp_sent in enumerate(temp):
-                if j < len(temp)-1:
-                    temp_s = temp_sent.split()
-                    temp_sent_filt = [filt for filt in temp_s if filt.startswith("Ġ")]
-                    if len(temp_sent_filt)-1!=len(temp_src[j].split()):
-                        print(i,j,len(temp_sent_filt)-1,len(temp_src[j].split()), temp_s,temp[j+1], temp_src[j].split())
-            #assert len(tags[i])==len([val for val in subtoken if val.startswith("Ġ") and val !='<pad>']),(i, len(tags[i]),len([val for val in subtoken if val.startswith("Ġ") and val !='<pad>']))
-            for j, each_str in enumerate(subtoken):
-                #print(i, each_str, head, count)
-                if each_str != "<pad>":
-                    if j==0 or "Ġ" in each_str:
-                        aligned_labels[head] = tags[i][count]
-                        count += 1
-                        head += 1
-                    else:
-                        aligned_labels[head] = tags[i][count-1]
-                        head += 1
-                else:
-                    break
-            tag_align.append(aligned_labels)
-        #print(head, len(src_subtokens), count, len(tags))
-        #src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
-        tag_dict = {'O':0, "I-INT":1, "I-PAR": 2, "I-OUT": 3}
-        tag_id = []
-        for tag_list in tag_align:
-            temp = []
-            for tag in tag_list:
-                temp.append(int(tag_dict[tag]))
-            tag_id.append(temp)
-        mask_label = []
-        for i, tag_list in enumerate(tag_align):
-            temp = []
-            for j,tag in enumerate(tag_list):
-                if tag == "O":
-                    temp.append(0.0)
-                else:
-                    src_subtoken_idxs[i][j] = self.mask_vid
-                    temp.append(1.0)
-            #print(len(temp))
-            mask_label.append(temp)
-        data = []
-        for i in range(len(mask_label)):
-            data.append({"src": src_subtoken_idxs[i], "tag": tag_id[i], "mask": mask_label[i], "src_orig":src_subtoken_origin_idxs[i]})
-        return data
-
-
-class PicoBertAdapterData():
+class PicoBertAdapterData(PicoAlignMixin):
     def __init__(self, args):
         self.args = args
-        from transformers import BertTokenizer
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased",do_lower_case=True)
+        from transformers import BertTokenizerFast
+        self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased",do_lower_case=True)
 
         # BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
 
@@ -942,142 +964,10 @@ class PicoBertAdapterData():
         self.mask_token = '[MASK]'
         self.mask_vid = self.tokenizer.convert_tokens_to_ids(self.mask_token)
 
-    def preprocess(self, src, tag, is_test=False):
 
-        idxs = []
-        new_src = []
-        new_tag = []
-        for i, d in enumerate(src):
-            new_src.append([])
-            new_tag.append([])
-            for j, s in enumerate(d):
-                # assert len(s)==len(tag[i][j]),(len(s),len(tag[i][j]))
-                if len(s) > self.args.min_src_ntokens_per_sent:
-                    new_src[-1].append(s[:self.args.max_src_ntokens_per_sent])
-                    new_tag[-1].append(tag[i][j][:self.args.max_src_ntokens_per_sent])
-        # print(len(new_tag))
-
-        src_filt = [d[:self.args.max_src_nsents][:] for d in new_src if self.args.min_src_nsents < len(d)]
-        tag_filt = [d_tag[:self.args.max_src_nsents][:] for d_tag in new_tag if self.args.min_src_nsents < len(d_tag)]
-        #print (tag_filt[0], len(tag_filt))
-        print(len(src_filt), len(src_filt[0]), src_filt[0][0])
-        src_txt = []
-        trans = str.maketrans("", "", string.punctuation+"‘"+"’"+"‐"+'‑'+'”')
-        chin_trans = str.maketrans("", "", punctuation)
-        zhPattern = re.compile(u'[\u4e00-\u9fa5]+')
-        #anotrans = str.maketrans("", "", "’")
-        for d in src_filt:
-            temp = []
-            for sent in d:
-                temp_s = sent
-                for index, each_token in enumerate(sent):
-                    if each_token.startswith("http"):
-                        temp_s[index] = "http"
-                    elif len(each_token) > 1:
-                        temp_s[index] = each_token.translate(trans)
-                        temp_s[index] = temp_s[index].translate(chin_trans)
-                    if temp_s[index] == "":
-                        temp_s[index] = "[UNK]"
-                    if each_token.startswith("www"):
-                        temp_s[index] = "www"
-                    if zhPattern.search(each_token):
-                        temp_s[index] = "[UNK]"
-                        #temp_s[index] = temp_s[index].translate(anotrans)
-                temp.append(' '.join(temp_s))
-            src_txt.append(temp)
-
-        # src_txt = [' '.join(sent) for d in src for sent in d]
-        # print(len(src_txt))
-
-        text = [' {} {} '.format(self.sep_token, self.cls_token).join(d) for d in src_txt]
-        # print(len(text))
-        #text = ['{} '.format(self.cls_token) + d + ' {}'.format(self.sep_token) for d in text]
-        # print(len(text))
-        tags = []
-        for i, t in enumerate(tag_filt):
-            temp = []
-            temp.append('O')
-            for tag_list in t:
-                for tag in tag_list:
-                    temp.append(tag)
-                temp.append('O')
-                temp.append('O')
-            temp = temp[:-2]
-            temp.append('O')
-            tags.append(temp)
-            #assert len(text[i].split()) == len(temp), (i, text[i].split(), len(text[i].split()), len(temp))
-
-        #print("equal:", len(tags[0]), len(text[0].split()))
-        src_encoding = self.tokenizer(text, truncation=True, padding=True)
-        src_subtoken_idxs = src_encoding['input_ids']
-        src_subtoken_origin_idxs = src_subtoken_idxs
-        src_token_type_id = src_encoding['token_type_ids']
-        #print(len(src_subtoken_idxs), len(src_subtoken_idxs[0]))
-        #print (len(tags[0]), len(src_subtoken_idxs[0]), len(src_token_type_id[0]))
-        src_subtokens = [self.tokenizer.convert_ids_to_tokens(idx) for idx in src_subtoken_idxs]
-        tag_align = []
-        #print(src_subtokens[0])
-        #print("debug one:", len(src_subtokens), len(tags))
-        for i, subtoken in enumerate(src_subtokens):
-            aligned_labels = ["O"] * len(subtoken)
-            count = 0
-            # print(len(subtoken))
-            temp_src = text[i].split("[CLS]")
-            temp = " ".join([val for val in subtoken if val != '[PAD]'])
-            temp = temp.split("[CLS]")
-            for j, temp_sent in enumerate(temp):
-                if 0 < j:
-                    temp_s = temp_sent.split()
-                    temp_sent_filt = [filt for filt in temp_s if not filt.startswith("##")]
-                    if len(temp_sent_filt)!=len(temp_src[j-1].split()):
-                        print(len(temp_sent_filt),len(temp_src[j-1].split()))
-                        print("sub:", temp_sent_filt)
-                        print("src:", temp_src[j-1].split())
-                        print("\n")
-            print(i, len(tags[i]),len([val for val in subtoken if not val.startswith("##") and val !='[PAD]']))
-            for j, each_str in enumerate(subtoken):
-                # print(i, each_str, head, count)
-                if each_str != "[PAD]":
-                    if each_str.startswith("##"):
-                        aligned_labels[j] = tags[i][count - 1]
-                    else:
-                        #print(each_str, len(tags[i]), count)
-                        #try:
-                        aligned_labels[j] = tags[i][count]
-                        #except Exception:
-                        #    pass
-                        count += 1
-                else:
-                    break
-            tag_align.append(aligned_labels)
-        # print(head, len(src_subtokens), count, len(tags))
-        # src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
-        tag_dict = {'O': 0, "I-INT": 1, "I-PAR": 2, "I-OUT": 3}
-        tag_id = []
-        for tag_list in tag_align:
-            temp = []
-            for tag in tag_list:
-                temp.append(int(tag_dict[tag]))
-            tag_id.append(temp)
-        mask_label = []
-        for i, tag_list in enumerate(tag_align):
-            temp = []
-            for j, tag in enumerate(tag_list):
-                if tag == "O":
-                    temp.append(0.0)
-                else:
-                    src_subtoken_idxs[i][j] = self.mask_vid
-                    temp.append(1.0)
-            #print(len(temp))
-            mask_label.append(temp)
-        print(len(mask_label))
-        data = []
-        for i in range(len(mask_label)):
-            data.append({"src": src_subtoken_idxs[i], "tag": tag_id[i], "mask": mask_label[i], "token_type_ids":src_token_type_id[i],
-                         "src_orig":src_subtoken_origin_idxs[i]})
-        return data
+class PicoPubmedBertAdapterData(PicoAlignMixin):
+    max_length = 512
 
-class PicoPubmedBertAdapterData():
     def __init__(self, args):
         self.args = args
         model_name = 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract'
@@ -1093,139 +983,10 @@ class PicoPubmedBertAdapterData():
         self.mask_token = '[MASK]'
         self.mask_vid = self.tokenizer.convert_tokens_to_ids(self.mask_token)
 
-    def preprocess(self, src, tag, is_test=False):
 
-        idxs = []
-        new_src = []
-        new_tag = []
-        for i, d in enumerate(src):
-            new_src.append([])
-            new_tag.append([])
-            for j, s in enumerate(d):
-                # assert len(s)==len(tag[i][j]),(len(s),len(tag[i][j]))
-                if len(s) > self.args.min_src_ntokens_per_sent:
-                    new_src[-1].append(s[:self.args.max_src_ntokens_per_sent])
-                    new_tag[-1].append(tag[i][j][:self.args.max_src_ntokens_per_sent])
-        # print(len(new_tag))
-
-        src_filt = [d[:self.args.max_src_nsents][:] for d in new_src if self.args.min_src_nsents < len(d)]
-        tag_filt = [d_tag[:self.args.max_src_nsents][:] for d_tag in new_tag if self.args.min_src_nsents < len(d_tag)]
-        print(len(src_filt), len(src_filt[0]), src_filt[0][0])
-        src_txt = []
-        trans = str.maketrans("", "", string.punctuation + "‘" + "’" + "‐" + '‑' + '”')
-        chin_trans = str.maketrans("", "", punctuation)
-        zhPattern = re.compile(u'[\u4e00-\u9fa5]+')
-        # anotrans = str.maketrans("", "", "’")
-        for d in src_filt:
-            temp = []
-            for sent in d:
-                temp_s = sent
-                for index, each_token in enumerate(sent):
-                    if each_token.startswith("http"):
-                        temp_s[index] = "http"
-                    elif len(each_token) > 1:
-                        temp_s[index] = each_token.translate(trans)
-                        temp_s[index] = temp_s[index].translate(chin_trans)
-                    if temp_s[index] == "":
-                        temp_s[index] = "[UNK]"
-                    if each_token.startswith("www"):
-                        temp_s[index] = "www"
-                    if zhPattern.search(each_token):
-                        temp_s[index] = "[UNK]"
-                        # temp_s[index] = temp_s[index].translate(anotrans)
-                temp.append(' '.join(temp_s))
-            src_txt.append(temp)
-
-        # src_txt = [' '.join(sent) for d in src for sent in d]
-        # print(len(src_txt))
-
-        text = [' {} {} '.format(self.sep_token, self.cls_token).join(d) for d in src_txt]
-        # print(len(text))
-        #text = ['{} '.format(self.cls_token) + d + ' {}'.format(self.sep_token) for d in text]
-        # print(len(text))
-        tags = []
-        for i, t in enumerate(tag_filt):
-            temp = []
-            temp.append('O')
-            for tag_list in t:
-                for tag in tag_list:
-                    temp.append(tag)
-                temp.append('O')
-                temp.append('O')
-            temp = temp[:-2]
-            temp.append('O')
-            tags.append(temp)
-            #assert len(text[i].split()) == len(temp), (i, text[i].split(), len(text[i].split()), len(temp))
-
-        src_encoding = self.tokenizer(text, truncation=True, padding=True, max_length=512)
-        src_subtoken_idxs = src_encoding['input_ids']
-        src_token_type_id = src_encoding['token_type_ids']
-        src_subtoken_origin_idxs = src_subtoken_idxs
-        # print(len(src_subtoken_idxs), len(src_subtoken_idxs[0]))
-        # print (len(tags[0]), len(src_subtoken_idxs[0]), len(src_token_type_id[0]))
-        src_subtokens = [self.tokenizer.convert_ids_to_tokens(idx) for idx in src_subtoken_idxs]
-        tag_align = []
-        # print(src_subtokens[0])
-        # print("debug one:", len(src_subtokens), len(tags))
-        for i, subtoken in enumerate(src_subtokens):
-            aligned_labels = ["O"] * len(subtoken)
-            count = 0
-            # print(len(subtoken))
-            temp_src = text[i].split("[CLS]")
-            temp = " ".join([val for val in subtoken if val != '[PAD]'])
-            temp = temp.split("[CLS]")
-            for j, temp_sent in enumerate(temp):
-                if 0 < j:
-                    temp_s = temp_sent.split()
-                    temp_sent_filt = [filt for filt in temp_s if not filt.startswith("##")]
-                    if len(temp_sent_filt) != len(temp_src[j - 1].split()):
-                        print(len(temp_sent_filt), len(temp_src[j - 1].split()))
-                        print("sub:", temp_sent_filt)
-                        print("src:", temp_src[j - 1].split())
-                        print("\n")
-            print(i, len(tags[i]), len([val for val in subtoken if not val.startswith("##") and val != '[PAD]']))
-            for j, each_str in enumerate(subtoken):
-                # print(i, each_str, head, count)
-                if each_str != "[PAD]":
-                    if each_str.startswith("##"):
-                        aligned_labels[j] = tags[i][count - 1]
-                    else:
-                        # print(each_str, len(tags[i]), count)
-                        # try:
-                        aligned_labels[j] = tags[i][count]
-                        # except Exception:
-                        #    pass
-                        count += 1
-                else:
-                    break
-            tag_align.append(aligned_labels)
-        # print(head, len(src_subtokens), count, len(tags))
-        # src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
-        tag_dict = {'O': 0, "I-INT": 1, "I-PAR": 2, "I-OUT": 3}
-        tag_id = []
-        for tag_list in tag_align:
-            temp = []
-            for tag in tag_list:
-                temp.append(int(tag_dict[tag]))
-            tag_id.append(temp)
-        mask_label = []
-        for i, tag_list in enumerate(tag_align):
-            temp = []
-            for j, tag in enumerate(tag_list):
-                if tag == "O":
-                    temp.append(0.0)
-                else:
-                    src_subtoken_idxs[i][j] = self.mask_vid
-                    temp.append(1.0)
-            # print(len(temp))
-            mask_label.append(temp)
-        data = []
-        for i in range(len(mask_label)):
-            data.append({"src": src_subtoken_idxs[i], "tag": tag_id[i], "mask": mask_label[i],
-                         "token_type_ids": src_token_type_id[i],"src_orig":src_subtoken_origin_idxs[i]})
-        return data
+class PicoBioBertAdapterData(PicoAlignMixin):
+    max_length = 512
 
-class PicoBioBertAdapterData():
     def __init__(self, args):
         self.args = args
         model_name = 'dmis-lab/biobert-v1.1'
@@ -1241,137 +1002,6 @@ class PicoBioBertAdapterData():
         self.mask_token = '[MASK]'
         self.mask_vid = self.tokenizer.convert_tokens_to_ids(self.mask_token)
 
-    def preprocess(self, src, tag, is_test=False):
-
-        idxs = []
-        new_src = []
-        new_tag = []
-        for i, d in enumerate(src):
-            new_src.append([])
-            new_tag.append([])
-            for j, s in enumerate(d):
-                # assert len(s)==len(tag[i][j]),(len(s),len(tag[i][j]))
-                if len(s) > self.args.min_src_ntokens_per_sent:
-                    new_src[-1].append(s[:self.args.max_src_ntokens_per_sent])
-                    new_tag[-1].append(tag[i][j][:self.args.max_src_ntokens_per_sent])
-        # print(len(new_tag))
-
-        src_filt = [d[:self.args.max_src_nsents][:] for d in new_src if self.args.min_src_nsents < len(d)]
-        tag_filt = [d_tag[:self.args.max_src_nsents][:] for d_tag in new_tag if self.args.min_src_nsents < len(d_tag)]
-        print(len(src_filt), len(src_filt[0]), src_filt[0][0])
-        src_txt = []
-        trans = str.maketrans("", "", string.punctuation + "‘" + "’" + "‐" + '‑' + '”')
-        chin_trans = str.maketrans("", "", punctuation)
-        zhPattern = re.compile(u'[\u4e00-\u9fa5]+')
-        # anotrans = str.maketrans("", "", "’")
-        for d in src_filt:
-            temp = []
-            for sent in d:
-                temp_s = sent
-                for index, each_token in enumerate(sent):
-                    if each_token.startswith("http"):
-                        temp_s[index] = "http"
-                    elif len(each_token) > 1:
-                        temp_s[index] = each_token.translate(trans)
-                        temp_s[index] = temp_s[index].translate(chin_trans)
-                    if temp_s[index] == "":
-                        temp_s[index] = "[UNK]"
-                    if each_token.startswith("www"):
-                        temp_s[index] = "www"
-                    if zhPattern.search(each_token):
-                        temp_s[index] = "[UNK]"
-                        # temp_s[index] = temp_s[index].translate(anotrans)
-                temp.append(' '.join(temp_s))
-            src_txt.append(temp)
-
-        # src_txt = [' '.join(sent) for d in src for sent in d]
-        # print(len(src_txt))
-
-        text = [' {} {} '.format(self.sep_token, self.cls_token).join(d) for d in src_txt]
-        # print(len(text))
-        #text = ['{} '.format(self.cls_token) + d + ' {}'.format(self.sep_token) for d in text]
-        # print(len(text))
-        tags = []
-        for i, t in enumerate(tag_filt):
-            temp = []
-            temp.append('O')
-            for tag_list in t:
-                for tag in tag_list:
-                    temp.append(tag)
-                temp.append('O')
-                temp.append('O')
-            temp = temp[:-2]
-            temp.append('O')
-            tags.append(temp)
-            #assert len(text[i].split()) == len(temp), (i, text[i].split(), len(text[i].split()), len(temp))
-
-        src_encoding = self.tokenizer(text, truncation=True, padding=True, max_length=512)
-        src_subtoken_idxs = src_encoding['input_ids']
-        src_token_type_id = src_encoding['token_type_ids']
-        src_subtoken_origin_idxs = src_subtoken_idxs
-        # print(len(src_subtoken_idxs), len(src_subtoken_idxs[0]))
-        # print (len(tags[0]), len(src_subtoken_idxs[0]), len(src_token_type_id[0]))
-        src_subtokens = [self.tokenizer.convert_ids_to_tokens(idx) for idx in src_subtoken_idxs]
-        tag_align = []
-        # print(src_subtokens[0])
-        # print("debug one:", len(src_subtokens), len(tags))
-        for i, subtoken in enumerate(src_subtokens):
-            aligned_labels = ["O"] * len(subtoken)
-            count = 0
-            # print(len(subtoken))
-            temp_src = text[i].split("[CLS]")
-            temp = " ".join([val for val in subtoken if val != '[PAD]'])
-            temp = temp.split("[CLS]")
-            for j, temp_sent in enumerate(temp):
-                if 0 < j:
-                    temp_s = temp_sent.split()
-                    temp_sent_filt = [filt for filt in temp_s if not filt.startswith("##")]
-                    if len(temp_sent_filt) != len(temp_src[j - 1].split()):
-                        print(len(temp_sent_filt), len(temp_src[j - 1].split()))
-                        print("sub:", temp_sent_filt)
-                        print("src:", temp_src[j - 1].split())
-                        print("\n")
-            print(i, len(tags[i]), len([val for val in subtoken if not val.startswith("##") and val != '[PAD]']))
-            for j, each_str in enumerate(subtoken):
-                # print(i, each_str, head, count)
-                if each_str != "[PAD]":
-                    if each_str.startswith("##"):
-                        aligned_labels[j] = tags[i][count - 1]
-                    else:
-                        # print(each_str, len(tags[i]), count)
-                        # try:
-                        aligned_labels[j] = tags[i][count]
-                        # except Exception:
-                        #    pass
-                        count += 1
-                else:
-                    break
-            tag_align.append(aligned_labels)
-        # print(head, len(src_subtokens), count, len(tags))
-        # src_subtoken_idxs = self.tokenizer.convert_tokens_to_ids(src_subtokens)
-        tag_dict = {'O': 0, "I-INT": 1, "I-PAR": 2, "I-OUT": 3}
-        tag_id = []
-        for tag_list in tag_align:
-            temp = []
-            for tag in tag_list:
-                temp.append(int(tag_dict[tag]))
-            tag_id.append(temp)
-        mask_label = []
-        for i, tag_list in enumerate(tag_align):
-            temp = []
-            for j, tag in enumerate(tag_list):
-                if tag == "O":
-                    temp.append(0.0)
-                else:
-                    src_subtoken_idxs[i][j] = self.mask_vid
-                    temp.append(1.0)
-            # print(len(temp))
-            mask_label.append(temp)
-        data = []
-        for i in range(len(mask_label)):
-            data.append({"src": src_subtoken_idxs[i], "tag": tag_id[i], "mask": mask_label[i],
-                         "token_type_ids": src_token_type_id[i],"src_orig":src_subtoken_origin_idxs[i]})
-        return data
 
 def format_to_robert(args):
     print('... (5) Converting data to roBERT data... this will take a while')
@@ -1386,13 +1016,13 @@ def format_to_robert(args):
         for json_f in glob.glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')):
             real_name = json_f.split('/')[-1]
             #print("json_f:", json_f, real_name)
-            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
+            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', _bert_shard_ext(args)))))
         
-        pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_robert, a_lst):
-            pass
+        pool = Pool(args.n_cpus, initializer=_init_doc_cache_worker, initargs=(RoBertData, args))
+        _write_doc_cache(args, RoBertData, pool.imap(_format_to_robert, a_lst))
         pool.close()
         pool.join()
+    _compact_doc_cache(args, RoBertData)
 
 
 def format_to_bert(args):
@@ -1408,13 +1038,13 @@ def format_to_bert(args):
         for json_f in glob.glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')):
             real_name = json_f.split('/')[-1]
             # print("json_f:", json_f, real_name)
-            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
+            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', _bert_shard_ext(args)))))
 
-        pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_bert, a_lst):
-            pass
+        pool = Pool(args.n_cpus, initializer=_init_doc_cache_worker, initargs=(BertData, args))
+        _write_doc_cache(args, BertData, pool.imap(_format_to_bert, a_lst))
         pool.close()
         pool.join()
+    _compact_doc_cache(args, BertData)
 
 def format_to_pubmed_bert(args):
     print('... (5) Converting data to pubmed BERT data... this will take a while')
@@ -1429,13 +1059,13 @@ def format_to_pubmed_bert(args):
         for json_f in glob.glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')):
             real_name = json_f.split('/')[-1]
             # print("json_f:", json_f, real_name)
-            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
+            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', _bert_shard_ext(args)))))
 
-        pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_pubmed_bert, a_lst):
-            pass
+        pool = Pool(args.n_cpus, initializer=_init_doc_cache_worker, initargs=(PubmedData, args))
+        _write_doc_cache(args, PubmedData, pool.imap(_format_to_pubmed_bert, a_lst))
         pool.close()
         pool.join()
+    _compact_doc_cache(args, PubmedData)
 
 def format_to_bio_bert(args):
     print('... (5) Converting data to BioBERT data... this will take a while')
@@ -1450,13 +1080,13 @@ def format_to_bio_bert(args):
         for json_f in glob.glob(pjoin(args.raw_path, '*' + corpus_type + '.*.json')):
             real_name = json_f.split('/')[-1]
             # print("json_f:", json_f, real_name)
-            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', 'bert.pt'))))
+            a_lst.append((corpus_type, json_f, args, pjoin(args.save_path, real_name.replace('json', _bert_shard_ext(args)))))
 
-        pool = Pool(args.n_cpus)
-        for d in pool.imap(_format_to_bio_bert, a_lst):
-            pass
+        pool = Pool(args.n_cpus, initializer=_init_doc_cache_worker, initargs=(BioBertData, args))
+        _write_doc_cache(args, BioBertData, pool.imap(_format_to_bio_bert, a_lst))
         pool.close()
         pool.join()
+    _compact_doc_cache(args, BioBertData)
 
 def format_to_pico_adapter_robert(args):
     print('... (5) Converting data to pico adapter data... this will take a while')
@@ -1483,8 +1113,7 @@ def format_to_pico_adapter_robert(args):
         tag = []
         #json_file = [json_file[0]]
         for j in json_file:
-            jobs = json.load(open(j))
-            for d in jobs:
+            for d in _read_json_shard(j):
                 source.append(d['src'])
                 tag.append(d['tag'])
         #source = source[:100]
@@ -1492,7 +1121,7 @@ def format_to_pico_adapter_robert(args):
         data = pico_adapter.preprocess(source, tag, is_test=is_test)
         logger.info('Processed instances %d' % len(data))
         logger.info('Saving to %s' % save_path)
-        torch.save(data, save_path)
+        _torch_save_atomic(data, save_path)
 
 def format_to_pico_adapter_bert(args):
     print('... (5) Converting data to pico adapter data... this will take a while')
@@ -1519,8 +1148,7 @@ def format_to_pico_adapter_bert(args):
         tag = []
         #json_file = [json_file[0]]
         for j in json_file:
-            jobs = json.load(open(j))
-            for d in jobs:
+            for d in _read_json_shard(j):
                 source.append(d['src'])
                 tag.append(d['tag'])
         #source = source[:100]
@@ -1528,7 +1156,7 @@ def format_to_pico_adapter_bert(args):
         data = pico_adapter.preprocess(source, tag, is_test=is_test)
         logger.info('Processed instances %d' % len(data))
         logger.info('Saving to %s' % save_path)
-        torch.save(data, save_path)
+        _torch_save_atomic(data, save_path)
 
 def format_to_pico_adapter_pubmed_bert(args):
     print('... (5) Converting data to pico adapter data... this will take a while')
@@ -1555,8 +1183,7 @@ def format_to_pico_adapter_pubmed_bert(args):
         tag = []
         #json_file = [json_file[0]]
         for j in json_file:
-            jobs = json.load(open(j))
-            for d in jobs:
+            for d in _read_json_shard(j):
                 source.append(d['src'])
                 tag.append(d['tag'])
         #source = source[:100]
@@ -1564,7 +1191,7 @@ def format_to_pico_adapter_pubmed_bert(args):
         data = pico_adapter.preprocess(source, tag, is_test=is_test)
         logger.info('Processed instances %d' % len(data))
         logger.info('Saving to %s' % save_path)
-        torch.save(data, save_path)
+        _torch_save_atomic(data, save_path)
 
 def format_to_pico_adapter_bio_bert(args):
     print('... (5) Converting data to pico adapter data... this will take a while')
@@ -1591,159 +1218,393 @@ def format_to_pico_adapter_bio_bert(args):
         tag = []
         #json_file = [json_file[0]]
         for j in json_file:
-            jobs = json.load(open(j))
-            for d in jobs:
+            for d in _read_json_shard(j):
                 source.append(d['src'])
                 tag.append(d['tag'])
         data = pico_adapter.preprocess(source, tag, is_test=is_test)
         logger.info('Processed instances %d' % len(data))
         logger.info('Saving to %s' % save_path)
-        torch.save(data, save_path)
+        _torch_save_atomic(data, save_path)
+
+def _bert_shard_ext(args):
+    if args.shard_format == 'columnar':
+        return 'bert' + COLUMNAR_SUFFIX
+    return 'bert.pt'
+
+class _PtShardWriter(object):
+    """Collects examples and `torch.save`s them on `close`, atomically."""
+
+    def __init__(self, path):
+        self.path = path
+        self.datasets = []
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def add(self, ex):
+        self.datasets.append(ex)
+
+    def close(self):
+        _torch_save_atomic(self.datasets, self.path)
+
+
+def _torch_save_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _open_bert_shard(save_file):
+    if save_file.endswith(COLUMNAR_SUFFIX):
+        return ColumnarWriter(save_file)
+    return _PtShardWriter(save_file)
+
+
+def _read_json_shard(json_file):
+    """Documents of an intermediate `.json` shard, read one line at a time.
+
+    Shards hold one JSON document per line; shards written as a single JSON
+    array by earlier versions are still read, but as a whole.
+    """
+    with open(json_file) as f:
+        for line in f:
+            if line.startswith('['):
+                for d in json.loads(line + f.read()):
+                    yield d
+                return
+            if line.strip():
+                yield json.loads(line)
+
+
+class _JsonShardWriter(object):
+    """Writes documents as `.json` shards of one JSON document per line.
+
+    Like the single-array shards before, a shard is closed once it holds
+    more than `shard_size` documents. Each shard is written to a temporary
+    file and renamed into place when complete.
+    """
+
+    def __init__(self, path_format, shard_size):
+        self.path_format = path_format
+        self.shard_size = shard_size
+        self.shard_count = 0
+        self.n_docs = 0
+        self.f = None
+
+    def add(self, d):
+        """Append a document. Returns whether this completed a shard."""
+        if self.f is None:
+            self.f = open(self.path_format.format(self.shard_count) + '.tmp', 'w')
+        self.f.write(json.dumps(d) + '\n')
+        self.n_docs += 1
+        if (self.n_docs > self.shard_size):
+            return self.flush()
+        return False
+
+    def flush(self):
+        """Close the current shard, if it holds any documents. Returns whether one was written."""
+        if self.f is None:
+            return False
+        self.f.close()
+        fpath = self.path_format.format(self.shard_count)
+        os.replace(fpath + '.tmp', fpath)
+        self.f = None
+        self.n_docs = 0
+        self.shard_count += 1
+        return True
+
+# Arguments whose value changes what `preprocess` makes of a document.
+_DOC_CACHE_ARGS = ['min_src_nsents', 'max_src_nsents', 'min_src_ntokens_per_sent', 'max_src_ntokens_per_sent',
+                   'min_tgt_ntokens', 'max_tgt_ntokens', 'lower', 'use_bert_basic_tokenizer', 'corpus']
+_DOC_CACHE_MISS = object()
+
+
+class _DocCache(object):
+    """`preprocess` results of one `*Data` class, in the `others.doc_store` under `<cache_dir>/<name>`.
+
+    An entry is keyed by the `hashhex` of the document's source, target,
+    PICO tags and label together with the preprocessing arguments, and holds
+    the oracle labels and subtoken ids `preprocess` returned (or None for a
+    filtered document). New entries are collected in `new`; workers hand
+    them to the main process, which writes them with `_write_doc_cache`.
+    """
+
+    def __init__(self, cache_dir, name, args):
+        self.path = pjoin(cache_dir, name)
+        self.store = DocStore(self.path)
+        self.args_key = [getattr(args, k, None) for k in _DOC_CACHE_ARGS]
+        self.new = []
+        self.hits = 0
+
+    def key(self, d, is_test):
+        return hashhex(json.dumps([d['src'], d['tgt'], d.get('tag'), d.get('label'), self.args_key, is_test]))
+
+    def get(self, key):
+        if (key in self.store):
+            self.hits += 1
+            return self.store.get(key)
+        return _DOC_CACHE_MISS
+
+    def put(self, key, value):
+        self.new.append((key, value))
+
+    def take(self):
+        """The new entries since the last `take`."""
+        logger.info('Document cache: %d reused, %d processed' % (self.hits, len(self.new)))
+        new, self.new, self.hits = self.new, [], 0
+        return new
+
+
+def _prepare_doc(d, args, summary_size):
+    """(source, tgt, oracle sentence labels) of a json document."""
+    source, tgt = d['src'], d['tgt']
+    sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, summary_size)
+    if (args.lower):
+        source = [' '.join(s).lower().split() for s in source]
+        tgt = [' '.join(s).lower().split() for s in tgt]
+    return source, tgt, sent_labels
+
+
+def _bert_example(b_data):
+    src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt = b_data
+    return {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
+            "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
+            'src_txt': src_txt, "tgt_txt": tgt_txt}
+
+
+def _preprocess_docs(data, docs, args, is_test, prepare, cache=None):
+    """`data.preprocess` of each json document in `docs`, in order.
+
+    `prepare` turns a document into the (source, tgt, sent_labels) that
+    `preprocess` takes. With `-tokenize_batch_size N` documents go through
+    `preprocess_batch` in chunks of N. Documents whose entry is in the
+    `_DocCache` `cache` skip `prepare` and `preprocess` altogether; the
+    results of the others are `put` into it.
+    """
+    docs = iter(docs)
+    while True:
+        chunk = list(itertools.islice(docs, max(args.tokenize_batch_size, 1)))
+        if not chunk:
+            break
+        keys = [cache.key(d, is_test) if cache else None for d in chunk]
+        cached = [cache.get(k) if cache else _DOC_CACHE_MISS for k in keys]
+        todo = [prepare(d) for d, c in zip(chunk, cached) if c is _DOC_CACHE_MISS]
+        if (not todo):
+            results = []
+        elif (args.tokenize_batch_size > 0):
+            results = data.preprocess_batch(todo, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
+                                            is_test=is_test)
+        else:
+            results = [data.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
+                                       is_test=is_test) for source, tgt, sent_labels in todo]
+        results = iter(results)
+        for k, c in zip(keys, cached):
+            if (c is _DOC_CACHE_MISS):
+                c = next(results)
+                if (cache):
+                    cache.put(k, c)
+            yield c
+
+
+def _open_doc_cache(args, data_cls):
+    return _DocCache(args.doc_cache, data_cls.__name__, args) if args.doc_cache else None
+
+
+# The `_DocCache` of a pool worker, opened once by its initializer rather than by every job.
+_worker_doc_cache = None
+
+
+def _init_doc_cache_worker(data_cls, args):
+    global _worker_doc_cache
+    _worker_doc_cache = _open_doc_cache(args, data_cls)
+
+
+def _write_doc_cache(args, data_cls, results):
+    """Writes the new cache entries of each job in `results` as one segment of the `data_cls` store."""
+    writer = DocStoreWriter(pjoin(args.doc_cache, data_cls.__name__)) if args.doc_cache else None
+    for new in results:
+        if (writer is not None):
+            for key, value in new:
+                writer.add(key, value)
+    if (writer is not None):
+        writer.close()
+
+
+def _compact_doc_cache(args, data_cls):
+    if (args.doc_cache):
+        path = pjoin(args.doc_cache, data_cls.__name__)
+        logger.info('Document cache: %d documents in %s' % (compact(path), path))
+
+
+def check_tokenize(args):
+    """Compare `preprocess_batch` with `preprocess` on every document of the `.json` shards under `raw_path`.
+
+    Run it on a corpus before converting it with `-tokenize_batch_size`:
+    it reports the documents whose two outputs differ and the time each
+    path took.
+    """
+    data = _PIPELINE_TARGETS[args.pipeline_target](args)
+    if (not isinstance(data, BatchTokenizeMixin)):
+        raise ValueError('%s has no batched tokenization' % args.pipeline_target)
+    summary_size = 7 if (args.corpus == "pubmed" and isinstance(data, BertData)) else 3
+    n_docs, n_diff, t_single, t_batch = 0, 0, 0., 0.
+    for json_f in sorted(glob.glob(pjoin(args.raw_path, '*.json'))):
+        is_test = '.test.' in os.path.basename(json_f)
+        docs = _read_json_shard(json_f)
+        while True:
+            chunk = [_prepare_doc(d, args, summary_size)
+                     for d in itertools.islice(docs, max(args.tokenize_batch_size, 1))]
+            if not chunk:
+                break
+            start = time.time()
+            expected = [data.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
+                                        is_test=is_test) for source, tgt, sent_labels in chunk]
+            t_single += time.time() - start
+            start = time.time()
+            results = data.preprocess_batch(chunk, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
+                                            is_test=is_test)
+            t_batch += time.time() - start
+            for i, (r, e) in enumerate(zip(results, expected)):
+                if (r != e):
+                    if (n_diff < 10):
+                        logger.warning('%s: document %d differs' % (json_f, n_docs + i))
+                    n_diff += 1
+            n_docs += len(chunk)
+    logger.info('%d of %d documents differ; preprocess %.1fs, preprocess_batch %.1fs'
+                % (n_diff, n_docs, t_single, t_batch))
+
 
 def _format_to_robert(params):
     corpus_type, json_file, args, save_file = params
     is_test = corpus_type == 'test'
     if (os.path.exists(save_file)):
         logger.info('Ignore %s' % save_file)
-        return
+        return []
 
     Robert = RoBertData(args)
 
     logger.info('Processing %s' % json_file)
-    jobs = json.load(open(json_file))
-    datasets = []
-    for d in jobs:
-        source, tgt = d['src'], d['tgt']
-        sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, 3)
-        if (args.lower):
-            source = [' '.join(s).lower().split() for s in source]
-            tgt = [' '.join(s).lower().split() for s in tgt]
-        b_data = Robert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
-                                 is_test=is_test)
-        # b_data = bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer)
+    datasets = _open_bert_shard(save_file)
+
+    def _prepare(d):
+        return _prepare_doc(d, args, 3)
+
+    cache = _worker_doc_cache
+    for b_data in _preprocess_docs(Robert, _read_json_shard(json_file), args, is_test, _prepare, cache):
         if (b_data is None):
             continue
-        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt = b_data
-        b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
-                       "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
-                       'src_txt': src_txt, "tgt_txt": tgt_txt}
-        datasets.append(b_data_dict)
+        datasets.add(_bert_example(b_data))
     logger.info('Processed instances %d' % len(datasets))
     logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
+    datasets.close()
     gc.collect()
+    return cache.take() if cache else []
 
 def _format_to_bert(params):
     corpus_type, json_file, args, save_file= params
     is_test = corpus_type == 'test'
     if (os.path.exists(save_file)):
         logger.info('Ignore %s' % save_file)
-        return
+        return []
 
     bert = BertData(args)
 
     logger.info('Processing %s' % json_file)
-    jobs = json.load(open(json_file))
-    datasets = []
-    for d in jobs:
-        source, tgt, label = d['src'], d['tgt'], d['label']
-        if args.corpus != "pubmed":
-            sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, 3)
-        else:
-            #sent_labels = label
-            #if sent_labels == []:
-            sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, 7)
-        if (args.lower):
-            source = [' '.join(s).lower().split() for s in source]
-            tgt = [' '.join(s).lower().split() for s in tgt]
-        b_data = bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
-                                 is_test=is_test)
-        # b_data = bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer)
+    datasets = _open_bert_shard(save_file)
 
+    def _prepare(d):
+        #sent_labels = d['label'] for pubmed
+        return _prepare_doc(d, args, 7 if args.corpus == "pubmed" else 3)
+
+    cache = _worker_doc_cache
+    for b_data in _preprocess_docs(bert, _read_json_shard(json_file), args, is_test, _prepare, cache):
         if (b_data is None):
             continue
-        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt = b_data
-        b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
-                       "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
-                       'src_txt': src_txt, "tgt_txt": tgt_txt}
-        datasets.append(b_data_dict)
+        datasets.add(_bert_example(b_data))
     logger.info('Processed instances %d' % len(datasets))
     logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
+    datasets.close()
     gc.collect()
+    return cache.take() if cache else []
 
 def _format_to_pubmed_bert(params):
     corpus_type, json_file, args, save_file = params
     is_test = corpus_type == 'test'
     if (os.path.exists(save_file)):
         logger.info('Ignore %s' % save_file)
-        return
+        return []
 
     pubmed_bert = PubmedData(args)
 
     logger.info('Processing %s' % json_file)
-    jobs = json.load(open(json_file))
-    datasets = []
-    for d in jobs:
-        source, tgt = d['src'], d['tgt']
-        sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, 3)
-        if (args.lower):
-            source = [' '.join(s).lower().split() for s in source]
-            tgt = [' '.join(s).lower().split() for s in tgt]
-        b_data = pubmed_bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
-                                 is_test=is_test)
-        # b_data = bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer)
+    datasets = _open_bert_shard(save_file)
+
+    def _prepare(d):
+        return _prepare_doc(d, args, 3)
 
+    cache = _worker_doc_cache
+    for b_data in _preprocess_docs(pubmed_bert, _read_json_shard(json_file), args, is_test, _prepare, cache):
         if (b_data is None):
             continue
-        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt = b_data
-        b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
-                       "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
-                       'src_txt': src_txt, "tgt_txt": tgt_txt}
-        datasets.append(b_data_dict)
+        datasets.add(_bert_example(b_data))
     logger.info('Processed instances %d' % len(datasets))
     logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
+    datasets.close()
     gc.collect()
+    return cache.take() if cache else []
 
 def _format_to_bio_bert(params):
     corpus_type, json_file, args, save_file = params
     is_test = corpus_type == 'test'
     if (os.path.exists(save_file)):
         logger.info('Ignore %s' % save_file)
-        return
+        return []
 
     bio_bert = BioBertData(args)
 
     logger.info('Processing %s' % json_file)
-    jobs = json.load(open(json_file))
-    datasets = []
-    for d in jobs:
-        source, tgt = d['src'], d['tgt']
-        sent_labels = greedy_selection(source[:args.max_src_nsents], tgt, 3)
-        if (args.lower):
-            source = [' '.join(s).lower().split() for s in source]
-            tgt = [' '.join(s).lower().split() for s in tgt]
-        b_data = bio_bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer,
-                                 is_test=is_test)
-        # b_data = bert.preprocess(source, tgt, sent_labels, use_bert_basic_tokenizer=args.use_bert_basic_tokenizer)
+    datasets = _open_bert_shard(save_file)
+
+    def _prepare(d):
+        return _prepare_doc(d, args, 3)
 
+    cache = _worker_doc_cache
+    for b_data in _preprocess_docs(bio_bert, _read_json_shard(json_file), args, is_test, _prepare, cache):
         if (b_data is None):
             continue
-        src_subtoken_idxs, sent_labels, tgt_subtoken_idxs, segments_ids, cls_ids, src_txt, tgt_txt = b_data
-        b_data_dict = {"src": src_subtoken_idxs, "tgt": tgt_subtoken_idxs,
-                       "src_sent_labels": sent_labels, "segs": segments_ids, 'clss': cls_ids,
-                       'src_txt': src_txt, "tgt_txt": tgt_txt}
-        datasets.append(b_data_dict)
+        datasets.add(_bert_example(b_data))
     logger.info('Processed instances %d' % len(datasets))
     logger.info('Saving to %s' % save_file)
-    torch.save(datasets, save_file)
+    datasets.close()
     gc.collect()
+    return cache.take() if cache else []
 
-def format_to_lines(args):
+def _load_splits(args):
+    """Paper name -> split of the papers `format_to_lines` split before with this `-doc_cache`."""
+    path = pjoin(args.doc_cache, 'splits.json') if args.doc_cache else ''
+    if not (path and os.path.exists(path)):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_splits(args, splits):
+    if not args.doc_cache:
+        return
+    if not os.path.isdir(args.doc_cache):
+        os.makedirs(args.doc_cache)
+    path = pjoin(args.doc_cache, 'splits.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(splits, f)
+    os.replace(path + '.tmp', path)
+
+
+def _lines_file_lists(args):
+    """(f_main, f_abs, f_tag, args, label) of every tokenized paper, per split."""
     if args.corpus != 'pubmed':
         corpora = sorted([os.path.join(args.raw_path, f) for f in os.listdir(args.raw_path)
-                      if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')])
+                      if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')
+                      and not f.startswith('pico_tags.')])
         #train_files, valid_files, test_files = [], [], []:
         args_list = []
         for f_main in corpora:
@@ -1751,15 +1612,26 @@ def format_to_lines(args):
             f_abs = os.path.join(args.raw_path, f_abs_name)
             f_tag_name = '{}.tag.json'.format(os.path.basename(f_main).split('.')[0])
             f_tag = os.path.join(args.raw_path, f_tag_name)
-            args_list.append((f_main, f_abs, f_tag, args))
-        index_list = list(range(len(args_list)))
+            args_list.append((f_main, f_abs, f_tag, args, None))
+        # Papers split by an earlier run with the same -doc_cache keep their split; new ones are split at random.
+        splits = _load_splits(args)
+        names = [os.path.basename(f_main).split('.')[0] for f_main in corpora]
+        seen = [i for i, name in enumerate(names) if name in splits]
+        index_list = [i for i, name in enumerate(names) if name not in splits]
         random.shuffle(index_list)
-        train_list_id = index_list[:int(len(args_list)*0.75)]
-        eval_list_id = index_list[int(len(args_list)*0.75)+1:int(len(args_list)*0.9)]
-        test_list_id = index_list[int(len(args_list)*0.9)+1:]
-        train_files = [args_list[i] for i in train_list_id]
-        valid_files = [args_list[i] for i in eval_list_id]
-        test_files = [args_list[i] for i in test_list_id]
+        n_new = len(index_list)
+        # The slices leave out the papers at the split boundaries; they stay 'excluded' in later runs too.
+        for i in index_list:
+            splits[names[i]] = 'excluded'
+        for split, ids in [('train', index_list[:int(n_new*0.75)]),
+                           ('valid', index_list[int(n_new*0.75)+1:int(n_new*0.9)]),
+                           ('test', index_list[int(n_new*0.9)+1:])]:
+            for i in ids:
+                splits[names[i]] = split
+        _save_splits(args, splits)
+        train_files = [args_list[i] for i in seen + index_list if splits.get(names[i]) == 'train']
+        valid_files = [args_list[i] for i in seen + index_list if splits.get(names[i]) == 'valid']
+        test_files = [args_list[i] for i in seen + index_list if splits.get(names[i]) == 'test']
     else:
         root_data_dir = os.path.abspath(args.raw_path)
         train_files, valid_files, test_files = [], [], []
@@ -1767,11 +1639,14 @@ def format_to_lines(args):
         val_txt_path = os.path.join(root_data_dir, 'val_pubmed')
         train_txt_path = os.path.join(root_data_dir, 'train_pubmed')
         test_corpora = sorted([os.path.join(test_txt_path, f) for f in os.listdir(test_txt_path)
-                              if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')])
+                              if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')
+                              and not f.startswith('pico_tags.')])
         val_corpora = sorted([os.path.join(val_txt_path, f) for f in os.listdir(val_txt_path)
-                               if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')])
+                               if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')
+                               and not f.startswith('pico_tags.')])
         train_corpora = sorted([os.path.join(train_txt_path, f) for f in os.listdir(train_txt_path)
-                              if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')])
+                              if not f.startswith('.') and not f.endswith('.abs.txt.json') and not f.endswith('.tag.json')
+                              and not f.startswith('pico_tags.')])
         with open(os.path.join(root_data_dir, 'test.pkl'), 'rb') as f:
             test_label = pickle.load(f)
         with open(os.path.join(root_data_dir, 'val.pkl'), 'rb') as f:
@@ -1803,30 +1678,28 @@ def format_to_lines(args):
             label = train_label[int(paper_id)]
             train_files.append((f_main, f_abs, f_tag, args, label))
 
+    return {'train': train_files, 'valid': valid_files, 'test': test_files}
+
+
+def format_to_lines(args):
+    corporas = _lines_file_lists(args)
+
     start = time.time()
     print('... (4) Packing tokenized data into shards...')
     #print('Converting files count: {}'.format(len(corpora)))
 
     # imap executes in sync multiprocess manner
     # use array and shard_size to save the flow of ordered data
-    corporas = {'train': train_files, 'valid': valid_files, 'test': test_files}
     for corpus_type in ['train', 'valid', 'test']:
         a_lst = corporas[corpus_type]
         pool = Pool(args.n_cpus)
-        dataset = []
-        shard_count = 0
+        dataset = _JsonShardWriter("{:s}/{:s}.{{:d}}.json".format(args.save_path, corpus_type), args.shard_size)
         with tqdm(total=len(a_lst)) as pbar:
             with tqdm(total=args.shard_size) as spbar:
                 for i, data in enumerate(pool.imap(_format_to_lines, a_lst)):
-                    if data:
-                        dataset.append(data)
+                    written = dataset.add(data) if data else False
                     spbar.update()
-                    if (len(dataset) > args.shard_size):
-                        fpath = "{:s}/{:s}.{:d}.json".format(args.save_path, corpus_type, shard_count)
-                        with open(fpath, 'w') as f:
-                            f.write(json.dumps(dataset))
-                        dataset = []
-                        shard_count += 1
+                    if written:
                         pbar.update()
                         spbar.reset()
                         # gc.collect()
@@ -1834,13 +1707,8 @@ def format_to_lines(args):
             pbar.close()
         pool.close()
         pool.join()
-        if len(dataset) > 0:
-            fpath = "{:s}/{:s}.{:d}.json".format(args.save_path, corpus_type, shard_count)
-            print('last shard {} saved'.format(shard_count))
-            with open(fpath, 'w') as f:
-                f.write(json.dumps(dataset))
-            dataset = []
-            shard_count += 1
+        if dataset.flush():
+            print('last shard {} saved'.format(dataset.shard_count - 1))
     end = time.time()
     print('... Ending (4), time elapsed {}'.format(end - start))
 
@@ -1852,6 +1720,121 @@ def _format_to_lines(params):
     else:
         return {'src': source, 'tgt': tgt, "tag":tag, "label":label}
 
+_PIPELINE_TARGETS = {'bert': BertData, 'robert': RoBertData, 'pubmed_bert': PubmedData, 'bio_bert': BioBertData,
+                     'pico_adapter_robert': PicoAdapterData, 'pico_adapter_bert': PicoBertAdapterData,
+                     'pico_adapter_pubmed_bert': PicoPubmedBertAdapterData,
+                     'pico_adapter_bio_bert': PicoBioBertAdapterData}
+_PIPELINE_CHUNK = 16
+
+_pipeline_data = None
+
+
+def _init_pipeline_worker(target, args):
+    # Load the tokenizer once per worker rather than once per shard.
+    global _pipeline_data
+    _pipeline_data = _PIPELINE_TARGETS[target](args)
+    if (not isinstance(_pipeline_data, PicoAlignMixin)):
+        _init_doc_cache_worker(_PIPELINE_TARGETS[target], args)
+
+
+def _pipeline_chunk(params):
+    """Examples of a chunk of papers and the new document cache entries.
+
+    For BERT targets there is one example (or None) per paper load_json
+    could read. The entries go back to the main process, which writes them
+    to the cache.
+    """
+    files, args, is_test = params
+    docs = [d for d in map(_format_to_lines, files) if d]
+    if (isinstance(_pipeline_data, PicoAlignMixin)):
+        if not docs:
+            return [], []
+        return _pipeline_data.preprocess([d['src'] for d in docs], [d['tag'] for d in docs], is_test=is_test), []
+
+    summary_size = 7 if (args.corpus == "pubmed" and isinstance(_pipeline_data, BertData)) else 3
+
+    def _prepare(d):
+        return _prepare_doc(d, args, summary_size)
+
+    examples = [None if b_data is None else _bert_example(b_data)
+                for b_data in _preprocess_docs(_pipeline_data, docs, args, is_test, _prepare, _worker_doc_cache)]
+    new = []
+    if (_worker_doc_cache):
+        new, _worker_doc_cache.new = _worker_doc_cache.new, []
+    return examples, new
+
+
+def _pipeline_results(pool, files, args, is_test, cache_writer=None):
+    """Examples of the chunks of `files`, in order; new document cache entries go to `cache_writer`."""
+    # At most two chunks per worker are queued or waiting to be written at any time.
+    pending = deque()
+
+    def _get(result):
+        examples, new = result.get()
+        if (cache_writer is not None):
+            for key, value in new:
+                cache_writer.add(key, value)
+        return examples
+
+    for i in range(0, len(files), _PIPELINE_CHUNK):
+        pending.append(pool.apply_async(_pipeline_chunk, ((files[i:i + _PIPELINE_CHUNK], args, is_test),)))
+        if (len(pending) >= 2 * args.n_cpus):
+            yield _get(pending.popleft())
+    while pending:
+        yield _get(pending.popleft())
+
+
+def format_to_shards(args):
+    """`format_to_lines` followed by `format_to_<pipeline_target>` without the json shards in between.
+
+    Papers are split as in `format_to_lines` and the training shards hold
+    the same papers as the ones converted from its `.json` shards would.
+    """
+    print('... (4+5) Converting tokenized data to %s data... this will take a while' % args.pipeline_target)
+    corporas = _lines_file_lists(args)
+    is_pico = args.pipeline_target.startswith('pico_adapter')
+    pool = Pool(args.n_cpus, initializer=_init_pipeline_worker, initargs=(args.pipeline_target, args))
+    cache_writer = None
+    if (args.doc_cache and not is_pico):
+        cache_writer = DocStoreWriter(pjoin(args.doc_cache, _PIPELINE_TARGETS[args.pipeline_target].__name__))
+    for corpus_type in ['train', 'valid', 'test']:
+        start = time.time()
+        is_test = corpus_type == 'test'
+        results = _pipeline_results(pool, corporas[corpus_type], args, is_test, cache_writer)
+        if (is_pico):
+            save_path = pjoin(args.save_path, corpus_type + '.padpter.pt')
+            data = [ex for examples in results for ex in examples]
+            logger.info('Saving %d instances to %s' % (len(data), save_path))
+            _torch_save_atomic(data, save_path)
+        else:
+            datasets, shard_count, n_docs, n_examples = None, 0, 0, 0
+            for ex in itertools.chain.from_iterable(results):
+                if (datasets is None):
+                    datasets = _open_bert_shard(pjoin(args.save_path, '{:s}.{:d}.{:s}'.format(
+                        corpus_type, shard_count, _bert_shard_ext(args))))
+                if (ex is not None):
+                    datasets.add(ex)
+                    n_examples += 1
+                # Like a .json shard, a shard closes once more than shard_size papers went into it.
+                n_docs += 1
+                if (n_docs > args.shard_size):
+                    datasets.close()
+                    datasets, shard_count, n_docs = None, shard_count + 1, 0
+            if (datasets is not None):
+                datasets.close()
+                shard_count += 1
+            logger.info('Saved %d instances of %s in %d shards' % (n_examples, corpus_type, shard_count))
+        elapsed = time.time() - start
+        logger.info('%s: %d papers in %.1fs (%.1f docs/s)' % (corpus_type, len(corporas[corpus_type]), elapsed,
+                                                              len(corporas[corpus_type]) / max(elapsed, 1e-6)))
+    pool.close()
+    pool.join()
+    if (cache_writer is not None):
+        logger.info('Document cache: %d papers processed' % len(cache_writer))
+        cache_writer.close()
+        _compact_doc_cache(args, _PIPELINE_TARGETS[args.pipeline_target])
+
+
 def format_xsum_to_lines(args):
     if (args.dataset != ''):
         datasets = [args.dataset]
@@ -1869,27 +1852,15 @@ def format_xsum_to_lines(args):
 
         a_lst = [(root_src, root_tgt, n) for n in realnames]
         pool = Pool(args.n_cpus)
-        dataset = []
-        p_ct = 0
+        dataset = _JsonShardWriter("{:s}.{:s}.{{:d}}.json".format(args.save_path, corpus_type), args.shard_size)
         for d in pool.imap_unordered(_format_xsum_to_lines, a_lst):
             if (d is None):
                 continue
-            dataset.append(d)
-            if (len(dataset) > args.shard_size):
-                pt_file = "{:s}.{:s}.{:d}.json".format(args.save_path, corpus_type, p_ct)
-                with open(pt_file, 'w') as save:
-                    save.write(json.dumps(dataset))
-                    p_ct += 1
-                    dataset = []
+            dataset.add(d)
 
         pool.close()
         pool.join()
-        if (len(dataset) > 0):
-            pt_file = "{:s}.{:s}.{:d}.json".format(args.save_path, corpus_type, p_ct)
-            with open(pt_file, 'w') as save:
-                save.write(json.dumps(dataset))
-                p_ct += 1
-                dataset = []
+        dataset.flush()
 
 
 def _format_xsum_to_lines(params):
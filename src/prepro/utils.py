@@ -1,3 +1,5 @@
+import numpy as np
+
 # stopwords = pkgutil.get_data(__package__, 'smart_common_words.txt')
 # stopwords = stopwords.decode('ascii').split('\n')
 # stopwords = {key.strip(): 1 for key in stopwords}
@@ -32,3 +34,89 @@ def _get_word_ngrams(n, sentences):
     words = sum(sentences, [])
     # words = [w for w in words if w not in stopwords]
     return _get_ngrams(n, words)
+
+
+class NgramOracle(object):
+    """Greedy ROUGE-1 + ROUGE-2 oracle over integer n-gram ids.
+
+    Every distinct n-gram of the document and the abstract gets an integer id,
+    and each sentence is stored as the flat array of its unique ids. The
+    current selection is kept as a coverage mask, so a greedy step only has to
+    count the n-grams each candidate would newly add, which is one batched
+    `np.bincount` over all sentences.
+
+    Scores are computed with the same float operations as
+    `data_builder.cal_rouge`, so the selected ids are identical to the
+    set-union implementation.
+    """
+
+    def __init__(self, sents, abstract, orders=(1, 2)):
+        self.n_sents = len(sents)
+        self.orders = []
+        for n in orders:
+            vocab = {}
+            ref_ids = [vocab.setdefault(g, len(vocab)) for g in _get_ngrams(n, abstract)]
+            sent_ids, owners = [], []
+            for i, sent in enumerate(sents):
+                ids = [vocab.setdefault(g, len(vocab)) for g in _get_ngrams(n, sent)]
+                sent_ids.extend(ids)
+                owners.extend([i] * len(ids))
+            in_ref = np.zeros(len(vocab), dtype=bool)
+            in_ref[ref_ids] = True
+            flat = np.array(sent_ids, dtype=np.int64)
+            owner = np.array(owners, dtype=np.int64)
+            offsets = np.zeros(self.n_sents + 1, dtype=np.int64)
+            np.cumsum(np.bincount(owner, minlength=self.n_sents), out=offsets[1:])
+            self.orders.append({
+                'flat': flat, 'owner': owner, 'offsets': offsets,
+                'flat_in_ref': in_ref[flat], 'ref_count': len(ref_ids),
+                'covered': np.zeros(len(vocab), dtype=bool),
+                'evaluated_count': 0, 'overlapping_count': 0})
+
+    def _gains(self, order):
+        """Candidate n-gram and overlap counts if each sentence were added."""
+        new = ~order['covered'][order['flat']]
+        new_count = np.bincount(order['owner'], weights=new, minlength=self.n_sents)
+        new_overlap = np.bincount(order['owner'], weights=new & order['flat_in_ref'],
+                                  minlength=self.n_sents)
+        return new_count, new_overlap
+
+    def _scores(self, order, new_count, new_overlap):
+        evaluated_count = order['evaluated_count'] + new_count
+        overlapping_count = order['overlapping_count'] + new_overlap
+        precision = np.zeros(self.n_sents)
+        np.divide(overlapping_count, evaluated_count, out=precision, where=evaluated_count != 0)
+        if order['ref_count'] == 0:
+            recall = np.zeros(self.n_sents)
+        else:
+            recall = overlapping_count / order['ref_count']
+        return 2.0 * ((precision * recall) / (precision + recall + 1e-8))
+
+    def _add(self, order, i, new_count, new_overlap):
+        start, end = order['offsets'][i], order['offsets'][i + 1]
+        order['covered'][order['flat'][start:end]] = True
+        order['evaluated_count'] += int(new_count[i])
+        order['overlapping_count'] += int(new_overlap[i])
+
+    def select(self, summary_size):
+        max_rouge = 0.0
+        selected = []
+        is_selected = np.zeros(self.n_sents, dtype=bool)
+        for _ in range(summary_size):
+            if self.n_sents == 0:
+                break
+            gains = [self._gains(order) for order in self.orders]
+            rouge_score = np.zeros(self.n_sents)
+            for order, (new_count, new_overlap) in zip(self.orders, gains):
+                rouge_score = rouge_score + self._scores(order, new_count, new_overlap)
+            rouge_score[is_selected] = -np.inf
+            cur_id = int(np.argmax(rouge_score))
+            if not rouge_score[cur_id] > max_rouge:
+                return selected
+            for order, (new_count, new_overlap) in zip(self.orders, gains):
+                self._add(order, cur_id, new_count, new_overlap)
+            selected.append(cur_id)
+            is_selected[cur_id] = True
+            max_rouge = rouge_score[cur_id]
+
+        return sorted(selected)
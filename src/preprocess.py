@@ -51,7 +51,12 @@ if __name__ == '__main__':
     parser.add_argument("-save_path", default='./token_data/')
 
     parser.add_argument("-corpus", default='cord-19',type=str)
+    parser.add_argument("-tokenizer_backend", default='corenlp', type=str, choices=['corenlp', 'python'])
     parser.add_argument("-shard_size", default=2000, type=int)
+    parser.add_argument("-pipeline_target", default='bert', type=str,
+                        choices=['bert', 'robert', 'pubmed_bert', 'bio_bert', 'pico_adapter_robert', 'pico_adapter_bert',
+                                 'pico_adapter_pubmed_bert', 'pico_adapter_bio_bert'])
+    parser.add_argument("-shard_format", default='columnar', type=str, choices=['columnar', 'pt'])
     parser.add_argument('-min_src_nsents', default=3, type=int)
     parser.add_argument('-max_src_nsents', default=100, type=int)
     parser.add_argument('-min_src_ntokens_per_sent', default=5, type=int)
@@ -61,6 +66,8 @@ if __name__ == '__main__':
 
     parser.add_argument("-lower", type=str2bool, nargs='?',const=True,default=True)
     parser.add_argument("-use_bert_basic_tokenizer", type=str2bool, nargs='?',const=True,default=False)
+    parser.add_argument("-tokenize_batch_size", default=0, type=int)
+    parser.add_argument("-doc_cache", default='', type=str)
 
     parser.add_argument('-log_file', default='/data/xieqianqian/covid-bert/logs/covid.log')
 
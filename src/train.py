@@ -6,6 +6,7 @@ from __future__ import division
 
 import argparse
 import os
+from models.precision import PRECISIONS
 from others.logging import init_logger
 from train_abstractive import validate_abs, train_abs, baseline, test_abs, test_text_abs
 from train_extractive import train_ext, validate_ext, test_ext
@@ -44,6 +45,8 @@ if __name__ == '__main__':
 
     parser.add_argument("-batch_size", default=140, type=int)
     parser.add_argument("-test_batch_size", default=200, type=int)
+    parser.add_argument("-prefetch", default=0, type=int)
+    parser.add_argument("-encoder_cache", default='', type=str)
 
     parser.add_argument("-max_pos", default=512, type=int)
     parser.add_argument("-use_interval", type=str2bool, nargs='?',const=True,default=True)
@@ -94,6 +97,8 @@ if __name__ == '__main__':
     parser.add_argument("-warmup_steps_bert", default=8000, type=int)
     parser.add_argument("-warmup_steps_dec", default=8000, type=int)
     parser.add_argument("-max_grad_norm", default=0, type=float)
+    parser.add_argument("-precision", default='fp32', type=str, choices=PRECISIONS,
+                        help="autocast precision of training, validation and test; checkpoints stay fp32")
 
     parser.add_argument("-save_checkpoint_steps", default=5, type=int)
     parser.add_argument("-accum_count", default=1, type=int)
@@ -113,6 +118,7 @@ if __name__ == '__main__':
 
     parser.add_argument("-train_from", default='')
     parser.add_argument("-report_rouge", type=str2bool, nargs='?',const=True,default=True)
+    parser.add_argument("-rouge_engine", default='native', type=str, choices=['native', 'perl'])
     parser.add_argument("-block_trigram", type=str2bool, nargs='?', const=True, default=True)
 
 
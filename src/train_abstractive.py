@@ -6,6 +6,7 @@ from __future__ import division
 
 import argparse
 import glob
+import itertools
 import os
 import random
 import signal
@@ -308,8 +309,16 @@ def train_abs_single(args, device_id):
     random.seed(args.seed)
     torch.backends.cudnn.deterministic = True
 
+    # With several GPUs every rank only loads and collates its own part of the data.
+    if (device_id >= 0 and args.world_size > 1):
+        rank, world_size = args.gpu_ranks[device_id], args.world_size
+    else:
+        rank, world_size = 0, 1
+    epochs = itertools.count()
+
     def train_iter_fct():
-        return data_loader.Dataloader(args, load_dataset(args, 'train', shuffle=True), args.batch_size, device,
+        dataset = load_dataset(args, 'train', shuffle=True, rank=rank, world_size=world_size, epoch=next(epochs))
+        return data_loader.Dataloader(args, dataset, args.batch_size, device,
                                       shuffle=True, is_test=False)
 
     model = AbsSummarizer(args, device, checkpoint, bert_from_extractive)
@@ -330,5 +339,7 @@ def train_abs_single(args, device_id):
                           label_smoothing=args.label_smoothing)
 
     trainer = build_trainer(args, device_id, model, optim, train_loss)
+    if (checkpoint is not None and trainer.scaler is not None and 'scaler' in checkpoint):
+        trainer.scaler.load_state_dict(checkpoint['scaler'])
 
     trainer.train(train_iter_fct, args.train_steps)
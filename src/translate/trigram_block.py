@@ -0,0 +1,91 @@
+from __future__ import division
+import torch
+
+_MASK = (1 << 64) - 1
+
+
+def _signed(v):
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+
+class TrigramBlocker(object):
+    """
+    Word-trigram blocking for beam search, computed on the decoding device.
+
+    Follows the check `Translator._fast_translate_batch` used to run per
+    hypothesis: word pieces are joined into words (`##` pieces continue the
+    previous word) and a hypothesis is blocked when the trigram ending at its
+    last, possibly unfinished, word already occurs earlier in it.
+
+    A word is represented by a 64-bit polynomial hash of its text, so the
+    same word gets the same hash however it was split into pieces, and a
+    trigram by a hash of its three word hashes. All arithmetic is on int64
+    tensors and wraps around.
+
+    Args:
+       ids_to_tokens (dict): word piece id -> token of the tokenizer
+       device (`torch.device`): decoding device
+    """
+
+    P = 1000003
+    Q = 1099511628211
+
+    def __init__(self, ids_to_tokens, device):
+        size = max(ids_to_tokens) + 1
+        piece_hash = [0] * size
+        piece_pow = [1] * size
+        is_cont = [False] * size
+        for i, token in ids_to_tokens.items():
+            if token.startswith('##'):
+                is_cont[i] = True
+                token = token[2:]
+            h, p = 0, 1
+            for ch in token:
+                h = (h * self.P + ord(ch)) & _MASK
+                p = (p * self.P) & _MASK
+            piece_hash[i] = _signed(h)
+            piece_pow[i] = _signed(p)
+        self.piece_hash = torch.tensor(piece_hash, dtype=torch.long, device=device)
+        self.piece_pow = torch.tensor(piece_pow, dtype=torch.long, device=device)
+        self.is_cont = torch.tensor(is_cont, dtype=torch.bool, device=device)
+
+    def _trigram(self, w2, w1, w0):
+        return (w2 * self.Q + w1) * self.Q + w0
+
+    def init_state(self, first_tokens):
+        """ State of hypotheses holding only `first_tokens`, one per row. """
+        n = first_tokens.size(0)
+        zeros = torch.zeros(n, dtype=torch.long, device=first_tokens.device)
+        return {
+            'word': self.piece_hash[first_tokens],
+            'prev1': zeros,
+            'prev2': zeros.clone(),
+            'n_words': torch.ones_like(zeros),
+            'trigrams': zeros.new_zeros((n, 0)),
+            'closed': torch.zeros((n, 0), dtype=torch.bool, device=first_tokens.device),
+        }
+
+    def advance(self, state, tokens):
+        """ Append one word piece id per hypothesis. """
+        word, prev1, prev2, n_words = state['word'], state['prev1'], state['prev2'], state['n_words']
+        starts = ~self.is_cont[tokens]
+        # The trigram ending at `word` is complete once the next word starts.
+        closed = starts & (n_words >= 3)
+        return {
+            'word': torch.where(starts, self.piece_hash[tokens],
+                                word * self.piece_pow[tokens] + self.piece_hash[tokens]),
+            'prev1': torch.where(starts, word, prev1),
+            'prev2': torch.where(starts, prev1, prev2),
+            'n_words': n_words + starts.long(),
+            'trigrams': torch.cat([state['trigrams'], self._trigram(prev2, prev1, word).unsqueeze(1)], 1),
+            'closed': torch.cat([state['closed'], closed.unsqueeze(1)], 1),
+        }
+
+    def index_select(self, state, indices):
+        return {k: v.index_select(0, indices) for k, v in state.items()}
+
+    def blocked(self, state):
+        """ Bool mask of the hypotheses whose last trigram repeats an earlier one. """
+        last = self._trigram(state['prev2'], state['prev1'], state['word'])
+        repeated = (state['trigrams'].eq(last.unsqueeze(1)) & state['closed']).any(1)
+        return repeated & (state['n_words'] > 3)